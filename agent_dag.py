@@ -0,0 +1,133 @@
+"""
+Dependency-graph execution for multi-stage agent pipelines
+A pipeline is a list of Stages, each a chain built once plus the names of its inputs. An input
+is either a key of the pipeline's input dict or the name of an earlier stage, which makes that
+stage a dependency. invoke() starts every stage as soon as its dependencies are done, so stages
+that do not depend on each other call the model concurrently, and it records per-stage timings.
+
+    pipeline = AgentDAG([
+        Stage("situation", situation_chain, ["complaint", "chat_history"]),
+        Stage("thought", thought_chain, ["complaint", "situation", "chat_history"]),
+        Stage("reframe", reframe_chain, ["thought", "situation"]),
+        Stage("rephrase_thought", rephrase_chain, ["thought"]),          # runs alongside reframe
+        Stage("rephrase_reframe", rephrase_chain, {"thought": "reframe"}),
+    ])
+    results = pipeline.invoke({"complaint": ..., "chat_history": ...})
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Stages of all pipelines share one bounded pool; the calling thread only schedules
+MAX_WORKERS = int(os.getenv("AGENT_DAG_WORKERS", "16"))
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="agent-dag")
+        return _executor
+
+
+class Stage:
+    """
+    One pipeline step. inputs maps the chain's input names to the pipeline input keys or stage
+    names they come from; a list means the same names on both sides.
+    """
+
+    def __init__(self, name, chain, inputs):
+        self.name = name
+        self.chain = chain
+        self.inputs = dict(inputs) if isinstance(inputs, dict) else {source: source for source in inputs}
+
+    def run(self, values):
+        return self.chain.invoke({argument: values[source] for argument, source in self.inputs.items()})
+
+
+class AgentDAG:
+    """A pipeline of Stages run in dependency order, independent stages concurrently"""
+
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        self.dependencies = {name: {source for source in stage.inputs.values() if source in self.stages}
+                             for name, stage in self.stages.items()}
+        self._check_acyclic()
+        self._stats = {name: {"count": 0, "total_ms": 0.0, "last_ms": None} for name in self.stages}
+        self._stats_lock = threading.Lock()
+
+    def _check_acyclic(self):
+        done, visiting = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage '{name}' is part of a dependency cycle")
+            visiting.add(name)
+            for dependency in self.dependencies[name]:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _timed(self, stage, values):
+        started = time.perf_counter()
+        result = stage.run(values)
+        return result, (time.perf_counter() - started) * 1000
+
+    def run(self, inputs):
+        """Run the pipeline; returns (stage results by name, stage durations in ms by name)"""
+        values = dict(inputs)
+        results, timings = {}, {}
+        pending = dict(self.dependencies)
+        running = {}
+        executor = _get_executor()
+        try:
+            while pending or running:
+                ready = [name for name, dependencies in pending.items() if dependencies <= results.keys()]
+                for name in ready:
+                    del pending[name]
+                if len(ready) == 1 and not running:
+                    # Nothing to overlap with: run in the calling thread
+                    name = ready[0]
+                    results[name], timings[name] = self._timed(self.stages[name], values)
+                    values[name] = results[name]
+                    continue
+                for name in ready:
+                    running[executor.submit(self._timed, self.stages[name], dict(values))] = name
+                if not running:
+                    raise ValueError(f"Unsatisfiable stage inputs: {sorted(pending)}")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    results[name], timings[name] = future.result()
+                    values[name] = results[name]
+        finally:
+            for future in running:
+                future.cancel()
+        with self._stats_lock:
+            for name, ms in timings.items():
+                stats = self._stats[name]
+                stats["count"] += 1
+                stats["total_ms"] += ms
+                stats["last_ms"] = round(ms, 1)
+        return results, timings
+
+    def invoke(self, inputs):
+        """Run the pipeline and return the stage results by name"""
+        return self.run(inputs)[0]
+
+    def timings(self):
+        """Per-stage call count, mean and last duration (ms) since the pipeline was built"""
+        with self._stats_lock:
+            return {name: {"count": stats["count"], "last_ms": stats["last_ms"],
+                           "mean_ms": round(stats["total_ms"] / stats["count"], 1) if stats["count"] else None}
+                    for name, stats in self._stats.items()}
@@ -3,11 +3,15 @@ import os
 import langchain_openai as lcai
 from langchain_openai import ChatOpenAI
 from utils import mLangChain
+from agent_dag import AgentDAG, Stage
+from llm_cache import LLMCache
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 
 import re
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 load_dotenv("project.env")
 
@@ -48,6 +52,13 @@ except Exception as e:
     llminfo = None
     llmemo = None
 
+# Exact-match response cache for the agents listed in LLM_CACHE_AGENTS (comma-separated names used
+# below: sender, customer, context, info, trouble, reframe, shoes; "*" for all)
+llm_cache = LLMCache(max_entries=int(os.getenv("LLM_CACHE_SIZE", "4096")),
+                     ttl=float(os.getenv("LLM_CACHE_TTL", "0")) or None,
+                     path=os.getenv("LLM_CACHE_PATH") or None,
+                     agents=os.getenv("LLM_CACHE_AGENTS", "").split(","))
+
 
 categories = {
     "Service Quality": "Issues related to the immediate experience of human-to-human service interactions, such as delays, staff behavior, and communication errors.",
@@ -85,9 +96,82 @@ def get_historical_context_chain():
             ("human", "{sender}:{message}"),
         ]
     )
-    contextualize_q_chain = contextualize_q_prompt | llminfo | StrOutputParser()
+    contextualize_q_chain = contextualize_q_prompt | llm_cache.cached(llminfo, "context") | StrOutputParser()
     return contextualize_q_chain
 
+
+class ContextCache:
+    """
+    Conversation-context summaries per (chain tag, client_id, turn), shared by every agent handling that turn.
+    A summary is computed at most once per key, by the first agent that needs it; agents asking
+    for the same key meanwhile wait for that result instead of calling the model again.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """Cached value for key, computing it with compute() if needed; key None disables caching"""
+        if key is None:
+            return compute()
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                self.misses += 1
+                entry = self._entries[key] = {"ready": threading.Event(), "value": None, "error": None}
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        if owner:
+            try:
+                entry["value"] = compute()
+            except Exception as e:
+                # Do not cache failures: the next agent retries
+                entry["error"] = e
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                raise
+            finally:
+                entry["ready"].set()
+        else:
+            entry["ready"].wait()
+            if entry["error"] is not None:
+                raise entry["error"]
+        return entry["value"]
+
+
+context_cache = ContextCache()
+
+
+def with_context(template, context_chain_factory, tag):
+    """
+    Put a prompt template behind the shared conversation-context summary.
+    The summary chain is only built and run if the template references {context}, and then once
+    per (tag, client_id, turn) across agents (see ContextCache). tag names the summary chain, so
+    agents share a context only if they use the same chain. Inputs without client_id and turn
+    are summarized on every call, as before.
+    """
+    if 'context' not in template.input_variables:
+        return template
+    context_chain = context_chain_factory()
+
+    def add_context(inputs):
+        key = None
+        if inputs.get('client_id') is not None and inputs.get('turn') is not None:
+            key = (tag, inputs['client_id'], inputs['turn'])
+        return dict(inputs, context=context_cache.get(key, lambda: context_chain.invoke(inputs)))
+
+    return RunnableLambda(add_context) | template
+
+
 class mAgentInfo:
     def __init__(self):
         self.info_chain = self.agent_coworker_info()
@@ -97,7 +181,9 @@ class mAgentInfo:
             'domain':input_params['domain'],
             'message':input_params['message'],
             'sender': input_params['sender'],
-            'chat_history':input_params['chat_history']
+            'chat_history':input_params['chat_history'],
+            'client_id': input_params.get('client_id'),
+            'turn': input_params.get('turn'),
             })
 
         return info_cue
@@ -129,12 +215,8 @@ class mAgentInfo:
             ]
         )
 
-        chain = (RunnablePassthrough.assign(
-            context=get_historical_context_chain()
-        )
-                 | template
-                 | llminfo
-                 )
+        # The summary is only computed if the prompt uses {context}
+        chain = with_context(template, get_historical_context_chain, "summary") | llm_cache.cached(llminfo, "info")
 
         chain = chain | extract_cues
 
@@ -150,7 +232,9 @@ class mAgentTrouble:
             'domain':input_params['domain'],
             'message':input_params['message'],
             'sender': input_params['sender'],
-            'chat_history':input_params['chat_history']
+            'chat_history':input_params['chat_history'],
+            'client_id': input_params.get('client_id'),
+            'turn': input_params.get('turn'),
         })
 
         return trouble_steps
@@ -181,12 +265,8 @@ class mAgentTrouble:
             ]
         )
 
-        chain = (RunnablePassthrough.assign(
-            context=get_historical_context_chain()
-        )
-                 | template
-                 | llminfo
-                 )
+        # The summary is only computed if the prompt uses {context}
+        chain = with_context(template, get_historical_context_chain, "summary") | llm_cache.cached(llminfo, "trouble")
 
         chain = chain | extract_cues
 
@@ -197,14 +277,17 @@ class mAgentEP:
     def __init__(self):
         self.ep_chain = self.agent_coworker_emo_perspective()
         self.rephrase = self.paraphraseResponse()
+        self.pipeline = AgentDAG([
+            Stage('perspective', self.ep_chain, ['complaint']),
+            Stage('rephrase', self.rephrase, {'response': 'perspective'}),
+        ])
 
     def invoke(self, user_input):
 
         # emo_perspec = self.ep_chain.invoke({'complaint':input_params['complaint'], 'chat_history':input_params['chat_history']})
-        emo_perspec = self.ep_chain.invoke({'complaint':user_input['complaint']})
-        final_res = self.rephrase.invoke({'response': emo_perspec})
+        results = self.pipeline.invoke({'complaint':user_input['complaint']})
 
-        return final_res
+        return results['rephrase']
     
     def agent_coworker_emo_perspective(self):
         prompt = """Your role is to provide the customer's perspective of the conversation.
@@ -223,7 +306,7 @@ class mAgentEP:
                 ("user", "{complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "shoes") | StrOutputParser()
 
         return chain
     
@@ -237,7 +320,7 @@ class mAgentEP:
                 ("user", "{response}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "shoes") | StrOutputParser()
         return chain
 
 class mAgentER:
@@ -245,23 +328,25 @@ class mAgentER:
         self.situation_chain = self.agent_coworker_emo_situation()
         self.thought_chain = self.agent_coworker_emo_thought()
         self.reframe_chain = self.agent_coworker_emo_reframe()
+        # Once the thought exists, its rephrase runs alongside reframe -> rephrase_reframe
+        self.pipeline = AgentDAG([
+            Stage('situation', self.situation_chain, ['complaint', 'chat_history']),
+            Stage('thought', self.thought_chain, ['complaint', 'situation', 'chat_history']),
+            Stage('reframe', self.reframe_chain, ['thought', 'situation']),
+            Stage('rephrase_thought', self.rephrase(), ['thought']),
+            Stage('rephrase_reframe', self.rephrase_rf(), {'thought': 'reframe'}),
+        ])
 
     def invoke(self, user_input):
-        situation = self.situation_chain.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history']})
-        thought = self.thought_chain.invoke({'complaint':user_input['complaint'], 'situation':situation, 'chat_history':user_input['chat_history']})
-        reframe = self.reframe_chain.invoke({'thought':thought, 'situation':situation})
-
-
-        rephrase_thought = self.rephrase().invoke({'thought':thought})
-        print(rephrase_thought)
+        results = self.pipeline.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history']})
 
-        rephrase_reframe = self.rephrase_rf().invoke({'thought':reframe})
-        print(rephrase_reframe)
+        print(results['rephrase_thought'])
+        print(results['rephrase_reframe'])
 
         return {
-            'situation': situation.strip(),
-            'thought': rephrase_thought.strip(),
-            'reframe': rephrase_reframe.strip(),
+            'situation': results['situation'].strip(),
+            'thought': results['rephrase_thought'].strip(),
+            'reframe': results['rephrase_reframe'].strip(),
         }
     
 
@@ -285,7 +370,7 @@ class mAgentER:
                 ("user", "{complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -308,7 +393,7 @@ class mAgentER:
                 ("user", "{thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
     def rephrase_rf(self):
@@ -330,7 +415,7 @@ class mAgentER:
                 ("user", "{thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
     def agent_coworker_emo_thought(self):
@@ -368,7 +453,7 @@ class mAgentER:
                 ("user", "{situation}: {complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -406,7 +491,7 @@ class mAgentER:
                 ("user", "{situation}: {thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -424,7 +509,7 @@ class mAgentCustomer:
                 ("human", "{question}"),
             ]
         )
-        contextualize_q_chain = contextualize_q_prompt | llmchat | StrOutputParser()
+        contextualize_q_chain = contextualize_q_prompt | llm_cache.cached(llmchat, "customer") | StrOutputParser()
         return contextualize_q_chain
     
     def get_civil_chain(self):
@@ -450,13 +535,7 @@ class mAgentCustomer:
                 '''),
             ]
         )
-        rag_chain_info = (
-                RunnablePassthrough.assign(
-                    context=self.history_chain
-                )
-                | qa_info
-                | llmchat
-        )
+        rag_chain_info = with_context(qa_info, lambda: self.history_chain, "customer_question") | llm_cache.cached(llmchat, "customer")
         return rag_chain_info
     
     def get_uncivil_chain(self):
@@ -482,20 +561,16 @@ class mAgentCustomer:
                 '''),
             ]
         )
-        rag_chain_info = (
-                RunnablePassthrough.assign(
-                    context=self.history_chain
-                )
-                | qa_info
-                | llmchat
-        )
+        rag_chain_info = with_context(qa_info, lambda: self.history_chain, "customer_question") | llm_cache.cached(llmchat, "customer")
         return rag_chain_info
 
     def invoke(self, user_input):
+        inputs = {"chat_history": user_input['chat_history'], "question": user_input['input'], "civil": user_input['civil'],
+                  "client_id": user_input.get('client_id'), "turn": user_input.get('turn')}
         if user_input['civil'] == '1':
-            ai_msg = self.civil_chain.invoke({"chat_history": user_input['chat_history'], "question": user_input['input'], "civil": user_input['civil']})
+            ai_msg = self.civil_chain.invoke(inputs)
         else:
-            ai_msg = self.uncivil_chain.invoke({"chat_history": user_input['chat_history'], "question": user_input['input'], "civil": user_input['civil']})
+            ai_msg = self.uncivil_chain.invoke(inputs)
 
         # Handle both string output
         raw = ai_msg.content if hasattr(ai_msg, 'content') else str(ai_msg)
@@ -669,7 +744,7 @@ def agent_sender_fewshot_twitter_categorized():
             ("system", prompt),
         ]
     )
-    chain = template | llmchat | StrOutputParser()
+    chain = template | llm_cache.cached(llmchat, "sender") | StrOutputParser()
     return chain
 
 def agent_sender_fewshot_twitter():
@@ -735,6 +810,6 @@ def agent_sender_fewshot_twitter():
             ("system", prompt),
         ]
     )
-    chain = template | llmchat | StrOutputParser()
+    chain = template | llm_cache.cached(llmchat, "sender") | StrOutputParser()
     return chain
 
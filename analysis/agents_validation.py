@@ -3,11 +3,18 @@ from langchain_core.output_parsers import StrOutputParser
 import langchain_openai as lcai
 
 import os
+import sys
 from dotenv import load_dotenv
 ROOT_RELATIVE_PATH = os.path.dirname(os.path.abspath(''))
 project_env = os.path.join(ROOT_RELATIVE_PATH, 'project.env')
 load_dotenv(project_env)
 
+# agent_dag and llm_cache live in the repository root
+if ROOT_RELATIVE_PATH not in sys.path:
+    sys.path.append(ROOT_RELATIVE_PATH)
+from agent_dag import AgentDAG, Stage
+from llm_cache import LLMCache
+
 DEBUG = False
 
 llmemo = lcai.AzureChatOpenAI(
@@ -19,20 +26,28 @@ llmemo = lcai.AzureChatOpenAI(
     temperature=1,
 )
 
+# Off unless LLM_CACHE_AGENTS lists "reframe"; generate_reframe_summative.py turns it on
+llm_cache = LLMCache(ttl=float(os.getenv("LLM_CACHE_TTL", "0")) or None,
+                     path=os.getenv("LLM_CACHE_PATH") or None,
+                     agents=os.getenv("LLM_CACHE_AGENTS", "").split(","))
+
 class mAgentER_validation:
     def __init__(self):
         self.situation_chain = self.agent_coworker_emo_situation()
         self.thought_chain = self.agent_coworker_emo_thought()
         self.reframe_chain = self.agent_coworker_emo_reframe()
+        self.pipeline = AgentDAG([
+            Stage('situation', self.situation_chain, ['complaint', 'chat_history']),
+            Stage('thought', self.thought_chain, ['complaint', 'situation', 'chat_history']),
+            Stage('reframe', self.reframe_chain, ['thought', 'situation']),
+            Stage('rephrase_thought', self.rephrase(), ['thought']),
+            Stage('rephrase_reframe', self.rephrase_rf(), {'reframe_thought': 'reframe'}),
+        ])
 
     def invoke(self, user_input):
-        situation = self.situation_chain.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history']})
-        thought = self.thought_chain.invoke({'complaint':user_input['complaint'], 'situation':situation, 'chat_history':user_input['chat_history']})
-        reframe = self.reframe_chain.invoke({'thought':thought, 'situation':situation})
-
-
-        rephrase_thought = self.rephrase().invoke({'thought':thought})
-        rephrase_reframe = self.rephrase_rf().invoke({'reframe_thought':reframe})
+        results = self.pipeline.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history']})
+        thought, rephrase_thought = results['thought'], results['rephrase_thought']
+        reframe, rephrase_reframe = results['reframe'], results['rephrase_reframe']
 
         if DEBUG:
             print(f"{thought}\n -> \n{rephrase_thought}\n")
@@ -40,7 +55,7 @@ class mAgentER_validation:
             print(f"{reframe}\n -> \n{rephrase_reframe}\n")
 
         return {
-            'situation': situation.strip(),
+            'situation': results['situation'].strip(),
             'thought': rephrase_thought.strip(),
             'reframe': rephrase_reframe.strip(),
         }
@@ -66,7 +81,7 @@ class mAgentER_validation:
                 ("user", "{complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -89,7 +104,7 @@ class mAgentER_validation:
                 ("user", "{thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
     def rephrase_rf(self):
@@ -111,7 +126,7 @@ class mAgentER_validation:
                 ("user", "{reframe_thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
     def agent_coworker_emo_thought(self):
@@ -149,7 +164,7 @@ class mAgentER_validation:
                 ("user", "{situation}: {complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -187,7 +202,7 @@ class mAgentER_validation:
                 ("user", "{situation}: {thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -197,15 +212,18 @@ class nAgentER_ctx_pers:
         self.situation_chain = self.agent_coworker_emo_situation()
         self.thought_chain = self.agent_coworker_emo_thought()
         self.reframe_chain = self.agent_coworker_emo_reframe()
+        self.pipeline = AgentDAG([
+            Stage('situation', self.situation_chain, ['complaint', 'chat_history']),
+            Stage('thought', self.thought_chain, ['complaint', 'situation', 'chat_history', 'personality']),
+            Stage('reframe', self.reframe_chain, ['thought', 'situation', 'personality']),
+            Stage('rephrase_thought', self.rephrase(), ['thought']),
+            Stage('rephrase_reframe', self.rephrase_rf(), {'reframe_thought': 'reframe'}),
+        ])
 
     def invoke(self, user_input):
-        situation = self.situation_chain.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history']})
-        thought = self.thought_chain.invoke({'complaint':user_input['complaint'], 'situation':situation, 'chat_history':user_input['chat_history'],  "personality": user_input['personality']})
-        reframe = self.reframe_chain.invoke({'thought':thought, 'situation':situation,  "personality": user_input['personality']})
-
-
-        rephrase_thought = self.rephrase().invoke({'thought':thought})
-        rephrase_reframe = self.rephrase_rf().invoke({'reframe_thought':reframe})
+        results = self.pipeline.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history'], "personality": user_input['personality']})
+        thought, rephrase_thought = results['thought'], results['rephrase_thought']
+        reframe, rephrase_reframe = results['reframe'], results['rephrase_reframe']
 
         if DEBUG:
             print(f"{thought}\n -> \n{rephrase_thought}\n")
@@ -213,7 +231,7 @@ class nAgentER_ctx_pers:
             print(f"{reframe}\n -> \n{rephrase_reframe}\n")
 
         return {
-            'situation': situation.strip(),
+            'situation': results['situation'].strip(),
             'thought': rephrase_thought.strip(),
             'reframe': rephrase_reframe.strip(),
         }
@@ -239,7 +257,7 @@ class nAgentER_ctx_pers:
                 ("user", "{complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -262,7 +280,7 @@ class nAgentER_ctx_pers:
                 ("user", "{thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
     def rephrase_rf(self):
@@ -284,7 +302,7 @@ class nAgentER_ctx_pers:
                 ("user", "thought: {reframe_thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
 
@@ -325,7 +343,7 @@ class nAgentER_ctx_pers:
                 ("user", "{situation} +  {personality}: {thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -347,7 +365,7 @@ class nAgentER_ctx_pers:
                 ("user", "{situation} + {personality}: {complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -358,15 +376,18 @@ class nAgentER_ctx_behv:
         self.situation_chain = self.agent_coworker_emo_situation()
         self.thought_chain = self.agent_coworker_emo_thought()
         self.reframe_chain = self.agent_coworker_emo_reframe()
+        self.pipeline = AgentDAG([
+            Stage('situation', self.situation_chain, ['complaint', 'chat_history']),
+            Stage('thought', self.thought_chain, ['complaint', 'situation', 'chat_history', 'behavior']),
+            Stage('reframe', self.reframe_chain, ['thought', 'situation', 'behavior']),
+            Stage('rephrase_thought', self.rephrase(), ['thought']),
+            Stage('rephrase_reframe', self.rephrase_rf(), {'reframe_thought': 'reframe'}),
+        ])
 
     def invoke(self, user_input):
-        situation = self.situation_chain.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history']})
-        thought = self.thought_chain.invoke({'complaint':user_input['complaint'], 'situation':situation, 'chat_history':user_input['chat_history'],  "behavior": user_input['behavior']})
-        reframe = self.reframe_chain.invoke({'thought':thought, 'situation':situation,  "behavior": user_input['behavior']})
-
-
-        rephrase_thought = self.rephrase().invoke({'thought':thought})
-        rephrase_reframe = self.rephrase_rf().invoke({'reframe_thought':reframe})
+        results = self.pipeline.invoke({'complaint':user_input['complaint'], 'chat_history':user_input['chat_history'], "behavior": user_input['behavior']})
+        thought, rephrase_thought = results['thought'], results['rephrase_thought']
+        reframe, rephrase_reframe = results['reframe'], results['rephrase_reframe']
 
         if DEBUG:
             print(f"{thought}\n -> \n{rephrase_thought}\n")
@@ -374,7 +395,7 @@ class nAgentER_ctx_behv:
             print(f"{reframe}\n -> \n{rephrase_reframe}\n")
 
         return {
-            'situation': situation.strip(),
+            'situation': results['situation'].strip(),
             'thought': rephrase_thought.strip(),
             'reframe': rephrase_reframe.strip(),
         }
@@ -400,7 +421,7 @@ class nAgentER_ctx_behv:
                 ("user", "{complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -423,7 +444,7 @@ class nAgentER_ctx_behv:
                 ("user", "{thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
     def rephrase_rf(self):
@@ -445,7 +466,7 @@ class nAgentER_ctx_behv:
                 ("user", "thought: {reframe_thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
         return chain
 
 
@@ -486,7 +507,7 @@ class nAgentER_ctx_behv:
                 ("user", "{situation} +  {behavior}: {thought}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
@@ -508,7 +529,7 @@ class nAgentER_ctx_behv:
                 ("user", "{situation} + {behavior}: {complaint}"),
             ]
         )
-        chain = template | llmemo | StrOutputParser()
+        chain = template | llm_cache.cached(llmemo, "reframe") | StrOutputParser()
 
         return chain
 
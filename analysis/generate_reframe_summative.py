@@ -9,6 +9,10 @@ DIR_PATH = os.path.join(ROOT_RELATIVE_PATH,'data')    # Default path is data dir
 DIR_SERVER_PATH = os.path.join(DIR_PATH,'server_data')
 DIR_SANITIZED_PATH = os.path.join(DIR_SERVER_PATH,'sanitized_data')
 
+# Re-runs answer the prompts they already sent from the cache instead of the model
+av.llm_cache.enable("reframe")
+av.llm_cache.persist(os.path.join(DIR_PATH,'cache','llm_cache_reframe.jsonl'))
+
 ### Load the data
 incidents_df = pd.read_csv(os.path.join(ROOT_RELATIVE_PATH,'phase1_scenarios.tsv'), sep='\t')
 
@@ -85,7 +89,11 @@ Total time to generate messages for 45 incidents: 45*78 = 3510 seconds = 58.5 mi
 def generate_empathetic_msgs(incidents_df):
     responses = []
     for index, row in incidents_df.iterrows():
+        misses = av.llm_cache.stats()["counters"].get("reframe", {}).get("misses", 0)
         responses += generate_empathetic_msg(row)
+        if av.llm_cache.stats()["counters"].get("reframe", {}).get("misses", 0) == misses:
+            # Every message came from the cache: no model calls to pace
+            continue
         print("Taking a 15 second break...")
         time.sleep(15)
         print()
@@ -94,4 +102,5 @@ def generate_empathetic_msgs(incidents_df):
     return responses_df
 
 responses_df = generate_empathetic_msgs(incidents_df)
+print(f"LLM cache: {av.llm_cache.stats()}")
 responses_df.to_csv(os.path.join(DIR_SANITIZED_PATH,'empathetic_msgs_ai.tsv'), sep='\t', index=False)
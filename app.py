@@ -1,11 +1,10 @@
 from flask import Flask, send_from_directory
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, stream_with_context
 import os, json
 
 from agents import *
 
 from langchain_core.messages import AIMessage, HumanMessage
-from langchain.schema import messages_from_dict, messages_to_dict
 from sentiment import analyze_sentiment_decision
 
 import config as common
@@ -19,11 +18,16 @@ import config as common
 USE_MONGODB = False
 
 # Import JSON-based database
-from json_db import JSONClient
+from json_db import JSONClient, archive_completed_sessions, cache_info, slow_queries
+from sqlite_db import SQLiteClient
+from quota import QuotaCounters
+from conversation_store import ConversationStore
+from support_slots import SupportSlots
 
 from dotenv import load_dotenv
 from uuid import uuid4
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask_session import Session
 load_dotenv("project.env")
 
@@ -41,10 +45,36 @@ app.config['SESSION_TYPE'] = 'filesystem'
 
 Session(app)
 
-### Database - JSON file storage only (MongoDB disabled)
-print("📁 Using JSON file storage for data")
-client = JSONClient(db_dir='data')
+### Database - local file storage (MongoDB disabled)
+# DB_BACKEND=sqlite stores collections in data/<db>.sqlite3 instead of JSON files (see sqlite_db.py)
+DB_BACKEND = os.getenv("DB_BACKEND", "json")
+# JSON_DB_STORAGE=jsonl switches to the append-only log format (see json_db.py)
+JSON_DB_STORAGE = os.getenv("JSON_DB_STORAGE", "json")
+# JSON_DB_WRITE_BEHIND=1 commits writes from a background thread instead of the request thread
+JSON_DB_WRITE_BEHIND = os.getenv("JSON_DB_WRITE_BEHIND", "0") == "1"
+# JSON_DB_PARTITION_SESSIONS=1 shards chat_history/chat_in_task into one file per session_id
+JSON_DB_PARTITION_SESSIONS = os.getenv("JSON_DB_PARTITION_SESSIONS", "0") == "1"
+if DB_BACKEND == "sqlite":
+    print("📁 Using SQLite storage for data")
+    client = SQLiteClient(db_dir='data')
+else:
+    print(f"📁 Using JSON file storage for data ({JSON_DB_STORAGE})")
+    client = JSONClient(db_dir='data', storage=JSON_DB_STORAGE,
+                        write_behind=JSON_DB_WRITE_BEHIND,
+                        flush_interval=float(os.getenv("JSON_DB_FLUSH_INTERVAL", "0.05")),
+                        fsync=os.getenv("JSON_DB_FSYNC", "always"),
+                        codec=os.getenv("JSON_DB_CODEC", "json"),
+                        compact_bytes=int(float(os.getenv("JSON_DB_COMPACT_MB", "16")) * 1024 * 1024),
+                        slow_ms=float(os.environ["JSON_DB_SLOW_MS"]) if os.getenv("JSON_DB_SLOW_MS") else None)
 db = client.flask_db
+if DB_BACKEND != "sqlite" and JSON_DB_PARTITION_SESSIONS:
+    # Nearly every runtime access is scoped to one session; exports still scan all partitions
+    db.partitioned('chat_history', 'session_id')
+    db.partitioned('chat_in_task', 'session_id')
+if DB_BACKEND != "sqlite":
+    # Treatment assignment needs every worker to see the latest counts: never write-behind
+    db.get_collection('quota_counters', write_behind=False)
+    db.get_collection('participants', write_behind=False)
 
 # Collections
 chat_post_task = db.chat_post_task
@@ -58,6 +88,46 @@ summative_scoring = db.summative_scoring
 # New collection for experimental design
 participants = db.participants  # Stores treatment assignment and session info
 
+# Secondary indexes for the lookups made on every request
+chat_history_collection.create_index([("session_id", 1), ("client_id", 1)])
+chat_client_info.create_index("session_id")
+chat_in_task.create_index([("session_id", 1), ("client_id", 1), ("turn_number", 1), ("support_type", 1)])
+participants.create_index("session_id")
+participants.create_index([("treatment_group", 1), ("emotion_regulation_type", 1)])
+
+# Quotas: 4 treatments x 2 types = 8 cells, each needs 30 participants
+TREATMENTS = ["control", "information", "emotion", "both"]
+EMOTION_REGULATION_TYPES = ["Suppressor", "NonSuppressor"]
+QUOTA_PER_CELL = 30
+# Per-cell counters kept in sync with participants.treatment_group/screened_out by storePreSurvey
+quotas = QuotaCounters(db.quota_counters, participants, TREATMENTS, EMOTION_REGULATION_TYPES, QUOTA_PER_CELL)
+quotas.seed()
+
+# JSON_DB_ARCHIVE_DAYS=N archives the chat documents of sessions completed more than N days ago at startup
+# (see archive_sessions.py); they stay readable through collection.archived()
+JSON_DB_ARCHIVE_DAYS = float(os.getenv("JSON_DB_ARCHIVE_DAYS", "0"))
+if DB_BACKEND != "sqlite" and JSON_DB_ARCHIVE_DAYS > 0:
+    archived = archive_completed_sessions(participants, {"chat_history": chat_history_collection,
+                                                         "chat_client_info": chat_client_info,
+                                                         "chat_in_task": chat_in_task}, JSON_DB_ARCHIVE_DAYS)
+    print(f"📦 Archived sessions older than {JSON_DB_ARCHIVE_DAYS:g} days: {archived}")
+
+# Conversations (client settings + message log) are kept server-side by client_id; the session only
+# holds identifiers. CONVERSATION_STORE=memory keeps them in this process instead of the database.
+if os.getenv("CONVERSATION_STORE", "db") == "memory":
+    conversations = ConversationStore()
+else:
+    conversations = ConversationStore(db.conversations, db.conversation_turns)
+
+
+def get_conversation(session_id, client_id):
+    """The conversation of one of this session's clients, or None"""
+    conversation = conversations.get(client_id) if client_id else None
+    if conversation is None or conversation.session_id != session_id:
+        return None
+    return conversation
+
+
 sender_agent = None
 chat_history = [
 ]
@@ -278,25 +348,22 @@ def storePreSurvey(session_id):
         print("="*60, flush=True)
 
         # Check quota availability and assign treatment
-        # Quotas: 4 treatments x 2 types = 8 cells, each needs 30 participants
-        treatments = ["control", "information", "emotion", "both"]
-        quota_per_cell = 30
-
-        # Get current counts from MongoDB
         print(f"\nChecking Quotas for {emotion_regulation_type}:", flush=True)
-        available_treatments = []
-        for treatment in treatments:
-            count = participants.count_documents({
-                "treatment_group": treatment,
-                "emotion_regulation_type": emotion_regulation_type,
-                "screened_out": {"$ne": True}  # Don't count screened-out participants
-            })
-            print(f"  {treatment}: {count}/{quota_per_cell} participants", flush=True)
-            if count < quota_per_cell:
-                available_treatments.append(treatment)
+        for treatment, count in quotas.counts(emotion_regulation_type).items():
+            print(f"  {treatment}: {count}/{QUOTA_PER_CELL} participants", flush=True)
+
+        # A resubmitted survey gives back the slot of the earlier assignment once the new one is recorded
+        previous = participants.find_one({"session_id": session_id},
+                                         {"treatment_group": 1, "emotion_regulation_type": 1, "screened_out": 1})
+        previous_cell = None
+        if previous and previous.get("treatment_group") and not previous.get("screened_out"):
+            previous_cell = (previous["treatment_group"], previous.get("emotion_regulation_type"))
+
+        # Atomically reserve a slot in a random cell with room left
+        assigned_treatment = quotas.reserve(emotion_regulation_type)
 
         # If no slots available, screen out
-        if len(available_treatments) == 0:
+        if assigned_treatment is None:
             print(f"\n⚠️  SCREENING OUT: All quotas full for {emotion_regulation_type}", flush=True)
             print("="*60 + "\n", flush=True)
             # Mark participant as screened out
@@ -309,6 +376,8 @@ def storePreSurvey(session_id):
                     "screen_out_time": datetime.datetime.now(datetime.timezone.utc)
                 }}
             )
+            if previous_cell:
+                quotas.release(*previous_cell)
             # Save pre-task survey data
             data.pop('client_param', None)
             data['session_id'] = session_id
@@ -323,10 +392,6 @@ def storePreSurvey(session_id):
                 "next_url": screen_out_url
             }), 200
 
-        # Randomly assign to one of the available treatments
-        import random
-        assigned_treatment = random.choice(available_treatments)
-
         print(f"\n✅ TREATMENT ASSIGNED: {assigned_treatment}", flush=True)
         print(f"   Session ID: {session_id}", flush=True)
         print("="*60 + "\n", flush=True)
@@ -335,15 +400,21 @@ def storePreSurvey(session_id):
         session[session_id]['treatment_group'] = assigned_treatment
 
         # Update participant record in MongoDB
-        participants.update_one(
-            {"session_id": session_id},
-            {"$set": {
-                "treatment_group": assigned_treatment,
-                "emotion_regulation_type": emotion_regulation_type,
-                "suppression_score": supp_score,
-                "assignment_time": datetime.datetime.now(datetime.timezone.utc)
-            }}
-        )
+        try:
+            participants.update_one(
+                {"session_id": session_id},
+                {"$set": {
+                    "treatment_group": assigned_treatment,
+                    "emotion_regulation_type": emotion_regulation_type,
+                    "suppression_score": supp_score,
+                    "assignment_time": datetime.datetime.now(datetime.timezone.utc)
+                }}
+            )
+        except Exception:
+            quotas.release(assigned_treatment, emotion_regulation_type)
+            raise
+        if previous_cell:
+            quotas.release(*previous_cell)
 
         # Remove client_param from data to save (it's not survey data)
         data.pop('client_param', None)
@@ -450,11 +521,11 @@ def getReply(session_id):
 
         client_id = str(uuid4())
         current_client = session[session_id]['current_client']
-        session[session_id][client_id] = {"current_client": current_client, "domain": val_domain, "category": val_category, "civil": val_civil, "chat_history": []}
-        session[session_id][client_id]["chat_history"] = messages_to_dict([AIMessage(content="Client: "+response)])
-        
+        conversation = conversations.create(client_id, session_id,
+                                            {"current_client": current_client, "domain": val_domain, "category": val_category, "civil": val_civil},
+                                            [("ai", "Client: "+response)])
 
-        turn_number = len(session[session_id][client_id]["chat_history"])
+        turn_number = len(conversation)
         timestamp = datetime.datetime.now(datetime.timezone.utc)
 
         chat_client_info.insert_one({
@@ -489,8 +560,10 @@ def getReply(session_id):
         show_info = request.json.get("show_info")
         show_emo = request.json.get("show_emo")
 
-        retrieve_from_session = json.loads(json.dumps(session[session_id][client_id]["chat_history"]))
-        chat_history = messages_from_dict(retrieve_from_session)
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"message": "Unknown client"}), 400
+        chat_history = conversation.chat_history()
 
         # Try to use Azure OpenAI, fall back to mock if connection fails
         try:
@@ -509,7 +582,8 @@ def getReply(session_id):
                 result = random.choice(endings)
                 response = result
             else:
-                result = sender_agent.invoke({"input": prompt, "chat_history": chat_history, "civil": session[session_id][client_id]["civil"]})
+                result = sender_agent.invoke({"input": prompt, "chat_history": chat_history, "civil": conversation.settings["civil"],
+                                               "client_id": client_id, "turn": conversation.turn_number})
                 response = result
                 # Post-process: Extract only the first response (stop at "Representative:" if model over-generates)
                 if "Representative:" in response:
@@ -548,33 +622,36 @@ def getReply(session_id):
                 ]
                 response = mock_responses[turn_count % len(mock_responses)]
 
-        chat_history.extend([HumanMessage(content="Representative: "+prompt), AIMessage(content="Client: "+response)])
-        session[session_id][client_id]["chat_history"] = messages_to_dict(chat_history)
+        conversations.append(conversation, [("human", "Representative: "+prompt), ("ai", "Client: "+response)])
 
-        turn_number = len(chat_history) // 2 + 1
+        turn_number = conversation.turn_number
         timestamp = datetime.datetime.now(datetime.timezone.utc)
 
-        # Insert representative response
-        chat_history_collection.insert_one({
-            "session_id": session_id,
-            "client_id": client_id,
-            "turn_number": turn_number - 1,
-            "sender": "representative",
-            "receiver": "client",
-            "message": prompt.strip(),
-            "timestamp": timestamp
-        })
+        # Insert representative response and the client reply to it in one write
+        chat_history_collection.insert_many([
+            {
+                "session_id": session_id,
+                "client_id": client_id,
+                "turn_number": turn_number - 1,
+                "sender": "representative",
+                "receiver": "client",
+                "message": prompt.strip(),
+                "timestamp": timestamp
+            },
+            {
+                "session_id": session_id,
+                "client_id": client_id,
+                "turn_number": turn_number,
+                "sender": "client",
+                "receiver": "representative",
+                "message": response.strip(),
+                "timestamp": timestamp
+            }
+        ])
 
-        # Insert client reply to the response
-        chat_history_collection.insert_one({
-            "session_id": session_id,
-            "client_id": client_id,
-            "turn_number": turn_number,
-            "sender": "client",
-            "receiver": "representative",
-            "message": response.strip(),
-            "timestamp": timestamp
-        })
+    if SPECULATIVE_SUPPORT and "FINISH:999" not in response:
+        # Support runs while the reply goes back; the page's support request then collects it
+        speculate_support(conversation, response, show_info, show_emo)
 
     return jsonify({
         "client": client_id,
@@ -687,7 +764,10 @@ def storeTroubleFeedback(session_id):
         rating = int(request.json.get("rate")) * -1
         support_type = request.json.get ("type")
 
-        turn_number = len(session[session_id][client_id]["chat_history"])//2+1
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"message": "Unknown client"}), 400
+        turn_number = conversation.turn_number
         timestamp = datetime.datetime.now(datetime.timezone.utc)
     
         query = {
@@ -702,9 +782,8 @@ def storeTroubleFeedback(session_id):
                 "timestamp_feedback": timestamp,
             }
         }
-        res = chat_in_task.update_one(query, update)
-        if res.matched_count == 0:
-            return jsonify({"message": "No existing record found to update"}), 404
+        # Upsert so feedback on a support record that was never stored is not lost
+        chat_in_task.update_one(query, update, upsert=True)
         return jsonify({"message": "Trouble feedback received"}), 200
     return jsonify({"message": "Invalid session or session expired"}), 400
 
@@ -715,7 +794,10 @@ def storeSentimentFeedback(session_id):
         rating = int(request.json.get("rate")) * -1
         support_type = request.json.get ("type")
 
-        turn_number = len(session[session_id][client_id]["chat_history"])//2+1
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"message": "Unknown client"}), 400
+        turn_number = conversation.turn_number
         timestamp = datetime.datetime.now(datetime.timezone.utc)
 
         query = {
@@ -730,9 +812,8 @@ def storeSentimentFeedback(session_id):
                 "timestamp_feedback": timestamp,
             }
         }
-        res = chat_in_task.update_one(query, update)
-        if res.matched_count == 0:
-            return jsonify({"message": "No existing record found to update"}), 404
+        # Upsert so feedback on a support record that was never stored is not lost
+        chat_in_task.update_one(query, update, upsert=True)
         return jsonify({"message": "Sentiment feedback received"}), 200
     return jsonify({"message": "Invalid session or session expired"}), 400
 
@@ -743,7 +824,10 @@ def storeEmoFeedback(session_id):
         rating = int(request.json.get("rate")) * -1    # helpful-unhelpful scale is reversed
         support_type = request.json.get("type")
 
-        turn_number = len(session[session_id][client_id]["chat_history"]) // 2 + 1
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"message": "Unknown client"}), 400
+        turn_number = conversation.turn_number
         timestamp = datetime.datetime.now(datetime.timezone.utc)
 
         query = {
@@ -758,14 +842,218 @@ def storeEmoFeedback(session_id):
                 "timestamp_feedback": timestamp,
             }
         }
-
-        res = chat_in_task.update_one(query, update)
-        if res.matched_count == 0:
-            return jsonify({"message": "No existing record found to update"}), 404
+        # Upsert so feedback on a support record that was never stored is not lost
+        chat_in_task.update_one(query, update, upsert=True)
         return jsonify({"message": "Feedback received"}), 200
     return jsonify({"message": "Invalid session or session expired"}), 400
 
 
+# Coworker support: each agent computes its support for the client's latest reply and records it
+# in chat_in_task. Used by the per-agent endpoints below and by /copilot/, which runs them together.
+
+# The model/analysis call of each agent, separate from recording so getReply can start it early.
+# The turn and chat history are passed in as of when the call was requested, not read when it runs.
+SUPPORT_CALLS = {
+    "info": lambda conversation, reply, turn, chat_history: info_agent.invoke({'domain': conversation.settings["domain"], 'message': reply, 'sender': 'client',
+                                                                               "chat_history": chat_history,
+                                                                               'client_id': conversation.client_id, 'turn': turn}),
+    "trouble": lambda conversation, reply, turn, chat_history: trouble_agent.invoke({'domain': conversation.settings["domain"], 'message': reply, 'sender': 'client',
+                                                                                     "chat_history": chat_history,
+                                                                                     'client_id': conversation.client_id, 'turn': turn}),
+    # "sentiment": lambda conversation, reply, turn, chat_history: analyze_sentiment_transformer(reply),
+    "sentiment": lambda conversation, reply, turn, chat_history: analyze_sentiment_decision(reply),
+    "reframe": lambda conversation, reply, turn, chat_history: emo_agent.invoke({'complaint': reply, "chat_history": chat_history}),
+    "shoes": lambda conversation, reply, turn, chat_history: ep_agent.invoke({'complaint': reply, "chat_history": chat_history}),
+}
+
+# SPECULATIVE_SUPPORT=0 turns off starting support in getReply; unused results are dropped after SPECULATIVE_SUPPORT_TTL seconds
+SPECULATIVE_SUPPORT = os.getenv("SPECULATIVE_SUPPORT", "1") == "1"
+support_slots = SupportSlots(max_workers=int(os.getenv("SPECULATIVE_SUPPORT_WORKERS", "8")),
+                             ttl=float(os.getenv("SPECULATIVE_SUPPORT_TTL", "600")))
+
+
+def agent_result(agent, conversation, reply):
+    """The agent's output for this turn's reply: taken from the slot getReply started, or computed now"""
+    turn = conversation.turn_number
+    return support_slots.run((conversation.client_id, turn, agent, reply),
+                             SUPPORT_CALLS[agent], conversation, reply, turn, conversation.chat_history())
+
+
+def speculate_support(conversation, reply, show_info, show_emo):
+    """Start the support the representative's page will request for this reply (see processClientResponse)"""
+    flags = {"show_info": show_info, "show_emo": show_emo}
+    # Captured now: the jobs may run after the next message has been appended
+    turn, chat_history = conversation.turn_number, conversation.chat_history()
+    for flag, agents in COPILOT_DEFAULTS.items():
+        if str(flags[flag]) != '1':
+            continue
+        for agent in agents:
+            if agent == "reframe" and turn == 1:
+                # The page asks for reframing from the second turn on
+                continue
+            support_slots.start((conversation.client_id, turn, agent, reply),
+                                SUPPORT_CALLS[agent], conversation, reply, turn, chat_history)
+
+
+def support_reframe(session_id, conversation, reply):
+    turn_number = conversation.turn_number
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    # Try to use Azure OpenAI, fall back to mock if connection fails
+    try:
+        response_cw_emo = agent_result("reframe", conversation, reply)
+        thought = response_cw_emo['thought']
+        reframe = response_cw_emo['reframe']
+    except Exception as e:
+        print(f"⚠️  Azure OpenAI failed, using mock emotional reframing: {str(e)[:100]}")
+        thought = "The client seems very frustrated and upset about their situation. They're expressing legitimate concerns and want to be heard."
+        reframe = "Try to acknowledge their feelings first: 'I understand how frustrating this must be for you.' Show empathy before moving to solutions."
+    # Thought and reframe, stored in one write
+    chat_in_task.insert_many([
+        {
+            "session_id": session_id,
+            "client_id": conversation.client_id,
+            "turn_number": turn_number,
+            "support_type": "TYPE_EMO_THOUGHT",
+            "support_content": thought.strip(),
+            "timestamp_arrival":timestamp
+        },
+        {
+            "session_id": session_id,
+            "client_id": conversation.client_id,
+            "turn_number": turn_number,
+            "support_type": "TYPE_EMO_REFRAME",
+            "support_content": reframe.strip(),
+            "timestamp_arrival": timestamp
+        }
+    ])
+    return {
+        'thought':thought,
+        'reframe': reframe
+    }
+
+
+def support_shoes(session_id, conversation, reply):
+    turn_number = conversation.turn_number
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    # Try to use Azure OpenAI, fall back to mock if connection fails
+    try:
+        response = agent_result("shoes", conversation, reply)
+    except Exception as e:
+        print(f"⚠️  Azure OpenAI failed, using mock empathy perspective: {str(e)[:100]}")
+        response = "Imagine being in their position - they've likely had to spend time and energy dealing with this issue, and now they feel let down. Try to validate their experience before offering solutions."
+    chat_in_task.insert_one({
+        "session_id": session_id,
+        "client_id": conversation.client_id,
+        "turn_number": turn_number,
+        "support_type": "Put Yourself in the Client's Shoes",
+        "support_content": response.strip(),
+        "timestamp_arrival": timestamp
+    })
+    return response
+
+
+def support_sentiment(session_id, conversation, reply):
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    turn_number = conversation.turn_number
+
+    # Perform sentiment analysis
+    sentiment_category = agent_result("sentiment", conversation, reply)
+
+    chat_in_task.insert_one({
+        "session_id": session_id,
+        "client_id": conversation.client_id,
+        "turn_number": turn_number,
+        "support_type": "TYPE_SENTIMENT",
+        "support_content": sentiment_category,
+        "timestamp_arrival": timestamp
+    })
+    return sentiment_category
+
+
+def support_info(session_id, conversation, reply):
+    # Try to use Azure OpenAI, fall back to mock if connection fails
+    try:
+        response_cw_info = agent_result("info", conversation, reply)
+    except Exception as e:
+        # Generic helpful suggestions based on domain - MUST BE AN ARRAY
+        print(f"⚠️  Azure OpenAI failed, using mock informational support: {str(e)[:100]}")
+        domain = conversation.settings["domain"]
+        if domain == "hotel":
+            response_cw_info = [
+                "Apologize for the inconvenience",
+                "Offer to check the reservation system immediately",
+                "Suggest alternative solutions (different room, refund, compensation)"
+            ]
+        elif domain == "airlines":
+            response_cw_info = [
+                "Express understanding of the urgency",
+                "Check booking system for the confirmation",
+                "Explore rebooking options on next available flight"
+            ]
+        else:
+            response_cw_info = [
+                "Acknowledge the issue",
+                "Gather necessary details",
+                "Explain steps to resolve"
+            ]
+
+    turn_number = conversation.turn_number
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    chat_in_task.insert_one({
+        "session_id": session_id,
+        "client_id": conversation.client_id,
+        "turn_number": turn_number,
+        "support_type": "TYPE_INFO_CUE",
+        "support_content": response_cw_info,
+        "timestamp_arrival": timestamp
+    })
+    return response_cw_info
+
+
+def support_trouble(session_id, conversation, reply):
+    # Try to use Azure OpenAI, fall back to mock if connection fails
+    try:
+        response = agent_result("trouble", conversation, reply)
+    except Exception as e:
+        # Mock troubleshooting guidance
+        print(f"⚠️  Azure OpenAI failed, using mock troubleshooting support: {str(e)[:100]}")
+        domain = conversation.settings["domain"]
+        if domain == "hotel":
+            response = ["Check reservation system for booking confirmation", "Verify payment processing status", "Review room availability for alternative options", "Prepare compensation offer per hotel policy"]
+        elif domain == "airlines":
+            response = ["Check flight booking system for confirmation number", "Review seat availability on alternative flights", "Check baggage tracking system if applicable", "Prepare rebooking options and compensation per airline policy"]
+        else:
+            response = ["Verify customer account and transaction history", "Check system logs for any processing errors", "Review company policy for this type of issue", "Prepare resolution options and next steps"]
+
+    turn_number = conversation.turn_number
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    chat_in_task.insert_one({
+        "session_id": session_id,
+        "client_id": conversation.client_id,
+        "turn_number": turn_number,
+        "support_type": "TYPE_INFO_GUIDE",
+        "support_content": response,
+        "timestamp_arrival": timestamp
+    })
+    return response
+
+
+SUPPORT_AGENTS = {
+    "info": support_info,
+    "trouble": support_trouble,
+    "sentiment": support_sentiment,
+    "reframe": support_reframe,
+    "shoes": support_shoes,
+}
+# Agents /copilot/ runs when the request does not list them, by the round's support flags
+COPILOT_DEFAULTS = {"show_info": ["info", "trouble"], "show_emo": ["sentiment", "reframe"]}
+# All copilot requests share this pool, so a burst of turns cannot start unbounded LLM calls
+COPILOT_WORKERS = int(os.getenv("COPILOT_WORKERS", "16"))
+copilot_executor = ThreadPoolExecutor(max_workers=COPILOT_WORKERS, thread_name_prefix="copilot")
+
+
 @app.route('/get-emo-support/<session_id>/', methods=['POST'])
 def getEmoSupport(session_id):
     if session_id in session:
@@ -773,64 +1061,17 @@ def getEmoSupport(session_id):
         reply = request.json.get("client_reply")
         support_type = request.json.get("type")
 
-        retrieve_from_session = json.loads(json.dumps(session[session_id][client_id]["chat_history"]))
-        chat_history = messages_from_dict(retrieve_from_session)
-
-        turn_number = len(chat_history) // 2 + 1
-        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"error": "Unknown client"}), 400
 
         if support_type=="TYPE_EMO_REFRAME":
-            # Try to use Azure OpenAI, fall back to mock if connection fails
-            try:
-                response_cw_emo = emo_agent.invoke({'complaint':reply, "chat_history": chat_history})
-                thought = response_cw_emo['thought']
-                reframe = response_cw_emo['reframe']
-            except Exception as e:
-                print(f"⚠️  Azure OpenAI failed, using mock emotional reframing: {str(e)[:100]}")
-                thought = "The client seems very frustrated and upset about their situation. They're expressing legitimate concerns and want to be heard."
-                reframe = "Try to acknowledge their feelings first: 'I understand how frustrating this must be for you.' Show empathy before moving to solutions."
-            # Thought
-            chat_in_task.insert_one({
-                "session_id": session_id,
-                "client_id": client_id,
-                "turn_number": turn_number,
-                "support_type": "TYPE_EMO_THOUGHT",
-                "support_content": thought.strip(),
-                "timestamp_arrival":timestamp
-            })
-            # Reframe
-            chat_in_task.insert_one({
-                "session_id": session_id,
-                "client_id": client_id,
-                "turn_number": turn_number,
-                "support_type": "TYPE_EMO_REFRAME",
-                "support_content": reframe.strip(),
-                "timestamp_arrival": timestamp
-            })
             return jsonify({
-                "message": {
-                    'thought':thought,
-                    'reframe': reframe
-                }
+                "message": support_reframe(session_id, conversation, reply)
             })
         elif support_type=="TYPE_EMO_SHOES":
-            # Try to use Azure OpenAI, fall back to mock if connection fails
-            try:
-                response_cw_emo = ep_agent.invoke({'complaint':reply, "chat_history": chat_history})
-                response = response_cw_emo
-            except Exception as e:
-                print(f"⚠️  Azure OpenAI failed, using mock empathy perspective: {str(e)[:100]}")
-                response = "Imagine being in their position - they've likely had to spend time and energy dealing with this issue, and now they feel let down. Try to validate their experience before offering solutions."
-            chat_in_task.insert_one({
-                "session_id": session_id,
-                "client_id": client_id,
-                "turn_number": turn_number,
-                "support_type": "Put Yourself in the Client's Shoes",
-                "support_content": response.strip(),
-                "timestamp_arrival": timestamp
-            })
             return jsonify({
-                "message": response
+                "message": support_shoes(session_id, conversation, reply)
             })
         else:
             return jsonify({"error": "Invalid support_type"}), 400
@@ -842,23 +1083,11 @@ def sentiment(session_id):
     if session_id in session:
         client_id = request.json.get("client_id")
         reply = request.json.get("client_reply")
-        timestamp = datetime.datetime.now(datetime.timezone.utc)
-        turn_number = len(session[session_id][client_id]["chat_history"]) // 2 + 1
-
-        # Perform sentiment analysis
-        # sentiment_category = analyze_sentiment_transformer(reply)
-        sentiment_category = analyze_sentiment_decision(reply)
-
-        chat_in_task.insert_one({
-            "session_id": session_id,
-            "client_id": client_id,
-            "turn_number": turn_number,
-            "support_type": "TYPE_SENTIMENT",
-            "support_content": sentiment_category,
-            "timestamp_arrival": timestamp
-        })
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"error": "Unknown client"}), 400
 
-        return jsonify({'message': sentiment_category})
+        return jsonify({'message': support_sentiment(session_id, conversation, reply)})
     else:
         return jsonify({"error": "Invalid session_id"}), 400
 
@@ -869,50 +1098,13 @@ def getInfoSupport(session_id):
     if session_id in session:
         client_id = request.json.get("client_id")
         reply = request.json.get("client_reply")
-        # support_type = request.json.get("type")
 
-        retrieve_from_session = json.loads(json.dumps(session[session_id][client_id]["chat_history"]))
-        chat_history = messages_from_dict(retrieve_from_session)
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"message": "Unknown client"}), 400
 
-        # Try to use Azure OpenAI, fall back to mock if connection fails
-        try:
-            response_cw_info = info_agent.invoke({'domain': session[session_id][client_id]["domain"],'message':reply, 'sender':'client', "chat_history": chat_history})
-        except Exception as e:
-            # Generic helpful suggestions based on domain - MUST BE AN ARRAY
-            print(f"⚠️  Azure OpenAI failed, using mock informational support: {str(e)[:100]}")
-            domain = session[session_id][client_id]["domain"]
-            if domain == "hotel":
-                response_cw_info = [
-                    "Apologize for the inconvenience",
-                    "Offer to check the reservation system immediately",
-                    "Suggest alternative solutions (different room, refund, compensation)"
-                ]
-            elif domain == "airlines":
-                response_cw_info = [
-                    "Express understanding of the urgency",
-                    "Check booking system for the confirmation",
-                    "Explore rebooking options on next available flight"
-                ]
-            else:
-                response_cw_info = [
-                    "Acknowledge the issue",
-                    "Gather necessary details",
-                    "Explain steps to resolve"
-                ]
-
-        turn_number = len(chat_history) // 2 + 1
-        timestamp = datetime.datetime.now(datetime.timezone.utc)
-
-        chat_in_task.insert_one({
-            "session_id": session_id,
-            "client_id": client_id,
-            "turn_number": turn_number,
-            "support_type": "TYPE_INFO_CUE",
-            "support_content": response_cw_info,
-            "timestamp_arrival": timestamp
-        })
         return jsonify({
-            "message": response_cw_info
+            "message": support_info(session_id, conversation, reply)
         })
     return jsonify({"message": "Invalid session or session expired"}), 400
 
@@ -922,43 +1114,66 @@ def getTroubleSupport(session_id):
     if session_id in session:
         client_id = request.json.get("client_id")
         reply = request.json.get("client_reply")
-        # support_type = request.json.get("type")
-
-        retrieve_from_session = json.loads(json.dumps(session[session_id][client_id]["chat_history"]))
-        chat_history = messages_from_dict(retrieve_from_session)
-
-        # Try to use Azure OpenAI, fall back to mock if connection fails
-        try:
-            response_cw_trouble = trouble_agent.invoke({'domain': session[session_id][client_id]["domain"],'message':reply, 'sender':'client', "chat_history": chat_history})
-            response = response_cw_trouble
-        except Exception as e:
-            # Mock troubleshooting guidance
-            print(f"⚠️  Azure OpenAI failed, using mock troubleshooting support: {str(e)[:100]}")
-            domain = session[session_id][client_id]["domain"]
-            if domain == "hotel":
-                response = ["Check reservation system for booking confirmation", "Verify payment processing status", "Review room availability for alternative options", "Prepare compensation offer per hotel policy"]
-            elif domain == "airlines":
-                response = ["Check flight booking system for confirmation number", "Review seat availability on alternative flights", "Check baggage tracking system if applicable", "Prepare rebooking options and compensation per airline policy"]
-            else:
-                response = ["Verify customer account and transaction history", "Check system logs for any processing errors", "Review company policy for this type of issue", "Prepare resolution options and next steps"]
-
-        turn_number = len(chat_history) // 2 + 1
-        timestamp = datetime.datetime.now(datetime.timezone.utc)
 
-        chat_in_task.insert_one({
-            "session_id": session_id,
-            "client_id": client_id,
-            "turn_number": turn_number,
-            "support_type": "TYPE_INFO_GUIDE",
-            "support_content": response,
-            "timestamp_arrival": timestamp
-        })
+        conversation = get_conversation(session_id, client_id)
+        if conversation is None:
+            return jsonify({"message": "Unknown client"}), 400
 
         return jsonify({
-            "message": response
+            "message": support_trouble(session_id, conversation, reply)
         })
     return jsonify({"message": "Invalid session or session expired"}), 400
 
+
+@app.route('/copilot/<session_id>/', methods=['POST'])
+def copilot(session_id):
+    """
+    All coworker support for one client reply in one request:
+    POST {client_id, client_reply, agents: ["info", "trouble", "sentiment", "reframe", "shoes"]}
+    (without agents, the show_info/show_emo flags of the request pick them). The agents run
+    concurrently; the response is NDJSON, one {"agent", "message"} (or {"agent", "error"}) line
+    per agent in the order they finish.
+    """
+    if session_id not in session:
+        return jsonify({"message": "Invalid session or session expired"}), 400
+    client_id = request.json.get("client_id")
+    reply = request.json.get("client_reply")
+    agents = request.json.get("agents")
+    if agents is None:
+        agents = [agent for flag, flag_agents in COPILOT_DEFAULTS.items()
+                  if str(request.json.get(flag)) == '1' for agent in flag_agents]
+    unknown = [agent for agent in agents if agent not in SUPPORT_AGENTS]
+    if unknown:
+        return jsonify({"message": f"Unknown agents {unknown}, expected some of {list(SUPPORT_AGENTS)}"}), 400
+
+    conversation = get_conversation(session_id, client_id)
+    if conversation is None:
+        return jsonify({"message": "Unknown client"}), 400
+    # Built once here; the agents share it
+    conversation.chat_history()
+
+    futures = {copilot_executor.submit(SUPPORT_AGENTS[agent], session_id, conversation, reply): agent
+               for agent in dict.fromkeys(agents)}
+
+    def results():
+        try:
+            for future in as_completed(futures):
+                agent = futures[future]
+                try:
+                    line = {"agent": agent, "message": future.result()}
+                except Exception as e:
+                    print(f"⚠️  Copilot agent {agent} failed: {str(e)[:100]}")
+                    line = {"agent": agent, "error": str(e)[:200]}
+                yield json.dumps(line, default=str) + "\n"
+        finally:
+            # Client went away: drop the agents that have not started
+            for future in futures:
+                future.cancel()
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route('/conversation_history/')
 def conversation_history():
     session_id = request.args.get('session_id')
@@ -1032,15 +1247,111 @@ def complete():
 
 @app.route('/history/<session_id>/<client_id>/')
 def getClientHistory(session_id, client_id):
-    chat_history = list(chat_history_collection.find({"session_id": session_id, "client_id": client_id}, {"_id": 0}))
+    # Optional pagination: /history/<session_id>/<client_id>/?skip=0&limit=20
+    query = {"session_id": session_id, "client_id": client_id}
+    source = chat_history_collection
+    if hasattr(source, 'archived') and not source.count_documents(query):
+        # Sessions completed long ago are only in the archive; others (e.g. not started yet) skip reading it
+        archive = source.archived()
+        if session_id in archive.values("session_id"):
+            source = archive
+    cursor = source.find(query, {"_id": 0})
+    cursor = cursor.skip(request.args.get('skip', 0, type=int)).limit(request.args.get('limit', 0, type=int))
+    chat_history = list(cursor)
     return jsonify({"chat_history": chat_history})
 
 @app.route('/history/<session_id>/')
 def getClientList(session_id):
-    clients_info = list(chat_client_info.find({"session_id": session_id}, {"_id": 0, "client_name": 1, "client_id": 1, "category":1}))
+    projection = {"_id": 0, "client_name": 1, "client_id": 1, "category":1}
+    clients_info = list(chat_client_info.find({"session_id": session_id}, projection))
+    if not clients_info and hasattr(chat_client_info, 'archived'):
+        archive = chat_client_info.archived()
+        if session_id in archive.values("session_id"):
+            clients_info = list(archive.find({"session_id": session_id}, projection))
     return jsonify({"clients_info": clients_info})
 
+# Collections researchers can follow live through /admin/watch/
+WATCHABLE_COLLECTIONS = {
+    "chat_history": chat_history_collection,
+    "chat_in_task": chat_in_task,
+    "participants": participants,
+}
+
+@app.route('/admin/watch/<collection_name>/')
+def watchCollection(collection_name):
+    """
+    Server-sent events stream of the inserts/updates/deletes of a collection, for live dashboards:
+    /admin/watch/chat_history/?pwd=<ADMIN_PWD>[&session_id=...]
+    Each event's id is a resume token, so EventSource reconnects continue where they left off.
+    """
+    if request.args.get('pwd') != common.ADMIN_PWD:
+        return "Unauthorized", 401
+    collection = WATCHABLE_COLLECTIONS.get(collection_name)
+    if collection is None:
+        return jsonify({"message": f"Unknown collection, expected one of {list(WATCHABLE_COLLECTIONS)}"}), 404
+    if not hasattr(collection, 'watch'):
+        return jsonify({"message": "Change streams need the JSON backend with unpartitioned collections"}), 501
+
+    query = {"session_id": request.args['session_id']} if request.args.get('session_id') else None
+    resume_after = request.headers.get('Last-Event-ID') or request.args.get('resume_after')
+    try:
+        stream = collection.watch(query, resume_after=resume_after, max_await_time=15)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 410
 
+    def events():
+        with stream:
+            while True:
+                try:
+                    change = stream.try_next()
+                except ValueError as e:
+                    # The stream fell too far behind: the client has to reread the collection
+                    yield f"event: invalidate\ndata: {json.dumps({'message': str(e)})}\n\n"
+                    return
+                if change is None:
+                    # Keep proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {change['_id']}\nevent: {change['operationType']}\ndata: {json.dumps(change, default=str)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/admin/db-stats/')
+def dbStats():
+    """
+    The slow-query log and the LLM response cache's hits/misses per agent, plus (JSON backend)
+    per-collection query/write counters (JSON_DB_SLOW_MS=<ms> turns profiling on):
+    /admin/db-stats/?pwd=<ADMIN_PWD>
+    Add &collection=<name>&query=<json filter> to explain how that query runs.
+    """
+    if request.args.get('pwd') != common.ADMIN_PWD:
+        return "Unauthorized", 401
+
+    stats = {"slow_queries": slow_queries(), "llm_cache": llm_cache.stats()}
+    # Not hasattr(db, 'stats'): an SQLite database would create a collection by that name
+    if DB_BACKEND != "sqlite":
+        stats["collections"] = db.stats()
+        stats["cache"] = cache_info()
+        collection_names = list(stats["collections"])
+    else:
+        collection_names = db.list_collection_names()
+    if request.args.get('collection'):
+        if request.args['collection'] not in collection_names:
+            return jsonify({"message": f"Unknown collection, expected one of {collection_names}"}), 404
+        try:
+            query = json.loads(request.args.get('query') or "{}")
+        except ValueError:
+            return jsonify({"message": "query must be a JSON object"}), 400
+        if not isinstance(query, dict):
+            return jsonify({"message": "query must be a JSON object"}), 400
+        try:
+            stats["explain"] = getattr(db, request.args['collection']).find(query).explain()
+        except ValueError as e:
+            # e.g. an unknown query operator
+            return jsonify({"message": f"Invalid query: {e}"}), 400
+    return app.response_class(json.dumps(stats, default=str), mimetype='application/json')
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, threaded=True)
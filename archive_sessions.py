@@ -0,0 +1,71 @@
+"""
+Move the documents of study sessions completed more than --days days ago (participants.completion_time)
+out of the live json_db collections into compressed, read-only archive segments.
+
+    python archive_sessions.py --days 30
+    python archive_sessions.py --days 30 --dry-run
+    python archive_sessions.py --show <session_id>
+
+Archived documents stay queryable: collection.archived().find({"session_id": ...}), and the
+/history/ endpoints fall back to the archive. The collections are locked while they are archived,
+so the app may keep running (except with JSON_DB_WRITE_BEHIND=1 and 'json' storage, whose
+in-memory view is authoritative: stop the app first).
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+from json_db import JSONClient, archive_completed_sessions, expired_sessions
+
+SESSION_COLLECTIONS = ["chat_history", "chat_client_info", "chat_in_task"]
+
+
+def open_collections(db, db_dir, names):
+    """Collections by name, opening partitioned collections (directories with a manifest) as such"""
+    collections = {}
+    for name in names:
+        manifest = Path(db_dir) / name / "manifest.json"
+        if manifest.exists():
+            collections[name] = db.partitioned(name, json.loads(manifest.read_text())["partition_key"])
+        else:
+            collections[name] = getattr(db, name)
+    return collections
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive the documents of completed study sessions")
+    parser.add_argument("collections", nargs="*", default=SESSION_COLLECTIONS,
+                        help=f"collection names (default: {' '.join(SESSION_COLLECTIONS)})")
+    parser.add_argument("--db-dir", default="data")
+    parser.add_argument("--days", type=float, default=30, help="archive sessions completed more than this many days ago")
+    parser.add_argument("--storage", default=os.getenv("JSON_DB_STORAGE", "json"))
+    parser.add_argument("--codec", default=os.getenv("JSON_DB_CODEC", "json"))
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents that would be archived")
+    parser.add_argument("--show", metavar="SESSION_ID", help="print the archived document counts of one session")
+    args = parser.parse_args()
+
+    db = JSONClient(db_dir=args.db_dir, storage=args.storage, codec=args.codec).flask_db
+    collections = open_collections(db, args.db_dir, args.collections)
+
+    if args.show:
+        for name, collection in collections.items():
+            print(f"{name}: {collection.archived().count_documents({'session_id': args.show})} archived documents")
+        return
+
+    if args.dry_run:
+        expired = expired_sessions(db.participants, args.days)
+        print(f"{len(expired)} sessions completed more than {args.days:g} days ago")
+        for name, collection in collections.items():
+            count = collection.count_documents({"session_id": {"$in": expired}}) if expired else 0
+            print(f"{name}: {count} documents would be archived")
+        return
+
+    moved = archive_completed_sessions(db.participants, collections, args.days)
+    for name, count in moved.items():
+        print(f"{name}: {count} documents archived")
+    db.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Benchmark json_db with the write patterns of the study app.
+
+    python bench_json_db.py                                   # 1k/10k/100k docs x 1/4/16 threads, json + jsonl
+    python bench_json_db.py --scales 1000 --threads 4 --storage jsonl --codec orjson --output after.json
+    python bench_json_db.py --compare before.json after.json
+
+Every run preloads a fresh database with `scale` documents spread like real data over
+chat_history, chat_in_task, chat_client_info and participants (with the indexes app.py creates),
+then worker threads replay simulated participants: the pre-survey quota check, and per turn the
+writes of getReply, getEmoSupport, sentiment and a store-*-feedback route plus the occasional
+/history/ read. Each route is timed as a whole.
+
+Results are written as JSON (stdout or --output): one entry per storage x scale x threads with
+p50/p99 latency per route and overall (ms), throughput (routes/s) and on-disk size (bytes).
+--compare prints the throughput and p99 changes between two result files.
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from json_db import JSONClient
+from quota import QuotaCounters
+
+TREATMENTS = ["control", "information", "emotion", "both"]
+EMOTION_REGULATION_TYPES = ["Suppressor", "NonSuppressor"]
+# Turns per simulated session, as in the study (clients x rounds)
+TURNS_PER_SESSION = 10
+CLIENTS_PER_SESSION = 3
+MESSAGE = "I have been waiting for my refund for three weeks and nobody answers my emails. " * 3
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def disk_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def open_database(db_dir, storage, codec, write_behind):
+    db = JSONClient(db_dir=str(db_dir), storage=storage, codec=codec, write_behind=write_behind).flask_db
+    # As in app.py: treatment assignment never goes through write-behind
+    db.get_collection("quota_counters", write_behind=False)
+    db.get_collection("participants", write_behind=False)
+    db.chat_history.create_index([("session_id", 1), ("client_id", 1)])
+    db.chat_client_info.create_index("session_id")
+    db.chat_in_task.create_index([("session_id", 1), ("client_id", 1), ("turn_number", 1), ("support_type", 1)])
+    db.participants.create_index("session_id")
+    db.participants.create_index([("treatment_group", 1), ("emotion_regulation_type", 1)])
+    return db
+
+
+def quota_counters(db):
+    """The app's quota counters, with a quota no benchmark run can fill"""
+    return QuotaCounters(db.quota_counters, db.participants, TREATMENTS, EMOTION_REGULATION_TYPES,
+                         quota_per_cell=10 ** 9)
+
+
+def preload(db, scale, rng):
+    """Insert `scale` documents shaped like the app's, split over the collections as a finished study would be"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Per session: 1 participant, 3 client infos, 2 messages and ~3 support/feedback records per turn
+    per_session = 1 + CLIENTS_PER_SESSION + TURNS_PER_SESSION * 5
+    sessions = [f"pre-{i}" for i in range(max(1, scale // per_session))]
+    participants, client_info, history, in_task = [], [], [], []
+    for session_id in sessions:
+        participants.append({"session_id": session_id, "treatment_group": rng.choice(TREATMENTS),
+                             "emotion_regulation_type": rng.choice(EMOTION_REGULATION_TYPES),
+                             "study_completed": True, "completion_time": now})
+        for client in range(CLIENTS_PER_SESSION):
+            client_info.append({"session_id": session_id, "client_id": str(client), "client_name": "Client",
+                                "category": "Billing", "domain": "Airline", "timestamp": now})
+        for turn in range(TURNS_PER_SESSION):
+            client_id = str(turn % CLIENTS_PER_SESSION)
+            history.append({"session_id": session_id, "client_id": client_id, "turn_number": turn,
+                            "sender": "representative", "receiver": "client", "message": MESSAGE, "timestamp": now})
+            history.append({"session_id": session_id, "client_id": client_id, "turn_number": turn,
+                            "sender": "client", "receiver": "representative", "message": MESSAGE, "timestamp": now})
+            for support_type in ("Emo", "Sentiment", "Trouble"):
+                in_task.append({"session_id": session_id, "client_id": client_id, "turn_number": turn,
+                                "support_type": support_type, "support_content": MESSAGE, "timestamp": now})
+    collections = [(db.participants, participants), (db.chat_client_info, client_info),
+                   (db.chat_history, history), (db.chat_in_task, in_task)]
+    remaining = scale
+    for collection, documents in collections:
+        documents = documents[:remaining]
+        remaining -= len(documents)
+        if documents:
+            collection.insert_many(documents)
+    db.flush()
+
+
+class Workload:
+    """Simulated participants; every public method is one app route and returns nothing"""
+
+    def __init__(self, db, rng):
+        self.db = db
+        self.rng = rng
+        self.quotas = quota_counters(db)
+
+    def pre_survey(self, session_id):
+        """storePreSurvey: read the participant, reserve a quota slot and store the assignment"""
+        participants = self.db.participants
+        participants.find_one({"session_id": session_id}, {"treatment_group": 1, "emotion_regulation_type": 1})
+        regulation_type = self.rng.choice(EMOTION_REGULATION_TYPES)
+        treatment = self.quotas.reserve(regulation_type)
+        participants.update_one({"session_id": session_id},
+                                {"$set": {"treatment_group": treatment, "emotion_regulation_type": regulation_type,
+                                          "timestamp": datetime.datetime.now(datetime.timezone.utc)}},
+                                upsert=True)
+
+    def get_reply(self, session_id, client_id, turn):
+        """getReply: client info on a client's first turn, then the representative/client message pair"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if turn < CLIENTS_PER_SESSION:
+            self.db.chat_client_info.insert_one({"session_id": session_id, "client_id": client_id,
+                                                 "client_name": "Client", "category": "Billing",
+                                                 "domain": "Airline", "timestamp": now})
+        self.db.chat_history.insert_many([
+            {"session_id": session_id, "client_id": client_id, "turn_number": turn, "sender": "representative",
+             "receiver": "client", "message": MESSAGE, "timestamp": now},
+            {"session_id": session_id, "client_id": client_id, "turn_number": turn, "sender": "client",
+             "receiver": "representative", "message": MESSAGE, "timestamp": now},
+        ])
+
+    def get_emo_support(self, session_id, client_id, turn):
+        """getEmoSupport: the emotion and reframe support records of a turn"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.db.chat_in_task.insert_many([
+            {"session_id": session_id, "client_id": client_id, "turn_number": turn, "support_type": "Emo",
+             "support_content": MESSAGE, "timestamp": now},
+            {"session_id": session_id, "client_id": client_id, "turn_number": turn, "support_type": "Reframe",
+             "support_content": MESSAGE, "timestamp": now},
+        ])
+
+    def sentiment(self, session_id, client_id, turn):
+        """sentiment: one support record"""
+        self.db.chat_in_task.insert_one({"session_id": session_id, "client_id": client_id, "turn_number": turn,
+                                         "support_type": "Sentiment", "support_content": "negative",
+                                         "timestamp": datetime.datetime.now(datetime.timezone.utc)})
+
+    def feedback(self, session_id, client_id, turn):
+        """store-*-feedback: upsert the rating onto the turn's support record"""
+        support_type = self.rng.choice(["Emo", "Sentiment", "Trouble"])
+        self.db.chat_in_task.update_one({"session_id": session_id, "client_id": client_id,
+                                         "turn_number": turn, "support_type": support_type},
+                                        {"$set": {"feedback": self.rng.randint(1, 5)}}, upsert=True)
+
+    def history(self, session_id, client_id):
+        """getClientHistory: read one client's conversation"""
+        list(self.db.chat_history.find({"session_id": session_id, "client_id": client_id}, {"_id": 0}))
+
+    def session(self, session_id):
+        """One participant's routes, in study order, as (route name, callable) pairs"""
+        yield "pre_survey", functools.partial(self.pre_survey, session_id)
+        for turn in range(TURNS_PER_SESSION):
+            client_id = str(turn % CLIENTS_PER_SESSION)
+            yield "get_reply", functools.partial(self.get_reply, session_id, client_id, turn)
+            yield "get_emo_support", functools.partial(self.get_emo_support, session_id, client_id, turn)
+            yield "sentiment", functools.partial(self.sentiment, session_id, client_id, turn)
+            yield "feedback", functools.partial(self.feedback, session_id, client_id, turn)
+            if turn % 3 == 2:
+                yield "history", functools.partial(self.history, session_id, client_id)
+
+
+def run(storage, codec, write_behind, scale, threads, routes, max_seconds, seed):
+    """Preload, replay `routes` routes on `threads` threads (or until max_seconds) and measure"""
+    db_dir = Path(tempfile.mkdtemp(prefix="bench_json_db_"))
+    db = open_database(db_dir, storage, codec, write_behind)
+    try:
+        rng = random.Random(seed)
+        started = time.perf_counter()
+        preload(db, scale, rng)
+        preload_seconds = time.perf_counter() - started
+        # Like the app at startup: without counters every reservation misses and nobody is assigned
+        quota_counters(db).seed()
+
+        latencies = {}
+        budget = iter(range(routes))
+        budget_lock = threading.Lock()
+        deadline = time.perf_counter() + max_seconds
+        errors = []
+
+        def worker(number):
+            workload = Workload(db, random.Random(seed + number))
+            local = {}
+            try:
+                session_number = 0
+                while True:
+                    for route, call in workload.session(f"bench-{number}-{session_number}"):
+                        with budget_lock:
+                            if next(budget, None) is None or time.perf_counter() > deadline:
+                                return
+                        began = time.perf_counter()
+                        call()
+                        local.setdefault(route, []).append(time.perf_counter() - began)
+                    session_number += 1
+            except Exception as e:
+                errors.append(repr(e))
+            finally:
+                with budget_lock:
+                    for route, samples in local.items():
+                        latencies.setdefault(route, []).extend(samples)
+
+        workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        db.flush()
+        elapsed = time.perf_counter() - started
+
+        samples = [sample for route_samples in latencies.values() for sample in route_samples]
+
+        def summary(values):
+            return {"count": len(values),
+                    "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+                    "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None}
+
+        return {
+            "storage": storage, "codec": codec, "write_behind": write_behind, "scale": scale, "threads": threads,
+            "routes": len(samples),
+            "seconds": round(elapsed, 3),
+            "throughput_per_s": round(len(samples) / elapsed, 1) if elapsed else None,
+            "preload_seconds": round(preload_seconds, 3),
+            "disk_bytes": disk_size(db_dir),
+            "latency": dict(summary(samples), by_route={route: summary(values)
+                                                        for route, values in sorted(latencies.items())}),
+            "errors": errors,
+        }
+    finally:
+        db.close()
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+def environment():
+    """What the numbers depend on, recorded next to them"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "time": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+
+def compare(before_path, after_path):
+    """Print throughput and overall p99 changes for the configurations present in both files"""
+    def key(result):
+        return (result["storage"], result["codec"], result["write_behind"], result["scale"], result["threads"])
+
+    before = {key(result): result for result in json.loads(Path(before_path).read_text())["results"]}
+    for result in json.loads(Path(after_path).read_text())["results"]:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        throughput = result["throughput_per_s"] / old["throughput_per_s"] - 1
+        p99 = result["latency"]["p99_ms"] / old["latency"]["p99_ms"] - 1
+        storage, codec, write_behind, scale, threads = key(result)
+        print(f"{storage:5} {codec:7} wb={int(write_behind)} scale={scale:>6} threads={threads:>2}  "
+              f"throughput {old['throughput_per_s']:>8} -> {result['throughput_per_s']:>8} ({throughput:+.0%})  "
+              f"p99 {old['latency']['p99_ms']:>8} -> {result['latency']['p99_ms']:>8} ms ({p99:+.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark json_db with the app's write patterns")
+    parser.add_argument("--scales", default="1000,10000,100000", help="preloaded documents per run")
+    parser.add_argument("--threads", default="1,4,16", help="concurrent worker threads per run")
+    parser.add_argument("--storage", default="json,jsonl", help="storage modes to run")
+    parser.add_argument("--codec", default=os.getenv("JSON_DB_CODEC", "json"))
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--routes", type=int, default=2000, help="routes replayed per run")
+    parser.add_argument("--max-seconds", type=float, default=60, help="stop a run after this long")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = []
+    for storage in args.storage.split(","):
+        for scale in map(int, args.scales.split(",")):
+            for threads in map(int, args.threads.split(",")):
+                result = run(storage, args.codec, args.write_behind, scale, threads, args.routes,
+                             args.max_seconds, args.seed)
+                print(f"{storage:5} scale={scale:>6} threads={threads:>2}: {result['throughput_per_s']} routes/s, "
+                      f"p50 {result['latency']['p50_ms']} ms, p99 {result['latency']['p99_ms']} ms, "
+                      f"{result['disk_bytes']} bytes", file=sys.stderr)
+                results.append(result)
+
+    output = json.dumps({"environment": environment(), "results": results}, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
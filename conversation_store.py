@@ -0,0 +1,168 @@
+"""
+Server-side conversation store
+Each simulated client's conversation (its settings and the message log) lives here, keyed by
+client_id, instead of in the Flask session. The session then only holds identifiers, so the
+filesystem session that is read and rewritten on every request stays the same size however long
+the conversations get.
+
+Conversations are cached in memory (LRU). With collections, they are also persisted append-only:
+one document per conversation in `conversations` and one per message in `turns`. A conversation
+missing from the cache (another worker process, a restart) is loaded from there, and a cached one
+picks up messages appended by other processes.
+"""
+import threading
+from collections import OrderedDict
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+# Message types, as in LangChain's messages_to_dict: the client is the AI, the representative the human
+MESSAGE_CLASSES = {"ai": AIMessage, "human": HumanMessage}
+
+
+class Message:
+    """One logged message; its LangChain object is built on first use and then reused"""
+    __slots__ = ('type', 'content', '_langchain')
+
+    def __init__(self, message_type, content):
+        self.type = message_type
+        self.content = content
+        self._langchain = None
+
+    def langchain(self):
+        if self._langchain is None:
+            self._langchain = MESSAGE_CLASSES[self.type](content=self.content)
+        return self._langchain
+
+
+class Conversation:
+    """
+    One client's settings and append-only message log.
+    chat_history() materializes the LangChain view incrementally: each message is converted once,
+    and every call between two appends (e.g. the support requests of one turn) gets the same list.
+    """
+    __slots__ = ('client_id', 'session_id', 'settings', 'messages', '_history', '_lock')
+
+    def __init__(self, client_id, session_id, settings, messages=()):
+        self.client_id = client_id
+        self.session_id = session_id
+        self.settings = dict(settings)
+        self.messages = [Message(message_type, content) for message_type, content in messages]
+        self._history = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def turn_number(self):
+        """Turn the next support/feedback record belongs to (one turn per representative/client exchange)"""
+        return len(self.messages) // 2 + 1
+
+    def extend(self, messages, persist=None, start=None):
+        """
+        Append (type, content) pairs; O(1) per message, the LangChain view is extended lazily.
+        persist(start, messages) runs first under the same lock, so concurrent appends get distinct
+        positions. With start (the position of the first message, e.g. when catching up), messages
+        the log already holds are skipped.
+        """
+        with self._lock:
+            if start is not None:
+                messages = messages[len(self.messages) - start:] if start <= len(self.messages) else []
+            if persist is not None:
+                persist(len(self.messages), messages)
+            self.messages.extend(Message(message_type, content) for message_type, content in messages)
+
+    def chat_history(self):
+        """
+        The messages as LangChain message objects, for the agents' chat_history.
+        The list is shared with other callers until the next append: do not modify it.
+        """
+        with self._lock:
+            if len(self._history) != len(self.messages):
+                # A new list, so histories handed out earlier keep their length
+                self._history = self._history + [message.langchain()
+                                                 for message in self.messages[len(self._history):]]
+            return self._history
+
+
+class ConversationStore:
+    """
+    Conversations by client_id, cached in memory and optionally persisted to two collections.
+    max_cached bounds the cache only when conversations are persisted.
+    """
+
+    def __init__(self, conversations=None, turns=None, max_cached=1024):
+        self.conversations = conversations
+        self.turns = turns
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if self.persisted:
+            self.conversations.create_index("client_id")
+            self.turns.create_index("client_id")
+
+    @property
+    def persisted(self):
+        return self.conversations is not None and self.turns is not None
+
+    def _remember(self, conversation):
+        with self._lock:
+            self._cache[conversation.client_id] = conversation
+            self._cache.move_to_end(conversation.client_id)
+            # Without collections the cache is the only copy: never evict
+            while self.persisted and len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def create(self, client_id, session_id, settings, messages=()):
+        """Start a conversation; messages are (type, content) pairs"""
+        conversation = Conversation(client_id, session_id, settings)
+        if self.persisted:
+            self.conversations.insert_one({"client_id": client_id, "session_id": session_id,
+                                           "settings": conversation.settings})
+        self._remember(conversation)
+        if messages:
+            self.append(conversation, messages)
+        return conversation
+
+    def get(self, client_id):
+        """The conversation of a client, or None if there is none"""
+        with self._lock:
+            conversation = self._cache.get(client_id)
+            if conversation is not None:
+                self._cache.move_to_end(client_id)
+        if not self.persisted:
+            return conversation
+
+        if conversation is None:
+            stored = self.conversations.find_one({"client_id": client_id})
+            if stored is None:
+                return None
+            conversation = Conversation(client_id, stored["session_id"], stored.get("settings", {}))
+            self._remember(conversation)
+        self._catch_up(conversation)
+        return conversation
+
+    def _catch_up(self, conversation):
+        """Load messages appended (by any process) after the ones the cached conversation holds"""
+        known = len(conversation.messages)
+        if self.turns.count_documents({"client_id": conversation.client_id}) == known:
+            return
+        cursor = self.turns.find({"client_id": conversation.client_id, "seq": {"$gte": known}},
+                                 {"_id": 0, "seq": 1, "type": 1, "content": 1}).sort("seq")
+        missing = []
+        for turn in cursor:
+            if turn["seq"] == known + len(missing):
+                missing.append((turn["type"], turn["content"]))
+        # Messages appended by this process since `known` was read are not added twice
+        conversation.extend(missing, start=known)
+
+    def append(self, conversation, messages):
+        """Append (type, content) messages to a conversation"""
+        messages = list(messages)
+        persist = None
+        if self.persisted:
+            def persist(start, messages):
+                self.turns.insert_many([{"client_id": conversation.client_id, "session_id": conversation.session_id,
+                                         "seq": start + offset, "type": message_type, "content": content}
+                                        for offset, (message_type, content) in enumerate(messages)])
+        conversation.extend(messages, persist)
@@ -16,6 +16,12 @@ sender_agent = mAgents.mAgentCustomer()
 # Load environment variables
 load_dotenv("project.env")
 
+# Re-runs answer the prompts they already sent from the cache instead of the model; each
+# generated example is its own cache variant so the examples of a pair stay different
+mAgents.llm_cache.enable("sender", "customer", "context", "representative")
+# data/cache/, not data/: json_db (and migrate_json_db.py) treat every data/*.jsonl as a collection
+mAgents.llm_cache.persist(os.path.join("data", "cache", "llm_cache_incidents.jsonl"))
+
 def agent_representative():
     support_agent_prompt = """
     You are a service representative chatting with a customer online.\
@@ -36,7 +42,7 @@ def agent_representative():
         context=mAgents.get_historical_context_chain()
     )
              | template
-             | mAgents.llminfo
+             | mAgents.llm_cache.cached(mAgents.llminfo, "representative")
              )
 
     chain = chain | StrOutputParser()
@@ -74,12 +80,13 @@ def generate_scenarios(domains, categories, examples_per_pair):
     iteration = 1
     for domain in domains:
         for category in categories:
-            for _ in range(examples_per_pair):
+            for example in range(examples_per_pair):
                 print(f"Generating scenario {iteration}")
                 iteration += 1          
                 
                 # Generate initial complaint
-                initial_complaint = generate_initial_complaint(domain, category)
+                with mAgents.llm_cache.variant(example):
+                    initial_complaint = generate_initial_complaint(domain, category)
                 chat_history = [AIMessage(content="Client: "+initial_complaint)]
 
 
@@ -128,4 +135,5 @@ file_path = "phase1_scenarios.tsv"
 df.to_csv(file_path, sep='\t', index=False, lineterminator='\n')
 
 print("Saved file to {}".format(file_path))
+print(f"LLM cache: {mAgents.llm_cache.stats()}")
 #%%
@@ -1,147 +1,2734 @@
 """
 Simple JSON file-based database replacement for MongoDB
 Stores data in JSON files instead of requiring MongoDB installation
+
+Two storage modes are supported per collection:
+- 'json':  the collection is a single JSON array that is rewritten on every write
+- 'jsonl': append-only log; inserts append one JSON line, updates/deletes append
+           patch/tombstone records and the in-memory view is rebuilt from the log on open;
+           compaction folds the log into a '<collection>.snapshot' file and keeps only its tail
+
+Files are encoded by a codec: 'json' (the historical indented format, datetimes become strings),
+'compact' (stdlib json without whitespace), 'orjson' or 'msgpack' ('json' storage only). All but
+'json' store datetimes as {"$date": iso} and read them back as datetimes, so range queries on
+timestamps work. Existing files can be converted with migrate_json_db.py.
+
+Documents of finished sessions can be moved out of the live files into gzip-compressed, read-only
+archive segments ('<collection>.archive/'), which stay queryable through archived(); see
+archive_completed_sessions and archive_sessions.py.
 """
+import atexit
+import bisect
+import contextlib
+import copy
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import operator
 import os
-from datetime import datetime
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process locking is unavailable, in-process locking still applies
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+STORAGE_MODES = ('json', 'jsonl')
+# 'always': fsync every write, 'batch': one fsync per write-behind batch, 'os': leave it to the OS
+FSYNC_POLICIES = ('always', 'batch', 'os')
+
+# Upper bound for the parsed collections kept in memory, measured in bytes of their files
+DEFAULT_CACHE_LIMIT = int(float(os.getenv("JSON_DB_CACHE_MB", "256")) * 1024 * 1024)
+# Serialization of collection files, see _CODECS
+CODECS = ('json', 'compact', 'orjson', 'msgpack')
+DEFAULT_CODEC = os.getenv("JSON_DB_CODEC", "json")
+# A 'jsonl' log is compacted in the background once it outgrows both this size and its snapshot
+DEFAULT_COMPACT_BYTES = int(float(os.getenv("JSON_DB_COMPACT_MB", "16")) * 1024 * 1024)
+# Number of recent changes kept per watched collection for change streams to resume from
+DEFAULT_CHANGE_BUFFER = 10000
+# Profiling: queries and writes slower than this many ms are logged (0 logs all); unset disables profiling
+DEFAULT_SLOW_MS = float(os.environ["JSON_DB_SLOW_MS"]) if os.getenv("JSON_DB_SLOW_MS") else None
+# Number of slow queries kept for slow_queries()
+SLOW_QUERY_LOG_SIZE = 200
+
+def _reset_id_source():
+    """Pick a fresh per-process nonce and counter (also run in forked workers)"""
+    global _ID_NONCE, _ID_COUNTER
+    _ID_NONCE = os.urandom(5).hex()
+    _ID_COUNTER = itertools.count(int.from_bytes(os.urandom(3), 'big'))
+
+
+_reset_id_source()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_id_source)
+
+
+def _new_id():
+    """Generate an ObjectId-like hex id (timestamp, per-process nonce, counter)"""
+    return f"{int(time.time()):08x}{_ID_NONCE}{next(_ID_COUNTER) & 0xFFFFFF:06x}"
+
+
+def _index_value(value):
+    """Return a hashable key for a field value (lists/dicts are keyed by their JSON form)"""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('$json', json.dumps(value, sort_keys=True, default=str))
+
+
+def _index_fields(keys):
+    """Normalize pymongo-style index keys ('a', ['a', 'b'] or [('a', 1), ('b', 1)]) to a tuple of fields"""
+    if isinstance(keys, str):
+        return (keys,)
+    return tuple(key[0] if isinstance(key, (list, tuple)) else key for key in keys)
+
+
+# ----------------------------------------------------------------------
+# Query compiler
+# ----------------------------------------------------------------------
+_MISSING = object()
+_LOGICAL_OPS = ('$and', '$or', '$nor')
+_RANGE_OPS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+
+
+def _get_field(doc, path):
+    """Resolve a (possibly dotted) field path, returning _MISSING if it is absent"""
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and all(str(k).startswith('$') for k in value)
+
+
+def _operator_shape(spec, params):
+    """Shape of an operator dict such as {"$gte": 1, "$lt": 5}; operands are appended to params"""
+    shape = []
+    for op, operand in spec.items():
+        if op == '$not':
+            shape.append((op, _operator_shape(operand, params)))
+        elif op == '$regex':
+            params.append(re.compile(operand, re.IGNORECASE if 'i' in spec.get('$options', '') else 0))
+            shape.append((op,))
+        elif op == '$options':
+            continue
+        else:
+            params.append(operand)
+            shape.append((op,))
+    return tuple(shape)
+
+
+def _query_shape(query, params):
+    """Split a filter into a hashable shape (fields and operators) and its literal operands"""
+    shape = []
+    for key, value in query.items():
+        if key in _LOGICAL_OPS:
+            shape.append((key, tuple(_query_shape(sub, params) for sub in value)))
+        elif _is_operator_dict(value):
+            shape.append((key, _operator_shape(value, params)))
+        else:
+            params.append(value)
+            shape.append((key, (('$eq',),)))
+    return tuple(shape)
+
+
+def _compile_operator(op, nested, slot):
+    """Build a test(value, params) for a single field operator"""
+    if op == '$eq':
+        return lambda value, p: (None if value is _MISSING else value) == p[slot]
+    if op == '$ne':
+        return lambda value, p: (None if value is _MISSING else value) != p[slot]
+    if op in _RANGE_OPS:
+        compare = _RANGE_OPS[op]
+
+        def test(value, p):
+            if value is _MISSING or value is None:
+                return False
+            try:
+                return compare(value, p[slot])
+            except TypeError:
+                return False
+        return test
+    if op == '$in':
+        return lambda value, p: (None if value is _MISSING else value) in p[slot]
+    if op == '$nin':
+        return lambda value, p: (None if value is _MISSING else value) not in p[slot]
+    if op == '$exists':
+        return lambda value, p: (value is not _MISSING) == bool(p[slot])
+    if op == '$regex':
+        return lambda value, p: isinstance(value, str) and p[slot].search(value) is not None
+    if op == '$not':
+        return lambda value, p: not nested(value, p)
+    raise ValueError(f"Unsupported query operator '{op}'")
+
+
+def _compile_operators(shape, slots):
+    tests = []
+    for op_shape in shape:
+        op = op_shape[0]
+        if op == '$not':
+            tests.append(_compile_operator(op, _compile_operators(op_shape[1], slots), None))
+        else:
+            tests.append(_compile_operator(op, None, next(slots)))
+    if len(tests) == 1:
+        return tests[0]
+    return lambda value, p: all(test(value, p) for test in tests)
+
+
+def _compile_clauses(shape, slots):
+    tests = []
+    for key, spec in shape:
+        if key in _LOGICAL_OPS:
+            branches = [_compile_clauses(sub, slots) for sub in spec]
+            if key == '$and':
+                tests.append(lambda doc, p, branches=branches: all(b(doc, p) for b in branches))
+            elif key == '$or':
+                tests.append(lambda doc, p, branches=branches: any(b(doc, p) for b in branches))
+            else:
+                tests.append(lambda doc, p, branches=branches: not any(b(doc, p) for b in branches))
+        else:
+            value_test = _compile_operators(spec, slots)
+            tests.append(lambda doc, p, key=key, value_test=value_test: value_test(_get_field(doc, key), p))
+    if not tests:
+        return lambda doc, p: True
+    if len(tests) == 1:
+        return tests[0]
+    return lambda doc, p: all(test(doc, p) for test in tests)
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_shape(shape):
+    """Compile a query shape once; the result takes (doc, params)"""
+    return _compile_clauses(shape, itertools.count())
+
+
+def compile_query(query):
+    """
+    Compile a Mongo-style filter into a predicate doc -> bool.
+    Supports $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists, $regex, $not, $and, $or, $nor
+    and dotted field paths. Compiled predicates are cached per query shape, so repeated
+    queries that only differ in their values are compiled once.
+    """
+    params = []
+    matcher = _compile_shape(_query_shape(query or {}, params))
+    return lambda doc: matcher(doc, params)
+
+
+def _pushdown_terms(query):
+    """Extract the top-level terms an index can serve: field -> candidate values, field -> range bounds"""
+    equality, ranges = {}, {}
+    for key, value in (query or {}).items():
+        if key in _LOGICAL_OPS:
+            continue
+        if not _is_operator_dict(value):
+            equality[key] = [value]
+        elif '$eq' in value:
+            equality[key] = [value['$eq']]
+        elif '$in' in value and isinstance(value['$in'], (list, tuple, set)):
+            equality[key] = list(value['$in'])
+        else:
+            bounds = {op: operand for op, operand in value.items() if op in _RANGE_OPS}
+            if bounds:
+                ranges[key] = bounds
+    return equality, ranges
+
+
+class _HashIndex:
+    """Secondary hash index mapping field values to the ids of the documents holding them"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        # Top-level fields whose updates can change this index's keys
+        self.roots = frozenset(field.split('.')[0] for field in fields)
+        self.buckets = {}
+        # Sorted distinct values of single-field indexes, built on demand for range queries
+        self._sorted_values = None
+
+    def key(self, doc):
+        values = (_get_field(doc, field) for field in self.fields)
+        return tuple(_index_value(None if value is _MISSING else value) for value in values)
+
+    def add(self, doc_id, doc):
+        key = self.key(doc)
+        if key not in self.buckets:
+            self.buckets[key] = {}
+            self._sorted_values = None
+        self.buckets[key][doc_id] = None
+
+    def remove(self, doc_id, doc):
+        key = self.key(doc)
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.pop(doc_id, None)
+            if not bucket:
+                del self.buckets[key]
+                self._sorted_values = None
+
+    def clear(self):
+        self.buckets = {}
+        self._sorted_values = None
+
+    def lookup(self, values):
+        return self.buckets.get(tuple(_index_value(value) for value in values), {})
+
+    def lookup_range(self, bounds):
+        """Ids with values inside the bounds ({"$gte": a, "$lt": b}), or None if values are not orderable"""
+        if self._sorted_values is None:
+            values = [key[0] for key in self.buckets if key[0] is not None and not isinstance(key[0], tuple)]
+            try:
+                self._sorted_values = sorted(values)
+            except TypeError:
+                return None
+        values = self._sorted_values
+        try:
+            lo, hi = 0, len(values)
+            if '$gt' in bounds:
+                lo = max(lo, bisect.bisect_right(values, bounds['$gt']))
+            if '$gte' in bounds:
+                lo = max(lo, bisect.bisect_left(values, bounds['$gte']))
+            if '$lt' in bounds:
+                hi = min(hi, bisect.bisect_left(values, bounds['$lt']))
+            if '$lte' in bounds:
+                hi = min(hi, bisect.bisect_right(values, bounds['$lte']))
+        except TypeError:
+            return None
+        ids = {}
+        for value in values[lo:hi]:
+            ids.update(self.buckets[(value,)])
+        return ids
+
+
+# ----------------------------------------------------------------------
+# Updates
+# ----------------------------------------------------------------------
+UPDATE_OPERATORS = ('$set', '$unset', '$inc', '$setOnInsert')
+
+
+def _result(name, **fields):
+    """Build a lightweight pymongo-style result object"""
+    return type(name, (), fields)()
+
+
+def _with_path(doc, path, value=_MISSING):
+    """Return the new top-level value of path's root field after setting (or removing) path"""
+    root, _, rest = path.partition('.')
+    if not rest:
+        return value
+    current = doc.get(root)
+    current = copy.deepcopy(current) if isinstance(current, dict) else {}
+    target = current
+    *parents, leaf = rest.split('.')
+    for part in parents:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    if value is _MISSING:
+        target.pop(leaf, None)
+    else:
+        target[leaf] = value
+    return current
+
+
+def _update_changes(doc, update, inserting=False):
+    """
+    Translate an update document into (set, unset) on top-level fields.
+    Supports $set, $unset, $inc and $setOnInsert (only applied when inserting) with dotted paths;
+    an update without operators is merged into the document (the historical behaviour).
+    """
+    if not any(str(key).startswith('$') for key in update):
+        return dict(update), []
+    unknown = [key for key in update if key not in UPDATE_OPERATORS]
+    if unknown:
+        raise ValueError(f"Unsupported update operator(s) {unknown}, expected {UPDATE_OPERATORS}")
+
+    working = dict(doc)
+    changed, removed = set(), set()
+    operations = [('$set', update.get('$set', {})), ('$inc', update.get('$inc', {}))]
+    if inserting:
+        operations.append(('$set', update.get('$setOnInsert', {})))
+    for op, fields in operations:
+        for path, operand in fields.items():
+            if op == '$inc':
+                current = _get_field(working, path)
+                current = 0 if current is _MISSING or current is None else current
+                if not isinstance(current, (int, float)) or not isinstance(operand, (int, float)):
+                    raise ValueError(f"Cannot $inc non-numeric field '{path}'")
+                operand = current + operand
+            root = path.split('.')[0]
+            working[root] = _with_path(working, path, operand)
+            changed.add(root)
+            removed.discard(root)
+    for path in update.get('$unset', {}):
+        root = path.split('.')[0]
+        if '.' in path:
+            working[root] = _with_path(working, path)
+            changed.add(root)
+        elif root in working:
+            working.pop(root)
+            changed.discard(root)
+            removed.add(root)
+    return {root: working[root] for root in changed}, sorted(removed)
+
+
+def _upsert_document(query, update):
+    """Seed a new document from the equality terms of the query plus the update"""
+    doc = {}
+    for key, value in (query or {}).items():
+        if key in _LOGICAL_OPS:
+            continue
+        if not _is_operator_dict(value):
+            doc[key.split('.')[0]] = _with_path(doc, key, copy.deepcopy(value))
+        elif '$eq' in value:
+            doc[key.split('.')[0]] = _with_path(doc, key, copy.deepcopy(value['$eq']))
+    changes, removed = _update_changes(doc, update, inserting=True)
+    doc.update(changes)
+    for field in removed:
+        doc.pop(field, None)
+    return doc
+
+
+class ReturnDocument:
+    """Which version of the document find_one_and_update returns, as in pymongo"""
+    BEFORE = False
+    AFTER = True
+
+
+class InsertOne:
+    """Bulk write operation, as in pymongo"""
+
+    def __init__(self, document):
+        self.document = document
+
+
+class UpdateOne:
+    def __init__(self, filter, update, upsert=False):
+        self.filter, self.update, self.upsert = filter, update, upsert
+
+
+class UpdateMany:
+    def __init__(self, filter, update, upsert=False):
+        self.filter, self.update, self.upsert = filter, update, upsert
+
+
+class DeleteOne:
+    def __init__(self, filter):
+        self.filter = filter
+
+
+class DeleteMany:
+    def __init__(self, filter):
+        self.filter = filter
+
+
+# ----------------------------------------------------------------------
+# Codecs
+# ----------------------------------------------------------------------
+def _encode_default(value):
+    """Typed encoding of values JSON cannot represent: datetimes become {"$date": iso}, the rest str()"""
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return str(value)
+
+
+def _decode_hook(obj):
+    """Turn {"$date": iso} back into a datetime"""
+    if len(obj) == 1 and isinstance(obj.get("$date"), str):
+        try:
+            return datetime.fromisoformat(obj["$date"])
+        except ValueError:
+            return obj
+    return obj
+
+
+def _revive(value):
+    """Apply _decode_hook to every dict of a decoded value (for decoders without an object hook)"""
+    if isinstance(value, dict):
+        return _decode_hook({key: _revive(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_revive(item) for item in value]
+    return value
+
+
+class _Codec:
+    """
+    Serialization of collection files ('json' storage) and log records ('jsonl' storage).
+    dump() encodes a whole collection file, dump_line() a single log record (no newlines),
+    load() decodes either and raises ValueError on malformed input.
+    """
+
+    def __init__(self, name, dump, load, dump_line=None, suffix='json', binary=False):
+        self.name = name
+        self.dump = dump
+        self.load = load
+        self.dump_line = dump_line or dump
+        self.suffix = suffix
+        # Binary codecs cannot frame records by newlines, so they only support 'json' storage
+        self.binary = binary
+
+
+def _make_codec(name):
+    if name == 'json':
+        # The historical format: readable, but datetimes are stored as plain strings
+        return _Codec(name, lambda obj: json.dumps(obj, indent=2, default=str).encode(), json.loads,
+                      dump_line=lambda obj: json.dumps(obj, default=str).encode())
+    if name == 'compact':
+        return _Codec(name,
+                      lambda obj: json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                                             default=_encode_default).encode(),
+                      lambda data: json.loads(data, object_hook=_decode_hook))
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError("The 'orjson' codec needs the orjson package (pip install orjson)")
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        return _Codec(name, lambda obj: orjson.dumps(obj, default=_encode_default, option=options),
+                      lambda data: _revive(orjson.loads(data)))
+    if name == 'msgpack':
+        if msgpack is None:
+            raise ValueError("The 'msgpack' codec needs the msgpack package (pip install msgpack)")
+        return _Codec(name, lambda obj: msgpack.packb(obj, default=_encode_default, use_bin_type=True),
+                      lambda data: msgpack.unpackb(data, object_hook=_decode_hook, raw=False,
+                                                   strict_map_key=False),
+                      suffix='msgpack', binary=True)
+    raise ValueError(f"Unknown codec '{name}', expected one of {CODECS}")
+
+
+def _file_suffix(storage, codec):
+    return 'jsonl' if storage == 'jsonl' else codec.suffix
+
+
+# ----------------------------------------------------------------------
+# Cursors
+# ----------------------------------------------------------------------
+ASCENDING = 1
+DESCENDING = -1
+
+# Cross-type ordering used by MongoDB: null < numbers < strings < objects < arrays < booleans < dates
+_TYPE_ORDER = ((type(None), 0), (bool, 5), (int, 1), (float, 1), (str, 2), (dict, 3), (list, 4), (datetime, 6))
+
+
+def _sort_value(value):
+    if value is _MISSING:
+        return (0, 0)
+    for kind, rank in _TYPE_ORDER:
+        if isinstance(value, kind):
+            if kind in (dict, list):
+                return (rank, json.dumps(value, sort_keys=True, default=str))
+            return (rank, 0 if value is None else value)
+    return (7, str(value))
+
+
+def _sort_comparator(keys):
+    """Build a cmp_to_key key function for [(field, direction), ...]"""
+    def compare(a, b):
+        for field, direction in keys:
+            x, y = _sort_value(_get_field(a, field)), _sort_value(_get_field(b, field))
+            if x != y:
+                return (-1 if x < y else 1) * direction
+        return 0
+    return functools.cmp_to_key(compare)
+
+
+def _normalize_projection(projection):
+    """Return (include_mode, fields, include_id) for a pymongo projection dict or list of fields"""
+    if projection is None:
+        return None
+    if not isinstance(projection, dict):
+        projection = {field: 1 for field in projection}
+    include_id = bool(projection.get('_id', 1))
+    fields = {k: bool(v) for k, v in projection.items() if k != '_id'}
+    if any(fields.values()):
+        if not all(fields.values()):
+            raise ValueError("Cannot mix inclusion and exclusion in a projection")
+        return True, list(fields), include_id
+    return False, list(fields), include_id
+
+
+def _project(doc, projection):
+    """Copy a document, keeping only the projected fields"""
+    if projection is None:
+        return copy.deepcopy(doc)
+    include_mode, fields, include_id = projection
+    if include_mode:
+        result = {}
+        if include_id and '_id' in doc:
+            result['_id'] = copy.deepcopy(doc['_id'])
+        for path in fields:
+            value = _get_field(doc, path)
+            if value is _MISSING:
+                continue
+            *parents, leaf = path.split('.')
+            target = result
+            for part in parents:
+                target = target.setdefault(part, {})
+            target[leaf] = copy.deepcopy(value)
+        return result
+
+    result = copy.deepcopy(doc)
+    if not include_id:
+        result.pop('_id', None)
+    for path in fields:
+        *parents, leaf = path.split('.')
+        target = result
+        for part in parents:
+            target = target.get(part) if isinstance(target, dict) else None
+        if isinstance(target, dict):
+            target.pop(leaf, None)
+    return result
+
+
+class JSONCursor:
+    """
+    Lazy result of JSONCollection.find, mimicking pymongo's Cursor.
+    Nothing is evaluated until iteration; documents are copied (and projected) one at a time,
+    skip/limit stop the scan early and sort with a limit only keeps the top-k matches.
+    """
+
+    def __init__(self, collection, query=None, projection=None):
+        self._collection = collection
+        self._query = query
+        self._projection = _normalize_projection(projection)
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        """Sort by a field, or by a list of (field, direction) pairs"""
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction or ASCENDING)]
+        else:
+            self._sort = [(field, d) for field, d in key_or_list]
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        """Limit the number of results (0 means no limit, as in pymongo)"""
+        self._limit = count
+        return self
+
+    def _documents(self):
+        """Yield matching stored documents (not copies) after sort/skip/limit"""
+        matches = (doc for _, doc in self._collection._matching(self._query))
+        stop = self._skip + self._limit if self._limit else None
+        if self._sort:
+            key = _sort_comparator(self._sort)
+            if stop is not None:
+                matches = heapq.nsmallest(stop, matches, key=key)
+            else:
+                matches = sorted(matches, key=key)
+        return itertools.islice(matches, self._skip, stop)
+
+    def __iter__(self):
+        for doc in self._documents():
+            yield _project(doc, self._projection)
+
+    def to_list(self):
+        return list(self)
+
+    def explain(self):
+        """pymongo-style plan and execution statistics of this query (the query is run to collect them)"""
+        explanation = self._collection._explain(self._query)
+        plan = explanation["queryPlanner"]["winningPlan"]
+        if self._sort:
+            plan = {"stage": "SORT", "sortPattern": dict(self._sort), "inputStage": plan}
+        if self._skip or self._limit:
+            plan = {"stage": "LIMIT" if self._limit else "SKIP", "skipAmount": self._skip,
+                    "limitAmount": self._limit, "inputStage": plan}
+        explanation["queryPlanner"]["winningPlan"] = plan
+        stats = explanation["executionStats"]
+        returned = max(0, stats["nReturned"] - self._skip)
+        stats["nReturned"] = min(returned, self._limit) if self._limit else returned
+        return explanation
+
+
+# ----------------------------------------------------------------------
+# Aggregation
+# ----------------------------------------------------------------------
+AGGREGATION_STAGES = ('$match', '$group', '$sort', '$project', '$unwind', '$skip', '$limit', '$count')
+
+
+def _expression(spec):
+    """Compile an aggregation expression ("$field.path", {"$literal": v}, {name: expr, ...} or a constant)"""
+    if isinstance(spec, str) and spec.startswith('$'):
+        path = spec[1:]
+        return lambda doc: _get_field(doc, path)
+    if isinstance(spec, dict) and set(spec) == {'$literal'}:
+        value = spec['$literal']
+        return lambda doc: value
+    if isinstance(spec, dict) and not _is_operator_dict(spec):
+        fields = [(name, _expression(value)) for name, value in spec.items()]
+        return lambda doc: {name: (None if value is _MISSING else value)
+                            for name, value in ((name, evaluate(doc)) for name, evaluate in fields)}
+    if _is_operator_dict(spec):
+        raise ValueError(f"Unsupported aggregation expression {spec!r}")
+    return lambda doc: spec
+
+
+class _Accumulator:
+    """Running state of one $group output field; O(1) memory except for $push/$addToSet"""
+    __slots__ = ('op', 'value', 'count', 'seen')
+
+    def __init__(self, op):
+        self.op = op
+        self.value = {'$sum': 0, '$count': 0, '$push': [], '$addToSet': []}.get(op, _MISSING)
+        self.count = 0
+        self.seen = set() if op == '$addToSet' else None
+
+    def add(self, value):
+        op = self.op
+        if op == '$count':
+            self.value += 1
+        elif op == '$first':
+            if self.value is _MISSING:
+                self.value = value
+        elif op == '$last':
+            self.value = value
+        elif op == '$push':
+            if value is not _MISSING:
+                self.value.append(value)
+        elif op == '$addToSet':
+            key = _index_value(value)
+            if value is not _MISSING and key not in self.seen:
+                self.seen.add(key)
+                self.value.append(value)
+        elif op in ('$min', '$max'):
+            # null and missing values are ignored, everything else compares in BSON order
+            if value is _MISSING or value is None:
+                return
+            if (self.value is _MISSING
+                    or (op == '$min' and _sort_value(value) < _sort_value(self.value))
+                    or (op == '$max' and _sort_value(value) > _sort_value(self.value))):
+                self.value = value
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            # $sum and $avg skip non-numeric values
+            self.value = (0 if self.value is _MISSING else self.value) + value
+            self.count += 1
+
+    def result(self):
+        if self.op == '$avg':
+            return self.value / self.count if self.count else None
+        return None if self.value is _MISSING else self.value
+
+
+_ACCUMULATORS = ('$sum', '$avg', '$min', '$max', '$first', '$last', '$push', '$addToSet', '$count')
+
+
+def _group_stage(spec):
+    """$group: one pass over the input, keeping only the accumulators of each group"""
+    if '_id' not in spec:
+        raise ValueError("$group requires an '_id' expression")
+    key_of = _expression(spec['_id'])
+    outputs = []
+    for name, accumulator in spec.items():
+        if name == '_id':
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1 or next(iter(accumulator)) not in _ACCUMULATORS:
+            raise ValueError(f"$group field '{name}' must be one of the accumulators {', '.join(_ACCUMULATORS)}")
+        (op, argument), = accumulator.items()
+        outputs.append((name, op, _expression(argument)))
+
+    def run(docs):
+        groups = {}
+        for doc in docs:
+            key = key_of(doc)
+            key = None if key is _MISSING else key
+            group = groups.get(_index_value(key))
+            if group is None:
+                group = groups[_index_value(key)] = (key, [_Accumulator(op) for _, op, _ in outputs])
+            for (_, _, evaluate), accumulator in zip(outputs, group[1]):
+                accumulator.add(evaluate(doc))
+        for key, accumulators in groups.values():
+            result = {'_id': key}
+            for (name, _, _), accumulator in zip(outputs, accumulators):
+                result[name] = accumulator.result()
+            yield result
+    return run
+
+
+def _project_stage(spec):
+    """$project: field inclusion/exclusion as in find(), plus computed fields ("$path" and literals)"""
+    computed = {name: _expression(value) for name, value in spec.items() if not isinstance(value, (bool, int))}
+    projection = _normalize_projection({name: value for name, value in spec.items() if name not in computed}
+                                       or {'_id': 1})
+    if computed and not projection[0] and projection[1]:
+        raise ValueError("Cannot mix exclusion and computed fields in $project")
+    if computed:
+        projection = (True,) + projection[1:]
+
+    def run(docs):
+        for doc in docs:
+            result = _project(doc, projection)
+            for name, evaluate in computed.items():
+                value = evaluate(doc)
+                if value is not _MISSING:
+                    result[name.partition('.')[0]] = _with_path(result, name, copy.deepcopy(value))
+            yield result
+    return run
+
+
+def _unwind_stage(spec):
+    """$unwind: one output document per element of an array field"""
+    options = spec if isinstance(spec, dict) else {'path': spec}
+    if not str(options.get('path', '')).startswith('$'):
+        raise ValueError("$unwind path must be a '$field' reference")
+    path = options['path'][1:]
+    keep_empty = options.get('preserveNullAndEmptyArrays', False)
+
+    def run(docs):
+        for doc in docs:
+            value = _get_field(doc, path)
+            if isinstance(value, list) and value:
+                for item in value:
+                    unwound = dict(doc)
+                    unwound[path.partition('.')[0]] = _with_path(doc, path, item)
+                    yield unwound
+            elif isinstance(value, list) or value is _MISSING or value is None:
+                if keep_empty:
+                    yield doc
+            else:
+                yield doc
+    return run
+
+
+def _sort_stage(spec, limit=None):
+    """$sort, keeping only the top `limit` documents when a $limit follows"""
+    key = _sort_comparator(list(spec.items()))
+    if limit is not None:
+        return lambda docs: iter(heapq.nsmallest(limit, docs, key=key))
+    return lambda docs: iter(sorted(docs, key=key))
+
+
+def _compile_pipeline(pipeline):
+    """
+    Compile pipeline stages (after a leading $match) into generator functions docs -> docs.
+    Returns (functions, copied): copied tells whether the final documents are already copies.
+    """
+    stages = []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1 or next(iter(stage)) not in AGGREGATION_STAGES:
+            raise ValueError(f"Unsupported aggregation stage {stage!r}; supported: {', '.join(AGGREGATION_STAGES)}")
+        stages.append(next(iter(stage.items())))
+
+    functions, copied = [], False
+    for position, (name, spec) in enumerate(stages):
+        if name == '$match':
+            matches = compile_query(spec)
+            functions.append(functools.partial(filter, matches))
+        elif name == '$group':
+            functions.append(_group_stage(spec))
+            copied = False
+        elif name == '$sort':
+            following = stages[position + 1] if position + 1 < len(stages) else None
+            limit = following[1] if following and following[0] == '$limit' else None
+            functions.append(_sort_stage(spec, limit))
+        elif name == '$project':
+            functions.append(_project_stage(spec))
+            copied = True
+        elif name == '$unwind':
+            functions.append(_unwind_stage(spec))
+            copied = False
+        elif name == '$skip':
+            functions.append(functools.partial(lambda count, docs: itertools.islice(docs, count, None), spec))
+        elif name == '$limit':
+            functions.append(functools.partial(lambda count, docs: itertools.islice(docs, count), spec))
+        elif name == '$count':
+            functions.append(functools.partial(lambda field, docs: iter([{field: sum(1 for _ in docs)}]), spec))
+            copied = True
+    return functions, copied
+
+
+def _aggregate(source, pipeline):
+    """
+    Run an aggregation pipeline over source._matching (a collection or a partitioned collection).
+    Leading $match stages are merged and answered through the collection's indexes; later stages
+    stream over the matches, so only $group state and $sort buffers are held in memory.
+    """
+    pipeline = list(pipeline)
+    query = {}
+    while pipeline and isinstance(pipeline[0], dict) and list(pipeline[0]) == ['$match']:
+        match = pipeline.pop(0)['$match'] or {}
+        if set(match) & set(query):
+            # Overlapping fields cannot be merged into one filter; keep the index-friendly part on top
+            query = dict(query, **{'$and': query.get('$and', []) + [match]})
+        else:
+            query.update(match)
+    functions, copied = _compile_pipeline(pipeline)
+
+    def run():
+        docs = (doc for _, doc in source._matching(query or None))
+        for function in functions:
+            docs = function(docs)
+        for doc in docs:
+            yield doc if copied else copy.deepcopy(doc)
+    return run()
+
+
+# ----------------------------------------------------------------------
+# Change streams
+# ----------------------------------------------------------------------
+class ChangeStream:
+    """
+    Iterator over the changes of a JSONCollection, mimicking pymongo's ChangeStream.
+    Events look like MongoDB's: {"_id": <resume token>, "operationType": "insert" | "update" |
+    "delete", "documentKey": {"_id": id}, "fullDocument": <document after the change>,
+    "updateDescription": {"updatedFields": ..., "removedFields": [...]}}.
+    Iterating blocks until the next change; try_next() waits at most max_await_time seconds.
+    """
+
+    def __init__(self, collection, query=None, resume_after=None, max_await_time=1.0, poll_interval=0.25):
+        self._collection = collection
+        self._matches = compile_query(query) if query else None
+        self._max_await_time = max_await_time
+        self._poll_interval = poll_interval
+        self._closed = False
+        self._last = collection._watch(resume_after)
+
+    @property
+    def resume_token(self):
+        """Token of the last event returned; pass it as resume_after to continue after it"""
+        return self._collection._change_token(self._last)
+
+    def try_next(self):
+        """Return the next matching change, or None if there was none within max_await_time"""
+        deadline = time.monotonic() + self._max_await_time
+        while not self._closed:
+            # Writes of other processes only show up once the view catches up with the file
+            self._collection._refresh()
+            with self._collection._change_cond:
+                event = self._next_event()
+                if event is not None:
+                    return event
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._collection._change_cond.wait(min(remaining, self._poll_interval))
+        return None
+
+    def _next_event(self):
+        """Pop the next matching buffered event; caller holds the change condition"""
+        changes = self._collection._changes
+        if changes and changes[0][0] > self._last + 1:
+            raise ValueError("Resume point is no longer in the change buffer; reread the collection")
+        start = self._last - changes[0][0] + 1 if changes else 0
+        for seq, event, doc in itertools.islice(changes, max(start, 0), None):
+            self._last = seq
+            if self._matches is None or (doc is not None and self._matches(doc)):
+                return copy.deepcopy(event)
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._closed:
+            event = self.try_next()
+            if event is not None:
+                return event
+        raise StopIteration
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._collection._unwatch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _RWLock:
+    """Writer-preferring readers-writer lock guarding a collection's in-memory view"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class _FileLock:
+    """
+    Exclusive lock across threads and processes: an in-process mutex plus an advisory flock
+    on a sidecar '.lock' file (the flock part is a no-op where fcntl is unavailable).
+    Always acquire it before the collection's view lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        # flock does not exclude threads sharing the same file descriptor
+        self._mutex = threading.Lock()
+
+    def __enter__(self):
+        self._mutex.acquire()
+        try:
+            # flock is tied to the open file, so a forked worker (e.g. gunicorn --preload) needs its own
+            if self._fd is None or self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._mutex.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._mutex.release()
+
+    def close(self):
+        """Close the lock file descriptor; it is reopened on the next acquire"""
+        with self._mutex:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+
+
+def _fsync_dir(path):
+    """Make a rename in this directory durable (best effort, not supported on Windows)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _atomic_write(path, data, fsync=True):
+    """Write bytes to a temp file next to path, fsync it and rename it over path"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    if fsync:
+        _fsync_dir(path.parent)
+
+
+class _ViewCache:
+    """
+    LRU accounting of the collection views held in memory across all collections.
+    Views are sized by their file size; once the total exceeds the limit, the least
+    recently used views are dropped and re-read from disk on their next access.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._sizes = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def touch(self, collection, size):
+        """Record an access; must be called without holding any collection lock"""
+        with self._lock:
+            self._total += size - self._sizes.pop(collection, 0)
+            self._sizes[collection] = size
+            victims = []
+            while self._total > self.limit and len(self._sizes) > 1:
+                victim = next(iter(self._sizes))
+                if victim is collection:
+                    break
+                self._total -= self._sizes.pop(victim)
+                victims.append(victim)
+        for victim in victims:
+            victim._evict()
+
+    def discard(self, collection):
+        with self._lock:
+            self._total -= self._sizes.pop(collection, 0)
+
+    def info(self):
+        with self._lock:
+            return {
+                "limit_bytes": self.limit,
+                "cached_bytes": self._total,
+                "collections": [str(collection.file_path) for collection in self._sizes],
+            }
+
+
+_view_cache = _ViewCache(DEFAULT_CACHE_LIMIT)
+
+
+def set_cache_limit(limit_bytes):
+    """Change the memory budget (in bytes of collection files) shared by all cached collection views"""
+    _view_cache.limit = limit_bytes
+
+
+def cache_info():
+    """Return the current cache budget, usage and cached collections (most recently used last)"""
+    return _view_cache.info()
+
+
+# ----------------------------------------------------------------------
+# Profiling
+# ----------------------------------------------------------------------
+_slow_query_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+
+def _log_slow(entry):
+    _slow_query_log.append(entry)
+    print(f"🐢 Slow json_db {entry['op']} on {entry['collection']}: {entry['ms']} ms "
+          f"{json.dumps(entry.get('query'), default=str) if 'query' in entry else ''}")
+
+
+def slow_queries():
+    """The most recent slow queries and writes of all profiled collections, oldest first"""
+    return list(_slow_query_log)
+
+
+def _explain_result(namespace, query, plan, examined, returned, seconds):
+    """pymongo-style explain() output"""
+    return {
+        "queryPlanner": {"namespace": namespace, "parsedQuery": query or {}, "winningPlan": plan},
+        "executionStats": {"nReturned": returned, "totalDocsExamined": examined,
+                           "executionTimeMillis": round(seconds * 1000, 3)},
+    }
+
+
 class JSONCollection:
-    """Mimics MongoDB collection interface using JSON files"""
+    """
+    Mimics MongoDB collection interface using JSON files
+
+    Concurrency: reads and writes within a process are coordinated by a readers-writer lock,
+    and writes across processes (e.g. several gunicorn workers) by an advisory lock on
+    '<collection>.lock'. Every write first catches up with changes made by other processes,
+    so read-modify-write cycles never lose their updates. 'json' files are replaced atomically
+    (temp file + rename) and 'jsonl' records are appended with a single write.
+
+    Caching: the parsed view stays in memory between calls. Before each access it is validated
+    against the file's inode/size/mtime (writes made by this process update the recorded
+    signature, so they never force a re-read) and views are evicted LRU-first across all
+    collections once their combined size exceeds the cache limit (see set_cache_limit).
+
+    Write-behind: with write_behind=True an insert_one()/insert_many() is applied to the
+    in-memory view and queued, and a background thread commits the queue every flush_interval
+    seconds, so inserting callers never wait for disk I/O. Writes that read the view (updates,
+    upserts, find_one_and_update, deletes, bulk_write) are not queued: they take the file lock,
+    catch up and commit synchronously, together with the inserts queued before them, so they stay
+    atomic across processes. Call flush() to wait until everything queued so far is on disk (it
+    also runs at interpreter exit). In 'jsonl' mode several processes may write concurrently; in
+    'json' mode the view with queued inserts is authoritative, so use it with a single writer process.
+    fsync selects durability: 'always', 'batch' (once per flushed batch) or 'os'.
+
+    codec selects the file encoding (see CODECS); it defaults to JSON_DB_CODEC or 'json'.
+
+    Compaction ('jsonl'): compact() writes a point-in-time snapshot of the view and replaces the
+    log by the records appended meanwhile; it runs in the background once the log exceeds
+    compact_bytes (0 disables this) and its snapshot. Opening replays snapshot + log, and a torn
+    trailing record left by a crashed writer is dropped. Log records are absolute (updates carry
+    the new field values), so replaying a log over a newer snapshot gives the same view, which
+    is what makes a crash between swapping the snapshot and the log harmless.
+
+    Profiling: find(...).explain() and explain_count() report the plan (index or full scan),
+    documents examined vs returned and the time taken. With slow_ms set (or JSON_DB_SLOW_MS),
+    every query and write is counted in stats() and those slower than slow_ms are logged to
+    slow_queries().
+
+    Archiving: archive(query) moves matching documents into a compressed read-only segment and
+    archived() queries the segments; see ArchivedCollection.
+
+    Aggregation: aggregate() runs $match/$group/$sort/$project/$unwind/$skip/$limit/$count
+    pipelines without copying the collection; see _aggregate.
+
+    Change streams: watch() yields the inserts, updates and deletes applied to the view after it
+    was called (or after a resume token). In 'jsonl' mode this includes the writes of other
+    processes, picked up from the log; in 'json' mode only this process's writes are streamed,
+    since whole-file rewrites carry no change records.
+    """
+
+    def __init__(self, db_dir, collection_name, storage='json', write_behind=False, flush_interval=0.05,
+                 fsync='always', codec=None, compact_bytes=None, slow_ms=None):
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode '{storage}', expected one of {STORAGE_MODES}")
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}', expected one of {FSYNC_POLICIES}")
+        self.codec = _make_codec(codec or DEFAULT_CODEC)
+        if self.codec.binary and storage == 'jsonl':
+            raise ValueError(f"The '{self.codec.name}' codec cannot be used with 'jsonl' storage")
 
-    def __init__(self, db_dir, collection_name):
         self.db_dir = Path(db_dir)
         self.collection_name = collection_name
-        self.file_path = self.db_dir / f"{collection_name}.json"
+        self.storage = storage
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.file_path = self.db_dir / f"{collection_name}.{_file_suffix(storage, self.codec)}"
+        self.snapshot_path = self.db_dir / f"{collection_name}.snapshot"
+        self.archive_dir = self.db_dir / f"{collection_name}.archive"
+        self.compact_bytes = DEFAULT_COMPACT_BYTES if compact_bytes is None else compact_bytes
+        # Profiling is on when slow_ms is set (see stats() and slow_queries())
+        self.slow_ms = DEFAULT_SLOW_MS if slow_ms is None else slow_ms
+        self._stats = dict.fromkeys(("queries", "index_scans", "collection_scans", "docs_examined",
+                                     "docs_returned", "query_ms", "writes", "write_ms", "slow"), 0)
+        self._stats_lock = threading.Lock()
+
+        # In-memory view: document id -> document (insertion ordered).
+        # Stored documents are never mutated in place (updates replace them), so readers
+        # can keep using a document after releasing the lock.
+        self._docs = {}
+        # Insertion ordinal of every document, used to return index hits in collection order
+        self._seq = {}
+        self._next_seq = 0
+        # Secondary indexes by name, see create_index()
+        self._indexes = {}
+        # Byte offset up to which the log has been replayed ('jsonl' mode)
+        self._offset = 0
+        self._file_id = None
+        # Size of the snapshot the view was loaded from, and whether a compaction is running ('jsonl' mode)
+        self._snapshot_size = 0
+        self._compacting = False
+        # Change streams: recent changes as (seq, event, document) once watch() was first called
+        self._changes = None
+        self._change_seq = 0
+        self._change_cond = threading.Condition()
+        self._change_stream_id = _new_id()
+        self._watchers = 0
+        # False while the view is rebuilt from disk, which is not a change
+        self._recording = True
+        # File signature the view was loaded from ('json' mode), None when not loaded
+        self._loaded_signature = None
+        # Incremented on every change applied to the view
+        self.generation = 0
+        self._loaded = False
+
+        self._lock = _RWLock()
+
+        # Write-behind queue: encoded records per write ('jsonl') or one marker per write ('json')
+        self._pending = []
+        self._flush_mutex = threading.Lock()
+        self._flush_wakeup = threading.Event()
+        self._flusher = None
+        # Records committed by the current _writing() block, persisted together when it exits
+        self._staged = None
 
         # Create directory if it doesn't exist
         self.db_dir.mkdir(parents=True, exist_ok=True)
+        self._file_lock = _FileLock(self.db_dir / f"{collection_name}.lock")
 
-        # Initialize file if it doesn't exist
-        if not self.file_path.exists():
-            self._write_data([])
+        with self._file_lock, self._lock.write():
+            if not self.file_path.exists():
+                # Initialize file if it doesn't exist
+                self._initialize_file()
+            self._catch_up()
+            self._drop_torn_tail()
+        _view_cache.touch(self, self._view_size())
 
+    # ------------------------------------------------------------------
+    # Storage
+    # ------------------------------------------------------------------
     def _read_data(self):
-        """Read all documents from JSON file"""
+        """Read all documents from the collection file"""
         try:
-            with open(self.file_path, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
+            with open(self.file_path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return []
+        if not content.strip():
             return []
+        try:
+            return self.codec.load(content)
+        except ValueError as e:
+            # Never fall back to an empty collection here: the next write would overwrite the file
+            raise ValueError(f"Collection file {self.file_path} is not valid {self.codec.name}: {e}") from e
 
     def _write_data(self, data):
-        """Write all documents to JSON file"""
-        with open(self.file_path, 'w') as f:
-            json.dump(data, f, indent=2, default=str)
+        """Write all documents to the collection file"""
+        _atomic_write(self.file_path, self.codec.dump(data), fsync=self.fsync != 'os')
+
+    def _initialize_file(self):
+        """Create an empty collection file; a new log is seeded from a legacy JSON file if there is one"""
+        if self.storage == 'json':
+            self._write_data([])
+            return
+        legacy_path = self.db_dir / f"{self.collection_name}.json"
+        docs = self._read_legacy(legacy_path) if legacy_path.exists() else []
+        lines = [self.codec.dump_line({"op": "insert", "id": _new_id(), "doc": doc}) + b"\n" for doc in docs]
+        _atomic_write(self.file_path, b"".join(lines))
+
+    def _read_legacy(self, path):
+        """Read documents from a JSON array file written by the 'json' storage mode"""
+        try:
+            with open(path, 'rb') as f:
+                return self.codec.load(f.read())
+        except ValueError:
+            return []
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _reset_view(self):
+        self._docs = {}
+        self._seq = {}
+        self._next_seq = 0
+        for index in self._indexes.values():
+            index.clear()
+
+    def _view_size(self):
+        if self.storage == 'jsonl':
+            return self._snapshot_size + self._offset
+        return self._loaded_signature[1] if self._loaded_signature else 0
+
+    def _is_current(self, signature):
+        """Whether the view already reflects the file with this signature"""
+        if signature is None:
+            return False
+        if self.storage == 'json':
+            return signature == self._loaded_signature
+        return signature[0] == self._file_id and signature[1] == self._offset
+
+    def _evict(self):
+        """Drop the in-memory view; it is rebuilt from disk on the next access"""
+        with self._lock.write():
+            if self._pending:
+                # Queued writes only exist in the view until they are flushed
+                return
+            if self._watchers:
+                # Change streams diff reloads against the current view
+                return
+            self._reset_view()
+            self._loaded = False
+            self._loaded_signature = None
+            self._offset = 0
+            self._file_id = None
+
+    def _catch_up(self):
+        """Bring the in-memory view up to date with the file; caller holds the write lock"""
+        self._loaded = True
+        if self.storage == 'json':
+            # Stat before reading: if the file is replaced in between we re-read next time
+            signature = self._file_signature()
+            if signature is not None and signature == self._loaded_signature:
+                return
+            if self._pending and self._loaded_signature is not None:
+                # The view holds queued writes, it stays authoritative until they are flushed
+                return
+            self._reset_view()
+            self._recording = False
+            try:
+                for position, doc in enumerate(self._read_data()):
+                    self._apply({"op": "insert", "id": position, "doc": doc})
+            finally:
+                self._recording = True
+            self._loaded_signature = signature
+            return
+
+        try:
+            f = open(self.file_path, 'rb')
+        except FileNotFoundError:
+            f = None
+        with f or contextlib.nullcontext():
+            stat = os.fstat(f.fileno()) if f else None
+            reload = stat is None or stat.st_ino != self._file_id or stat.st_size < self._offset
+            # A reload is diffed against the previous view for change streams (ids are stable in the log)
+            previous = self._docs if reload and self._changes is not None and self._file_id is not None else None
+            self._recording = not reload
+            try:
+                if reload:
+                    # First load, or the log was compacted/replaced by another process: start from the snapshot.
+                    # It is read after opening the log: compaction swaps the snapshot in before the log,
+                    # so the open log holds every record newer than whichever snapshot we read.
+                    self._reset_view()
+                    self._offset = 0
+                    self._file_id = stat.st_ino if stat else None
+                    self._snapshot_size = self._load_snapshot()
+                if stat is not None and stat.st_size > self._offset:
+                    f.seek(self._offset)
+                    data = f.read()
+                    # Only consume complete lines; a trailing partial line is still being written
+                    end = data.rfind(b"\n") + 1
+                    self._replay_lines(data[:end])
+                    self._offset += end
+                if reload:
+                    # Queued writes are newer than anything in the log
+                    self._replay_lines(b"".join(self._pending))
+            finally:
+                self._recording = True
+        if previous is not None:
+            self._record_reload(previous)
+
+    def _load_snapshot(self):
+        """Load the snapshot (if any) into the empty view; returns its size in bytes"""
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        try:
+            snapshot = self.codec.load(data)
+        except ValueError as e:
+            # Snapshots are renamed into place complete, so this is not a torn write: refuse to guess
+            raise ValueError(f"Snapshot {self.snapshot_path} is not valid {self.codec.name}: {e}") from e
+        for doc_id, doc in snapshot["docs"]:
+            self._apply({"op": "insert", "id": doc_id, "doc": doc})
+        return len(data)
+
+    def _replay_lines(self, data):
+        """Apply the log records contained in complete lines of data"""
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = self.codec.load(line)
+            except ValueError:
+                print(f"⚠️  Skipping unreadable record in {self.file_path}")
+                continue
+            self._apply(record)
+
+    def _refresh(self):
+        """Catch up with writes made by other processes before a read"""
+        if not self._is_current(self._file_signature()):
+            with self._lock.write():
+                self._catch_up()
+        _view_cache.touch(self, self._view_size())
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Hold the read lock over an up-to-date view (retrying if it was evicted in between)"""
+        while True:
+            self._refresh()
+            with self._lock.read():
+                if self._loaded:
+                    yield
+                    return
+
+    @contextlib.contextmanager
+    def _writing(self, queue=False):
+        """
+        Hold the in-process write lock and the cross-process file lock, with the view caught up.
+        With write_behind, a plain insert (queue=True) only takes the in-process lock and is queued.
+        """
+        started = time.perf_counter()
+        if self.write_behind and queue:
+            # Nothing touches the file here: the flusher takes the file lock when it commits.
+            # Inserts do not read the view, so a view missing other processes' queued writes is fine
+            with self._lock.write():
+                self._catch_up()
+                with self._staging(queue):
+                    yield
+        else:
+            # The flush mutex keeps the flusher from holding a batch taken off the queue meanwhile,
+            # so everything queued is still in _pending and is written ahead of this block's records
+            with self._flush_mutex, self._file_lock, self._lock.write():
+                self._catch_up()
+                self._drop_torn_tail()
+                with self._staging(queue):
+                    yield
+        _view_cache.touch(self, self._view_size())
+        if self.slow_ms is not None:
+            self._record_write(time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def _staging(self, queue):
+        """Collect the records committed inside one _writing() block and persist them in a single I/O"""
+        self._staged = []
+        try:
+            yield
+        finally:
+            # Records already applied to the view are persisted even if a later operation failed
+            staged, self._staged = self._staged, None
+            if staged:
+                self._persist(staged, queue)
+
+    def _drop_torn_tail(self):
+        """Truncate a partial trailing log line; caller holds the file lock and has caught up"""
+        if self.storage == 'jsonl' and os.path.getsize(self.file_path) > self._offset:
+            # Nobody else can be appending while we hold the file lock, so a partial
+            # trailing line was left by a writer that crashed: drop it before appending
+            print(f"⚠️  Dropping torn trailing record of {self.file_path}")
+            os.truncate(self.file_path, self._offset)
+
+    def _apply(self, record):
+        """Apply a single change record to the in-memory view and its indexes"""
+        self.generation += 1
+        op = record["op"]
+        doc_id = record["id"]
+        if op == "insert":
+            doc = record["doc"]
+            old_doc = self._docs.get(doc_id)
+            if old_doc is None:
+                self._seq[doc_id] = self._next_seq
+                self._next_seq += 1
+            else:
+                # Replaying a log over a newer snapshot re-inserts documents the view already holds
+                for index in self._indexes.values():
+                    index.remove(doc_id, old_doc)
+            self._docs[doc_id] = doc
+            for index in self._indexes.values():
+                index.add(doc_id, doc)
+            if self._changes is not None and self._recording:
+                self._record_change({"operationType": "insert", "documentKey": {"_id": doc_id},
+                                     "fullDocument": doc}, doc)
+        elif op == "update":
+            old_doc = self._docs.get(doc_id)
+            if old_doc is not None:
+                changes = record.get("set", {})
+                removed = record.get("unset", [])
+                doc = dict(old_doc)
+                doc.update(changes)
+                for field in removed:
+                    doc.pop(field, None)
+                self._docs[doc_id] = doc
+                for index in self._indexes.values():
+                    if not (changes.keys().isdisjoint(index.roots) and index.roots.isdisjoint(removed)):
+                        index.remove(doc_id, old_doc)
+                        index.add(doc_id, doc)
+                if self._changes is not None and self._recording:
+                    self._record_change({"operationType": "update", "documentKey": {"_id": doc_id},
+                                         "updateDescription": {"updatedFields": changes, "removedFields": removed},
+                                         "fullDocument": doc}, doc)
+        elif op == "delete":
+            doc = self._docs.pop(doc_id, None)
+            if doc is not None:
+                self._seq.pop(doc_id, None)
+                for index in self._indexes.values():
+                    index.remove(doc_id, doc)
+                if self._changes is not None and self._recording:
+                    # Filters of change streams are matched against the deleted document
+                    self._record_change({"operationType": "delete", "documentKey": {"_id": doc_id}}, doc)
+
+    # ------------------------------------------------------------------
+    # Change streams
+    # ------------------------------------------------------------------
+    def _record_change(self, event, doc):
+        """Append a change event for watchers; doc is what their filters are matched against"""
+        with self._change_cond:
+            self._change_seq += 1
+            event["_id"] = self._change_token(self._change_seq)
+            self._changes.append((self._change_seq, event, doc))
+            self._change_cond.notify_all()
+
+    def _record_reload(self, previous):
+        """Emit the differences between the view before a full reload and after it"""
+        for doc_id, doc in self._docs.items():
+            old_doc = previous.get(doc_id)
+            if old_doc is None:
+                self._record_change({"operationType": "insert", "documentKey": {"_id": doc_id},
+                                     "fullDocument": doc}, doc)
+            elif old_doc != doc:
+                changes = {key: value for key, value in doc.items() if old_doc.get(key, _MISSING) != value}
+                removed = [key for key in old_doc if key not in doc]
+                self._record_change({"operationType": "update", "documentKey": {"_id": doc_id},
+                                     "updateDescription": {"updatedFields": changes, "removedFields": removed},
+                                     "fullDocument": doc}, doc)
+        for doc_id, old_doc in previous.items():
+            if doc_id not in self._docs:
+                self._record_change({"operationType": "delete", "documentKey": {"_id": doc_id}}, old_doc)
+
+    def _change_token(self, seq):
+        return f"{self._change_stream_id}:{seq}"
+
+    def _watch(self, resume_after):
+        """Register a change stream; returns the sequence number it starts after"""
+        self._refresh()
+        with self._change_cond:
+            if self._changes is None:
+                self._changes = deque(maxlen=DEFAULT_CHANGE_BUFFER)
+            if resume_after is None:
+                start = self._change_seq
+            else:
+                stream_id, _, seq = str(resume_after).rpartition(':')
+                if stream_id != self._change_stream_id or not seq.isdigit() or int(seq) > self._change_seq:
+                    raise ValueError("Unknown resume token (the app may have restarted); reread the collection")
+                start = int(seq)
+            self._watchers += 1
+        return start
+
+    def _unwatch(self):
+        with self._change_cond:
+            self._watchers -= 1
+
+    def watch(self, query=None, resume_after=None, max_await_time=1.0):
+        """
+        Return a ChangeStream of the inserts/updates/deletes made from now on (or after the
+        resume token of an earlier event). query filters events by their document (the deleted
+        one for deletes). Recent changes are buffered in memory once a collection is watched,
+        so a stream can resume after short interruptions but not across app restarts.
+        """
+        return ChangeStream(self, query, resume_after=resume_after, max_await_time=max_await_time)
+
+    def _commit(self, records):
+        """Apply change records to the in-memory view and stage them; caller is inside _writing()"""
+        if self.storage == 'jsonl':
+            payload = b"".join(self.codec.dump_line(record) + b"\n" for record in records)
+            # Replay what is written so the view matches what a fresh open would produce
+            self._replay_lines(payload)
+        else:
+            for record in records:
+                # Apply what a reload would read back, so field types (e.g. datetimes, which the
+                # 'json' codec stores as strings) do not depend on which process wrote a document
+                self._apply(self.codec.load(self.codec.dump_line(record)))
+            payload = b""
+        self._staged.append(payload)
+
+    def _persist(self, payloads, queue=False):
+        """Write (or, for a queued write-behind insert, queue) the staged payloads of one _writing() block"""
+        if self.write_behind and queue:
+            self._pending.extend(payloads)
+            self._start_flusher()
+            return
+        if self._pending:
+            # Queued inserts were applied to the view first, so they go to the file first
+            payloads, self._pending = self._pending + payloads, []
+        if self.storage == 'jsonl':
+            payload = b"".join(payloads)
+            with open(self.file_path, 'ab') as f:
+                f.write(payload)
+                f.flush()
+                if self.fsync != 'os':
+                    os.fsync(f.fileno())
+            self._offset += len(payload)
+            self._maybe_compact()
+        else:
+            self._write_data(list(self._docs.values()))
+            # Our own write must not look like an external change
+            self._loaded_signature = self._file_signature()
+
+    # ------------------------------------------------------------------
+    # Write-behind
+    # ------------------------------------------------------------------
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name=f"json_db-flush-{self.collection_name}",
+                                             daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        # close() detaches the flusher to stop it
+        while self._flusher is threading.current_thread():
+            self._flush_wakeup.wait(self.flush_interval)
+            self._flush_wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️  json_db: flushing {self.file_path} failed, will retry: {e}")
+
+    def flush(self):
+        """Block until every write queued before this call is on disk (no-op without write-behind)"""
+        with self._flush_mutex:
+            with self._lock.write():
+                payloads, self._pending = self._pending, []
+            if not payloads:
+                return
+            try:
+                if self.storage == 'jsonl':
+                    self._flush_log(payloads)
+                else:
+                    self._flush_json()
+            except BaseException:
+                # Put the batch back so the next flush retries it
+                with self._lock.write():
+                    self._pending[:0] = payloads
+                raise
+
+    def close(self):
+        """
+        Flush queued writes, stop the flusher thread and release the lock file descriptor.
+        The collection stays usable: everything is reopened lazily on the next access.
+        """
+        with self._lock.write():
+            flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            self._flush_wakeup.set()
+            flusher.join()
+            atexit.unregister(self.flush)
+        self.flush()
+        _view_cache.discard(self)
+        self._file_lock.close()
+
+    def _flush_log(self, payloads):
+        with self._file_lock:
+            with self._lock.write():
+                # Other processes may have appended since we last looked
+                self._catch_up()
+                self._drop_torn_tail()
+                f = open(self.file_path, 'ab')
+                try:
+                    if self.fsync == 'always':
+                        for payload in payloads:
+                            f.write(payload)
+                            f.flush()
+                            os.fsync(f.fileno())
+                    else:
+                        f.write(b"".join(payloads))
+                        f.flush()
+                    # Advance while still holding the view lock, so readers never replay our own records
+                    self._offset = os.fstat(f.fileno()).st_size
+                except BaseException:
+                    f.close()
+                    raise
+                self._maybe_compact()
+            # The batch fsync does not need to block readers
+            with f:
+                if self.fsync == 'batch':
+                    os.fsync(f.fileno())
+
+    # ------------------------------------------------------------------
+    # Compaction
+    # ------------------------------------------------------------------
+    def _maybe_compact(self):
+        """Start a background compaction if the log has grown enough; caller holds the view write lock"""
+        if (self.compact_bytes and not self._compacting
+                and self._offset > max(self.compact_bytes, self._snapshot_size)):
+            self._compacting = True
+            threading.Thread(target=self._background_compact, name=f"json_db-compact-{self.collection_name}",
+                             daemon=True).start()
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"⚠️  json_db: compacting {self.file_path} failed: {e}")
+        finally:
+            self._compacting = False
+
+    def compact(self):
+        """
+        Fold the log into a new snapshot and keep only the records appended meanwhile ('jsonl' only).
+        Writers are blocked only while the view is copied and while the short tail is swapped in;
+        encoding and writing the snapshot happen without any lock. Returns True if it compacted.
+        """
+        if self.storage != 'jsonl':
+            return False
+        with self._file_lock, self._lock.write():
+            self._catch_up()
+            # Documents are never mutated in place, so a shallow copy is a consistent snapshot
+            # (a dict copy allocates a single object, so it cannot trigger a GC pass under the lock)
+            docs = dict(self._docs)
+            cut, file_id = self._offset, self._file_id
+        _view_cache.touch(self, self._view_size())
+
+        data = self.codec.dump({"docs": list(docs.items())})
+        tmp_path = self.snapshot_path.with_name(f".{self.snapshot_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            with self._file_lock, self._lock.write():
+                self._catch_up()
+                if self._file_id != file_id:
+                    # Another process compacted in the meantime
+                    return False
+                self._drop_torn_tail()
+                with open(self.file_path, 'rb') as f:
+                    f.seek(cut)
+                    tail = f.read(self._offset - cut)
+                # Snapshot first: a crash before the log swap leaves the full log, which replays idempotently
+                os.replace(tmp_path, self.snapshot_path)
+                _atomic_write(self.file_path, tail)
+                self._file_id = os.stat(self.file_path).st_ino
+                self._offset = len(tail)
+                self._snapshot_size = len(data)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        _view_cache.touch(self, self._view_size())
+        return True
+
+    # ------------------------------------------------------------------
+    # Archiving
+    # ------------------------------------------------------------------
+    def archive(self, query):
+        """
+        Move the documents matching query into a new compressed segment under '<collection>.archive/'
+        and delete them from the collection; returns the number of documents moved.
+        The segment is on disk before the deletes are committed, so a crash in between can leave
+        documents both archived and live, but never loses them.
+        """
+        with self._writing():
+            docs = [doc for _, doc in self._scan(query)]
+            if not docs:
+                return 0
+            self.archive_dir.mkdir(exist_ok=True)
+            name = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}_{_new_id()}.{self.codec.name}.gz"
+            _atomic_write(self.archive_dir / name, gzip.compress(self.codec.dump(docs)), fsync=self.fsync != 'os')
+            return self._delete(query, multi=True)
+
+    def archived(self):
+        """Read-only view of the documents archived from this collection"""
+        return ArchivedCollection([self.archive_dir])
+
+    def _flush_json(self):
+        with self._lock.read():
+            data = self.codec.dump(list(self._docs.values()))
+        with self._file_lock:
+            _atomic_write(self.file_path, data, fsync=self.fsync != 'os')
+            with self._lock.write():
+                self._loaded_signature = self._file_signature()
+
+    def _query_plan(self, query):
+        """
+        (plan, candidate ids in insertion order) for a query; the ids are None if a full scan is needed.
+        Equality/$in terms use the hash index covering the most fields (fewest lookups on ties);
+        otherwise a range term on a single-field index is answered from its sorted values.
+        """
+        equality, ranges = _pushdown_terms(query)
+        best, best_name, best_lookups = None, None, None
+        for name, index in self._indexes.items():
+            if all(field in equality for field in index.fields):
+                lookups = 1
+                for field in index.fields:
+                    lookups *= len(equality[field])
+                if best is None or (len(index.fields), -lookups) > (len(best.fields), -best_lookups):
+                    best, best_name, best_lookups = index, name, lookups
+
+        if best is not None:
+            ids = {}
+            for values in itertools.product(*(equality[field] for field in best.fields)):
+                ids.update(best.lookup(values))
+            plan = {"stage": "IXSCAN", "indexName": best_name, "keyPattern": dict.fromkeys(best.fields, 1),
+                    "bounds": "equality", "lookups": best_lookups}
+            return plan, sorted(ids, key=self._seq.__getitem__)
+
+        for name, index in self._indexes.items():
+            if len(index.fields) == 1 and index.fields[0] in ranges:
+                ids = index.lookup_range(ranges[index.fields[0]])
+                if ids is not None:
+                    plan = {"stage": "IXSCAN", "indexName": name, "keyPattern": {index.fields[0]: 1},
+                            "bounds": "range"}
+                    return plan, sorted(ids, key=self._seq.__getitem__)
+        return {"stage": "COLLSCAN"}, None
+
+    def _candidate_ids(self, query):
+        """Candidate ids for a query, in insertion order, or None if a full scan is needed (see _query_plan)"""
+        return self._query_plan(query)[1]
+
+    def _scan(self, query):
+        """Yield (id, document) pairs matching the query, in insertion order; caller holds a lock"""
+        docs = self._docs
+        matches = compile_query(query)
+        candidates = self._candidate_ids(query)
+        for doc_id in (docs if candidates is None else candidates):
+            doc = docs.get(doc_id)
+            if doc is not None and matches(doc):
+                yield doc_id, doc
+
+    def _matching(self, query):
+        """
+        Lazily yield (id, document) pairs matching the query.
+        Candidates are chosen under the read lock; filtering then runs lock-free over
+        documents that are never mutated in place.
+        """
+        with self._reading():
+            docs = self._docs
+            plan, candidates = self._query_plan(query)
+            if candidates is None:
+                candidates = list(docs)
+        matches = compile_query(query)
+        if self.slow_ms is not None:
+            yield from self._profiled(query, plan, docs, candidates, matches)
+            return
+        for doc_id in candidates:
+            doc = docs.get(doc_id)
+            if doc is not None and matches(doc):
+                yield doc_id, doc
+
+    # ------------------------------------------------------------------
+    # Profiling
+    # ------------------------------------------------------------------
+    def _profiled(self, query, plan, docs, candidates, matches):
+        """_matching with statistics; only time spent inside the generator counts, not the caller's"""
+        examined = returned = 0
+        elapsed = 0.0
+        started = time.perf_counter()
+        try:
+            for doc_id in candidates:
+                doc = docs.get(doc_id)
+                if doc is None:
+                    continue
+                examined += 1
+                if matches(doc):
+                    returned += 1
+                    elapsed += time.perf_counter() - started
+                    yield doc_id, doc
+                    started = time.perf_counter()
+            elapsed += time.perf_counter() - started
+        finally:
+            self._record_query(query, plan, examined, returned, elapsed)
+
+    def _record_query(self, query, plan, examined, returned, seconds):
+        ms = seconds * 1000
+        with self._stats_lock:
+            stats = self._stats
+            stats["queries"] += 1
+            stats["index_scans" if plan["stage"] == "IXSCAN" else "collection_scans"] += 1
+            stats["docs_examined"] += examined
+            stats["docs_returned"] += returned
+            stats["query_ms"] += ms
+            slow = ms >= self.slow_ms
+            stats["slow"] += slow
+        if slow:
+            _log_slow({"collection": self.collection_name, "op": "query", "query": query,
+                       "plan": plan.get("indexName", plan["stage"]), "examined": examined, "returned": returned,
+                       "ms": round(ms, 3), "time": datetime.now(timezone.utc).isoformat()})
+
+    def _record_write(self, seconds):
+        ms = seconds * 1000
+        with self._stats_lock:
+            self._stats["writes"] += 1
+            self._stats["write_ms"] += ms
+            slow = ms >= self.slow_ms
+            self._stats["slow"] += slow
+        if slow:
+            _log_slow({"collection": self.collection_name, "op": "write", "ms": round(ms, 3),
+                       "time": datetime.now(timezone.utc).isoformat()})
+
+    def stats(self):
+        """Query and write counters since the collection was opened (all zero unless profiling is on)"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["query_ms"] = round(stats["query_ms"], 3)
+        stats["write_ms"] = round(stats["write_ms"], 3)
+        with self._reading():
+            stats["documents"] = len(self._docs)
+        stats["indexes"] = list(self._indexes)
+        return stats
+
+    def _explain(self, query):
+        """Run a query for its plan and execution statistics (used by JSONCursor.explain)"""
+        started = time.perf_counter()
+        with self._reading():
+            docs = self._docs
+            plan, candidates = self._query_plan(query)
+            if candidates is None:
+                candidates = list(docs)
+        matches = compile_query(query)
+        examined = returned = 0
+        for doc_id in candidates:
+            doc = docs.get(doc_id)
+            if doc is not None:
+                examined += 1
+                if matches(doc):
+                    returned += 1
+        return _explain_result(self.collection_name, query, plan, examined, returned, time.perf_counter() - started)
+
+    # ------------------------------------------------------------------
+    # Collection API
+    # ------------------------------------------------------------------
+    def create_index(self, keys, name=None):
+        """Declare a single or compound secondary hash index; equality queries on its fields use it automatically"""
+        fields = _index_fields(keys)
+        name = name or "_".join(f"{field}_1" for field in fields)
+        with self._lock.write():
+            if name not in self._indexes:
+                index = _HashIndex(fields)
+                for doc_id, doc in self._docs.items():
+                    index.add(doc_id, doc)
+                self._indexes[name] = index
+        return name
+
+    def drop_index(self, name):
+        """Remove a secondary index"""
+        with self._lock.write():
+            self._indexes.pop(name, None)
+
+    def index_information(self):
+        """Return the declared indexes and their fields"""
+        return {name: {"key": [(field, 1) for field in index.fields]} for name, index in self._indexes.items()}
+
+    def _insert(self, documents):
+        """Stage inserts of documents; caller is inside _writing()"""
+        records = []
+        for document in documents:
+            # Add timestamp if not present
+            if 'created_at' not in document:
+                document['created_at'] = datetime.now().isoformat()
+            doc_id = _new_id() if self.storage == 'jsonl' else self._next_seq + len(records)
+            # _commit encodes the record, so the caller's document is not shared with the view
+            records.append({"op": "insert", "id": doc_id, "doc": document})
+        self._commit(records)
+        return [record["id"] for record in records]
+
+    def _update(self, query, update, multi, upsert):
+        """Stage an update of the first (or every) matching document; caller is inside _writing()"""
+        records = []
+        for doc_id, doc in self._scan(query):
+            changes, removed = _update_changes(doc, update)
+            changes['updated_at'] = datetime.now().isoformat()
+            record = {"op": "update", "id": doc_id, "set": changes}
+            if removed:
+                record["unset"] = removed
+            records.append(record)
+            if not multi:
+                break
+        if records:
+            self._commit(records)
+            return [record["id"] for record in records], None
+        if upsert:
+            return [], self._insert([_upsert_document(query, update)])[0]
+        return [], None
+
+    def _delete(self, query, multi):
+        """Stage deletes of the first (or every) matching document; caller is inside _writing()"""
+        doc_ids = [doc_id for doc_id, _ in itertools.islice(self._scan(query), None if multi else 1)]
+        if doc_ids:
+            self._commit([{"op": "delete", "id": doc_id} for doc_id in doc_ids])
+        return len(doc_ids)
 
     def insert_one(self, document):
         """Insert a single document"""
-        data = self._read_data()
-        # Add timestamp if not present
-        if 'created_at' not in document:
-            document['created_at'] = datetime.now().isoformat()
-        data.append(document)
-        self._write_data(data)
-        return type('InsertResult', (), {'inserted_id': len(data) - 1})()
-
-    def find_one(self, query=None):
+        with self._writing(queue=True):
+            doc_id = self._insert([document])[0]
+        return _result('InsertOneResult', inserted_id=doc_id)
+
+    def insert_many(self, documents):
+        """Insert several documents with a single commit"""
+        with self._writing(queue=True):
+            doc_ids = self._insert(list(documents))
+        return _result('InsertManyResult', inserted_ids=doc_ids)
+
+    def find_one(self, query=None, projection=None):
         """Find a single document matching the query"""
-        data = self._read_data()
-        if query is None:
-            return data[0] if data else None
+        for doc in self.find(query, projection).limit(1):
+            return doc
+        return None
+
+    def find(self, query=None, projection=None):
+        """Find all documents matching the query; returns a lazy JSONCursor"""
+        return JSONCursor(self, query, projection)
+
+    def update_one(self, query, update, upsert=False):
+        """Update a single document; with upsert=True a document is inserted if none matches"""
+        with self._writing():
+            doc_ids, upserted_id = self._update(query, update, multi=False, upsert=upsert)
+        return _result('UpdateResult', matched_count=len(doc_ids), modified_count=len(doc_ids),
+                       upserted_id=upserted_id)
+
+    def update_many(self, query, update, upsert=False):
+        """Update every matching document with a single commit"""
+        with self._writing():
+            doc_ids, upserted_id = self._update(query, update, multi=True, upsert=upsert)
+        return _result('UpdateResult', matched_count=len(doc_ids), modified_count=len(doc_ids),
+                       upserted_id=upserted_id)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE):
+        """
+        Atomically update the first matching document and return it (before or after the update).
+        The filter is evaluated and the update committed under the same write lock, so conditional
+        updates such as {"count": {"$lt": limit}} + {"$inc": {"count": 1}} cannot overshoot.
+        """
+        with self._writing():
+            before = next((doc for _, doc in self._scan(query)), None)
+            doc_ids, upserted_id = self._update(query, update, multi=False, upsert=upsert)
+            if return_document == ReturnDocument.AFTER:
+                doc_id = doc_ids[0] if doc_ids else upserted_id
+                doc = None if doc_id is None else self._docs.get(doc_id)
+            else:
+                doc = before
+        return None if doc is None else _project(doc, _normalize_projection(projection))
+
+    def delete_one(self, query):
+        """Delete the first document matching the query"""
+        with self._writing():
+            deleted = self._delete(query, multi=False)
+        return _result('DeleteResult', deleted_count=deleted)
+
+    def delete_many(self, query):
+        """Delete all documents matching the query"""
+        with self._writing():
+            deleted = self._delete(query, multi=True)
+        return _result('DeleteResult', deleted_count=deleted)
+
+    def bulk_write(self, requests):
+        """
+        Run InsertOne/UpdateOne/UpdateMany/DeleteOne/DeleteMany operations in order, as one
+        read-modify-commit cycle. If an operation fails, the ones before it are still committed.
+        """
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0,
+                  "upserted_count": 0}
+        upserted_ids = {}
+        with self._writing():
+            for position, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    self._insert([request.document])
+                    counts["inserted_count"] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    doc_ids, upserted_id = self._update(request.filter, request.update,
+                                                        multi=isinstance(request, UpdateMany), upsert=request.upsert)
+                    counts["matched_count"] += len(doc_ids)
+                    counts["modified_count"] += len(doc_ids)
+                    if upserted_id is not None:
+                        counts["upserted_count"] += 1
+                        upserted_ids[position] = upserted_id
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    counts["deleted_count"] += self._delete(request.filter, multi=isinstance(request, DeleteMany))
+                else:
+                    raise TypeError(f"Unsupported bulk operation {request!r}")
+        return _result('BulkWriteResult', upserted_ids=upserted_ids, **counts)
+
+    def count_documents(self, query=None):
+        """Count documents matching the query"""
+        if query is None or query == {}:
+            with self._reading():
+                return len(self._docs)
+        return sum(1 for _ in self._matching(query))
+
+    def explain_count(self, query=None):
+        """Plan and execution statistics of count_documents(query)"""
+        explanation = self._explain(query)
+        explanation["queryPlanner"]["winningPlan"] = {"stage": "COUNT",
+                                                      "inputStage": explanation["queryPlanner"]["winningPlan"]}
+        return explanation
+
+    def aggregate(self, pipeline):
+        """
+        Run an aggregation pipeline ($match, $group, $sort, $project, $unwind, $skip, $limit, $count).
+        Returns an iterator; a leading $match uses the indexes and the rest streams in a single pass.
+        """
+        return _aggregate(self, pipeline)
+
+
+class PartitionedCollection:
+    """
+    A collection sharded by one key (e.g. session_id) into per-partition JSONCollection files
+    under '<db_dir>/<collection>/', with a manifest mapping partition values to files.
+
+    Queries with an equality/$in term on the partition key only open the partitions they name,
+    so single-session reads and writes touch that session's file alone; any other query scans
+    every partition (in partition creation order). Documents without the key share one partition.
+    At most max_open_partitions partition handles are kept open, least recently used first out.
+
+    Operations routed to one partition are atomic as in JSONCollection. Operations spanning
+    partitions run partition by partition, and the partition key of a stored document cannot
+    be changed by an update. An existing unpartitioned '<collection>.json(l)' file is split into
+    partitions the first time the collection is opened this way.
+    """
+
+    def __init__(self, db_dir, collection_name, partition_key, storage='json', max_open_partitions=128,
+                 **collection_options):
+        self.db_dir = Path(db_dir)
+        self.collection_name = collection_name
+        self.partition_key = partition_key
+        self.storage = storage
+        self.max_open_partitions = max_open_partitions
+        self.collection_options = collection_options
+        self.partition_dir = self.db_dir / collection_name
+        self.manifest_path = self.partition_dir / "manifest.json"
+
+        # Encoded partition value -> file stem, in creation order
+        self._partitions = {}
+        self._manifest_signature = None
+        # Open partition handles, least recently used first
+        self._open = OrderedDict()
+        # Index name -> keys, applied to every partition when it is opened
+        self._index_specs = {}
+        # Profiling counters of partitions whose handles were closed
+        self._closed_stats = {}
+        self._lock = threading.RLock()
+
+        self.partition_dir.mkdir(parents=True, exist_ok=True)
+        self._manifest_lock = _FileLock(self.partition_dir / "manifest.lock")
+        with self._manifest_lock:
+            if not self.manifest_path.exists():
+                self._migrate_legacy()
+            self._load_manifest()
+
+    # ------------------------------------------------------------------
+    # Manifest and partition handles
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _encode_value(value):
+        return json.dumps(None if value is _MISSING else value, sort_keys=True, default=str)
+
+    @staticmethod
+    def _stem(encoded, value):
+        """File name for a partition: the value itself when it is a short safe string, a hash otherwise"""
+        if isinstance(value, str) and re.fullmatch(r'[A-Za-z0-9_-]{1,64}', value):
+            return f"p_{value}"
+        return "h_" + hashlib.sha1(encoded.encode()).hexdigest()[:20]
+
+    def _load_manifest(self):
+        """Re-read the manifest if another process changed it"""
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature != self._manifest_signature:
+            with open(self.manifest_path, 'r') as f:
+                self._partitions = json.load(f)["partitions"]
+            self._manifest_signature = signature
+
+    def _write_manifest(self):
+        data = {"partition_key": self.partition_key, "partitions": self._partitions}
+        _atomic_write(self.manifest_path, json.dumps(data, indent=2).encode())
+        stat = os.stat(self.manifest_path)
+        self._manifest_signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _migrate_legacy(self):
+        """Split an unpartitioned collection file into partitions; caller holds the manifest lock"""
+        codec = self.collection_options.get('codec')
+        suffix = _file_suffix(self.storage, _make_codec(codec or DEFAULT_CODEC))
+        legacy_path = self.db_dir / f"{self.collection_name}.{suffix}"
+        if legacy_path.exists():
+            legacy = JSONCollection(self.db_dir, self.collection_name, storage=self.storage, codec=codec)
+            groups = {}
+            for doc in legacy.find():
+                encoded = self._encode_value(_get_field(doc, self.partition_key))
+                groups.setdefault(encoded, []).append(doc)
+            for encoded, docs in groups.items():
+                stem = self._stem(encoded, json.loads(encoded))
+                self._partitions[encoded] = stem
+                partition = JSONCollection(self.partition_dir, stem, storage=self.storage, codec=codec)
+                partition.insert_many(docs)
+                partition.close()
+            legacy.close()
+        self._write_manifest()
+        if legacy_path.exists():
+            # Keep the original next to the partitions rather than deleting it
+            legacy_path.rename(legacy_path.with_name(legacy_path.name + ".migrated"))
+
+    def _handle(self, stem):
+        """Open (or reuse) the collection of a partition"""
+        with self._lock:
+            partition = self._open.pop(stem, None)
+            if partition is None:
+                partition = JSONCollection(self.partition_dir, stem, storage=self.storage, **self.collection_options)
+                for name, keys in self._index_specs.items():
+                    partition.create_index(keys, name=name)
+            self._open[stem] = partition
+            victims = []
+            while len(self._open) > self.max_open_partitions:
+                victims.append(self._open.popitem(last=False)[1])
+        for victim in victims:
+            self._retire(victim)
+        return partition
+
+    def _retire(self, partition):
+        """Close a partition handle, keeping its profiling counters"""
+        stats = partition.stats()
+        with self._lock:
+            for name, value in stats.items():
+                if isinstance(value, (int, float)) and name != "documents":
+                    self._closed_stats[name] = self._closed_stats.get(name, 0) + value
+        partition.close()
+
+    def _partition_for(self, value, create=False):
+        """The collection of the partition holding value, or None if it does not exist (and create is False)"""
+        encoded = self._encode_value(value)
+        with self._lock:
+            stem = self._partitions.get(encoded)
+            if stem is None:
+                self._load_manifest()
+                stem = self._partitions.get(encoded)
+        if stem is None:
+            if not create:
+                return None
+            with self._manifest_lock, self._lock:
+                self._load_manifest()
+                stem = self._partitions.get(encoded)
+                if stem is None:
+                    stem = self._stem(encoded, value)
+                    self._partitions[encoded] = stem
+                    self._write_manifest()
+        return self._handle(stem)
+
+    def _routed_value(self, query):
+        """The partition key value when the query names exactly one partition, else _MISSING"""
+        equality, _ = _pushdown_terms(query)
+        values = equality.get(self.partition_key)
+        return values[0] if values is not None and len(values) == 1 else _MISSING
+
+    def _targets(self, query):
+        """Yield the collections of the partitions a query can match"""
+        equality, _ = _pushdown_terms(query)
+        if self.partition_key in equality:
+            for value in equality[self.partition_key]:
+                partition = self._partition_for(value)
+                if partition is not None:
+                    yield partition
+            return
+        with self._lock:
+            self._load_manifest()
+            stems = list(self._partitions.values())
+        for stem in stems:
+            yield self._handle(stem)
+
+    def _check_update(self, update, routed_value):
+        """Reject updates that would move a document to another partition"""
+        key = self.partition_key
+        if any(str(field).startswith('$') for field in update):
+            assignments = [update.get('$set', {}), update.get('$setOnInsert', {})]
+            others = [update.get('$unset', {}), update.get('$inc', {})]
+        else:
+            assignments, others = [update], []
+        for fields in assignments + others:
+            touched = [field for field in fields if field == key or str(field).startswith(key + '.')]
+            if not touched:
+                continue
+            # Re-setting the key to the value the query is routed by is harmless
+            if (fields in assignments and touched == [key] and routed_value is not _MISSING
+                    and fields[key] == routed_value):
+                continue
+            raise ValueError(f"Cannot change partition key '{key}' of documents in {self.collection_name}")
+
+    def _matching(self, query):
+        """Lazily yield (id, document) pairs matching the query across its partitions (used by JSONCursor)"""
+        for partition in self._targets(query):
+            yield from partition._matching(query)
+
+    # ------------------------------------------------------------------
+    # Collection API
+    # ------------------------------------------------------------------
+    def create_index(self, keys, name=None):
+        """Declare an index on every partition (existing and future)"""
+        fields = _index_fields(keys)
+        name = name or "_".join(f"{field}_1" for field in fields)
+        with self._lock:
+            self._index_specs[name] = keys
+            partitions = list(self._open.values())
+        for partition in partitions:
+            partition.create_index(keys, name=name)
+        return name
+
+    def drop_index(self, name):
+        with self._lock:
+            self._index_specs.pop(name, None)
+            partitions = list(self._open.values())
+        for partition in partitions:
+            partition.drop_index(name)
+
+    def index_information(self):
+        return {name: {"key": [(field, 1) for field in _index_fields(keys)]}
+                for name, keys in self._index_specs.items()}
+
+    def insert_one(self, document):
+        """Insert a single document into the partition of its key"""
+        return self._partition_for(_get_field(document, self.partition_key), create=True).insert_one(document)
+
+    def insert_many(self, documents):
+        """Insert documents with one commit per partition"""
+        documents = list(documents)
+        groups = {}
+        for position, document in enumerate(documents):
+            encoded = self._encode_value(_get_field(document, self.partition_key))
+            groups.setdefault(encoded, []).append(position)
+        doc_ids = [None] * len(documents)
+        for positions in groups.values():
+            partition = self._partition_for(_get_field(documents[positions[0]], self.partition_key), create=True)
+            result = partition.insert_many([documents[position] for position in positions])
+            for position, doc_id in zip(positions, result.inserted_ids):
+                doc_ids[position] = doc_id
+        return _result('InsertManyResult', inserted_ids=doc_ids)
 
-        for doc in data:
-            if all(doc.get(k) == v for k, v in query.items()):
+    def find_one(self, query=None, projection=None):
+        for doc in self.find(query, projection).limit(1):
+            return doc
+        return None
+
+    def find(self, query=None, projection=None):
+        return JSONCursor(self, query, projection)
+
+    def count_documents(self, query=None):
+        return sum(partition.count_documents(query) for partition in self._targets(query))
+
+    def aggregate(self, pipeline):
+        """Aggregation pipeline over the partitions; a leading $match on the partition key only opens those"""
+        return _aggregate(self, pipeline)
+
+    def archive(self, query):
+        """Archive matching documents partition by partition (see JSONCollection.archive)"""
+        return sum(partition.archive(query) for partition in self._targets(query))
+
+    def archived(self):
+        """Read-only view of the documents archived from every partition"""
+        return ArchivedCollection(sorted(self.partition_dir.glob('*.archive')))
+
+    def _upsert(self, query, update):
+        """Insert the upsert document of a query that matched nothing in any partition; returns (id, document)"""
+        document = _upsert_document(query, update)
+        return self.insert_one(document).inserted_id, document
+
+    def update_one(self, query, update, upsert=False):
+        routed = self._routed_value(query)
+        self._check_update(update, routed)
+        if routed is not _MISSING:
+            partition = self._partition_for(routed, create=upsert)
+            if partition is not None:
+                return partition.update_one(query, update, upsert=upsert)
+        else:
+            for partition in self._targets(query):
+                result = partition.update_one(query, update)
+                if result.matched_count:
+                    return result
+            if upsert:
+                return _result('UpdateResult', matched_count=0, modified_count=0,
+                               upserted_id=self._upsert(query, update)[0])
+        return _result('UpdateResult', matched_count=0, modified_count=0, upserted_id=None)
+
+    def update_many(self, query, update, upsert=False):
+        routed = self._routed_value(query)
+        self._check_update(update, routed)
+        if routed is not _MISSING:
+            partition = self._partition_for(routed, create=upsert)
+            if partition is not None:
+                return partition.update_many(query, update, upsert=upsert)
+            return _result('UpdateResult', matched_count=0, modified_count=0, upserted_id=None)
+        matched = sum(partition.update_many(query, update).matched_count for partition in self._targets(query))
+        upserted_id = self._upsert(query, update)[0] if upsert and not matched else None
+        return _result('UpdateResult', matched_count=matched, modified_count=matched, upserted_id=upserted_id)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE):
+        routed = self._routed_value(query)
+        self._check_update(update, routed)
+        if routed is not _MISSING:
+            partition = self._partition_for(routed, create=upsert)
+            if partition is None:
+                return None
+            return partition.find_one_and_update(query, update, projection, upsert, return_document)
+        for partition in self._targets(query):
+            doc = partition.find_one_and_update(query, update, projection, return_document=return_document)
+            if doc is not None:
                 return doc
+        if upsert:
+            _, document = self._upsert(query, update)
+            if return_document == ReturnDocument.AFTER:
+                return _project(document, _normalize_projection(projection))
         return None
 
-    def find(self, query=None):
-        """Find all documents matching the query"""
-        data = self._read_data()
-        if query is None:
-            return data
-
-        results = []
-        for doc in data:
-            if all(doc.get(k) == v for k, v in query.items()):
-                results.append(doc)
-        return results
-
-    def update_one(self, query, update):
-        """Update a single document"""
-        data = self._read_data()
-        for i, doc in enumerate(data):
-            if all(doc.get(k) == v for k, v in query.items()):
-                # Handle $set operator
-                if '$set' in update:
-                    doc.update(update['$set'])
-                else:
-                    doc.update(update)
-                doc['updated_at'] = datetime.now().isoformat()
-                data[i] = doc
-                self._write_data(data)
-                return type('UpdateResult', (), {'modified_count': 1})()
-        return type('UpdateResult', (), {'modified_count': 0})()
+    def delete_one(self, query):
+        for partition in self._targets(query):
+            result = partition.delete_one(query)
+            if result.deleted_count:
+                return result
+        return _result('DeleteResult', deleted_count=0)
 
     def delete_many(self, query):
-        """Delete all documents matching the query"""
-        data = self._read_data()
-        original_count = len(data)
+        deleted = sum(partition.delete_many(query).deleted_count for partition in self._targets(query))
+        return _result('DeleteResult', deleted_count=deleted)
 
-        if query == {}:
-            # Delete all
-            self._write_data([])
-            return type('DeleteResult', (), {'deleted_count': original_count})()
+    def bulk_write(self, requests):
+        """Run bulk operations in order; each one is committed by the partition(s) it touches"""
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0,
+                  "upserted_count": 0}
+        upserted_ids = {}
+        for position, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                self.insert_one(request.document)
+                counts["inserted_count"] += 1
+            elif isinstance(request, (UpdateOne, UpdateMany)):
+                method = self.update_many if isinstance(request, UpdateMany) else self.update_one
+                result = method(request.filter, request.update, upsert=request.upsert)
+                counts["matched_count"] += result.matched_count
+                counts["modified_count"] += result.modified_count
+                if result.upserted_id is not None:
+                    counts["upserted_count"] += 1
+                    upserted_ids[position] = result.upserted_id
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                method = self.delete_many if isinstance(request, DeleteMany) else self.delete_one
+                counts["deleted_count"] += method(request.filter).deleted_count
+            else:
+                raise TypeError(f"Unsupported bulk operation {request!r}")
+        return _result('BulkWriteResult', upserted_ids=upserted_ids, **counts)
+
+    def flush(self):
+        """Wait until queued write-behind writes of every open partition are on disk"""
+        with self._lock:
+            partitions = list(self._open.values())
+        for partition in partitions:
+            partition.flush()
+
+    def close(self):
+        with self._lock:
+            partitions = list(self._open.values())
+            self._open.clear()
+        for partition in partitions:
+            self._retire(partition)
+        self._manifest_lock.close()
+
+    def stats(self):
+        """Profiling counters summed over the partitions (see JSONCollection.stats)"""
+        with self._lock:
+            totals = dict(self._closed_stats)
+            partitions = list(self._open.values())
+            totals["partitions"] = len(self._partitions)
+        for partition in partitions:
+            for name, value in partition.stats().items():
+                if isinstance(value, (int, float)) and name != "documents":
+                    totals[name] = round(totals.get(name, 0) + value, 3)
+        totals["open_partitions"] = len(partitions)
+        totals["indexes"] = list(self._index_specs)
+        return totals
+
+    def _explain(self, query):
+        """Plan and execution statistics over the partitions the query is routed to (used by JSONCursor.explain)"""
+        started = time.perf_counter()
+        routed = self.partition_key in _pushdown_terms(query)[0]
+        examined = returned = 0
+        plans = {}
+        for partition in self._targets(query):
+            explanation = partition._explain(query)
+            examined += explanation["executionStats"]["totalDocsExamined"]
+            returned += explanation["executionStats"]["nReturned"]
+            plan = explanation["queryPlanner"]["winningPlan"]
+            plans.setdefault(json.dumps(plan, sort_keys=True), [plan, 0])[1] += 1
+        plan = {"stage": "PARTITIONS", "partitionKey": self.partition_key, "routed": routed,
+                "partitions": sum(count for _, count in plans.values()),
+                "inputStages": [dict(plan, partitions=count) for plan, count in plans.values()]}
+        return _explain_result(self.collection_name, query, plan, examined, returned, time.perf_counter() - started)
+
+    def explain_count(self, query=None):
+        explanation = self._explain(query)
+        explanation["queryPlanner"]["winningPlan"] = {"stage": "COUNT",
+                                                      "inputStage": explanation["queryPlanner"]["winningPlan"]}
+        return explanation
+
+
+# Values of a field per archive segment (see ArchivedCollection.values); segments never change once written
+_segment_values = {}
+_segment_values_lock = threading.Lock()
+
+
+class ArchivedCollection:
+    """
+    Read-only view over archive segments (see JSONCollection.archive), with the query API of a collection.
+    Segments are decompressed one at a time while a query runs and no documents are cached, so archived
+    documents cost no memory until they are asked for. Documents come back in archiving order.
+    """
 
-        # Filter out matching documents
-        filtered_data = []
-        for doc in data:
-            if not all(doc.get(k) == v for k, v in query.items()):
-                filtered_data.append(doc)
+    def __init__(self, directories):
+        self.directories = list(directories)
 
-        self._write_data(filtered_data)
-        deleted_count = original_count - len(filtered_data)
-        return type('DeleteResult', (), {'deleted_count': deleted_count})()
+    def segments(self):
+        """Segment files, oldest first"""
+        return sorted((path for directory in self.directories if directory.is_dir()
+                       for path in directory.glob('*.gz')), key=lambda path: path.name)
+
+    @staticmethod
+    def _read_segment(path):
+        # Segment names end in '.<codec>.gz', recording the codec they were written with
+        codec = _make_codec(path.name.split('.')[-2])
+        return codec.load(gzip.decompress(path.read_bytes()))
+
+    def _matching(self, query):
+        """Lazily yield ((segment, position), document) pairs matching the query (used by JSONCursor)"""
+        matches = compile_query(query)
+        for path in self.segments():
+            for position, doc in enumerate(self._read_segment(path)):
+                if matches(doc):
+                    yield (path.name, position), doc
+
+    def values(self, field):
+        """
+        The values field takes in the archive (hashable, as index keys), e.g. to check that a session
+        is archived before querying for it. Each segment is read once per process for a given field.
+        """
+        values = set()
+        for path in self.segments():
+            key = (str(path), field)
+            with _segment_values_lock:
+                segment_values = _segment_values.get(key)
+            if segment_values is None:
+                segment_values = frozenset(_index_value(value) for value in
+                                           (_get_field(doc, field) for doc in self._read_segment(path))
+                                           if value is not _MISSING)
+                with _segment_values_lock:
+                    _segment_values[key] = segment_values
+            values |= segment_values
+        return values
+
+    def find_one(self, query=None, projection=None):
+        for doc in self.find(query, projection).limit(1):
+            return doc
+        return None
+
+    def find(self, query=None, projection=None):
+        return JSONCursor(self, query, projection)
 
     def count_documents(self, query=None):
-        """Count documents matching the query"""
-        if query is None or query == {}:
-            return len(self._read_data())
+        return sum(1 for _ in self._matching(query))
+
+    def aggregate(self, pipeline):
+        return _aggregate(self, pipeline)
+
+
+def expired_sessions(participants, days, key='session_id', completed_field='completion_time', now=None):
+    """
+    Keys of the sessions completed more than `days` days ago. completed_field is a datetime, or
+    the ISO string the 'json' codec stores datetimes as; naive times are taken as UTC.
+    """
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=days)
+    expired = []
+    for participant in participants.find({completed_field: {'$exists': True}}, {key: 1, completed_field: 1}):
+        completed = participant.get(completed_field)
+        if isinstance(completed, str):
+            try:
+                completed = datetime.fromisoformat(completed)
+            except ValueError:
+                continue
+        if not isinstance(completed, datetime) or key not in participant:
+            continue
+        if completed.tzinfo is None:
+            completed = completed.replace(tzinfo=timezone.utc)
+        if completed < cutoff:
+            expired.append(participant[key])
+    return expired
 
-        data = self._read_data()
-        count = 0
-        for doc in data:
-            if all(doc.get(k) == v for k, v in query.items()):
-                count += 1
-        return count
+
+def archive_completed_sessions(participants, collections, days, key='session_id',
+                               completed_field='completion_time', now=None):
+    """
+    TTL policy: archive the documents of every session completed more than `days` days ago
+    (see expired_sessions). collections maps names to collections with archive().
+    Returns {collection name: number of documents archived}.
+    """
+    expired = expired_sessions(participants, days, key, completed_field, now)
+    if not expired:
+        return {name: 0 for name in collections}
+    return {name: collection.archive({key: {'$in': expired}}) for name, collection in collections.items()}
 
 
 class JSONDatabase:
-    """Mimics MongoDB database interface"""
+    """Mimics MongoDB database interface; extra keyword options are passed to every JSONCollection"""
 
-    def __init__(self, db_dir='data'):
+    def __init__(self, db_dir='data', storage='json', **collection_options):
         self.db_dir = db_dir
+        self.storage = storage
+        self.collection_options = collection_options
         self._collections = {}
 
     def __getattr__(self, name):
         """Get or create a collection"""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._collections:
+            self._collections[name] = JSONCollection(self.db_dir, name, storage=self.storage,
+                                                     **self.collection_options)
+        return self._collections[name]
+
+    def get_collection(self, name, **options):
+        """Get or create a collection, opened with options overriding the database-wide ones"""
         if name not in self._collections:
-            self._collections[name] = JSONCollection(self.db_dir, name)
+            self._collections[name] = JSONCollection(self.db_dir, name, storage=self.storage,
+                                                     **dict(self.collection_options, **options))
         return self._collections[name]
 
+    def partitioned(self, name, partition_key, **options):
+        """Get or create a collection sharded by partition_key (see PartitionedCollection)"""
+        if name not in self._collections:
+            self._collections[name] = PartitionedCollection(self.db_dir, name, partition_key, storage=self.storage,
+                                                            **dict(self.collection_options, **options))
+        return self._collections[name]
+
+    def flush(self):
+        """Wait until all queued write-behind writes of every collection are on disk"""
+        for collection in list(self._collections.values()):
+            collection.flush()
+
+    def stats(self):
+        """Profiling counters of every collection opened through this database"""
+        return {name: collection.stats() for name, collection in list(self._collections.items())}
+
+    def close(self):
+        """Flush and close every collection opened through this database"""
+        collections, self._collections = list(self._collections.values()), {}
+        for collection in collections:
+            collection.close()
+
 
 class JSONClient:
     """Mimics MongoDB client interface"""
 
-    def __init__(self, host='localhost', port=27017, db_dir='data'):
+    def __init__(self, host='localhost', port=27017, db_dir='data', storage='json', **collection_options):
         self.host = host
         self.port = port
         self.db_dir = db_dir
+        self.storage = storage
+        self.collection_options = collection_options
         self._databases = {}
 
     def __getattr__(self, name):
         """Get or create a database"""
+        if name.startswith('_'):
+            raise AttributeError(name)
         if name not in self._databases:
-            self._databases[name] = JSONDatabase(self.db_dir)
+            self._databases[name] = JSONDatabase(self.db_dir, storage=self.storage, **self.collection_options)
         return self._databases[name]
+
+    def flush(self):
+        """Wait until all queued write-behind writes are on disk"""
+        for database in list(self._databases.values()):
+            database.flush()
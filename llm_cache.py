@@ -0,0 +1,158 @@
+"""
+Exact-match cache of chat model responses
+Agents opt in by name: cached(llm, agent) returns a runnable that stands in for the model in a
+chain (template | llm_cache.cached(llmemo, "shoes") | StrOutputParser()). For enabled agents, a
+call whose model, model parameters and rendered messages match an earlier one gets that
+response without calling the model. Other agents call the model as before. Entries are kept in
+a bounded LRU, optionally expire after ttl seconds and, with a path, are appended to a JSON-lines
+file so that later runs start warm.
+
+Model outputs are sampled, so a cached agent returns the same text for the same prompt. Scripts
+that sample one prompt several times keep the samples apart with variant():
+
+    with llm_cache.variant(sample):
+        complaint = sender_initial.invoke(parameters)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+
+class LLMCache:
+    """Responses by hash of (model, parameters, messages, variant), for the enabled agents"""
+
+    def __init__(self, max_entries=4096, ttl=None, path=None, agents=()):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = None
+        self.agents = set()
+        self._entries = OrderedDict()  # key -> (created, content)
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._variant = ContextVar(f"llm_cache_variant_{id(self)}", default=None)
+        self.enable(*agents)
+        if path:
+            self.persist(path)
+
+    def enable(self, *agents):
+        """Turn caching on for these agents ("*": all)"""
+        self.agents.update(agent.strip() for agent in agents if agent.strip())
+
+    def enabled(self, agent):
+        return "*" in self.agents or agent in self.agents
+
+    def persist(self, path):
+        """Load the entries saved at path and append new ones to it"""
+        with self._lock:
+            self.path = path
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            if os.path.exists(path):
+                self._load(path)
+
+    def _load(self, path):
+        now = time.time()
+        lines = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if self._fresh(entry["created"], now):
+                    self._store(entry["key"], entry["created"], entry["content"])
+        if lines > 2 * len(self._entries):
+            # Mostly expired, evicted or overwritten lines: rewrite with the live entries only
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for key, (created, content) in self._entries.items():
+                    f.write(json.dumps({"key": key, "created": created, "content": content}) + "\n")
+            os.replace(temp_path, path)
+
+    @contextmanager
+    def variant(self, name):
+        """Calls in this block are cached apart from the same prompts outside it"""
+        # A context variable, so it also holds in the threads LangChain runs parallel steps on
+        token = self._variant.set(name)
+        try:
+            yield
+        finally:
+            self._variant.reset(token)
+
+    def _fresh(self, created, now):
+        return self.ttl is None or now - created < self.ttl
+
+    def _store(self, key, created, content):
+        self._entries[key] = (created, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def key(self, llm, prompt):
+        """Hash of the model class and parameters, the rendered messages and the current variant"""
+        messages = prompt.to_messages() if hasattr(prompt, "to_messages") else prompt
+        if isinstance(messages, str):
+            messages = [("human", messages)]
+        else:
+            messages = [(message.type, message.content) for message in messages]
+        identity = {
+            "model": type(llm).__name__,
+            "params": getattr(llm, "_identifying_params", {}),
+            "messages": messages,
+            "variant": self._variant.get(),
+        }
+        return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _count(self, agent, outcome):
+        counters = self._counters.setdefault(agent, {"hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+    def invoke(self, llm, agent, prompt, config=None):
+        """llm.invoke(prompt), answered from the cache when agent is enabled and the call was seen"""
+        if not self.enabled(agent):
+            return llm.invoke(prompt, config)
+        key = self.key(llm, prompt)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._fresh(entry[0], now):
+                self._entries.move_to_end(key)
+                self._count(agent, "hits")
+                return AIMessage(content=entry[1])
+            self._count(agent, "misses")
+
+        response = llm.invoke(prompt, config)
+        with self._lock:
+            self._store(key, now, response.content)
+            if self.path:
+                # One line per write, so processes sharing the file do not interleave entries
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "created": now, "content": response.content}) + "\n")
+        return response
+
+    def cached(self, llm, agent):
+        """Stand-in for llm in an agent's chain; None (no model configured) stays None"""
+        if llm is None:
+            return None
+        return RunnableLambda(lambda prompt, config: self.invoke(llm, agent, prompt, config))
+
+    def stats(self):
+        """Entry count and hits/misses per agent"""
+        with self._lock:
+            return {"entries": len(self._entries), "agents": sorted(self.agents),
+                    "counters": {agent: dict(counters) for agent, counters in self._counters.items()}}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,141 @@
+"""
+Convert json_db collection files to another codec (see json_db.CODECS).
+Stop the app first: files are rewritten without taking the collection locks.
+
+    python migrate_json_db.py --codec compact
+    python migrate_json_db.py --codec orjson --revive-dates --db-dir data chat_history participants
+
+Every collection file in --db-dir (and in partitioned collection directories) is read with the
+codec it was written with (--from-codec, default 'json'; '.msgpack' files are always msgpack),
+rewritten with the new codec, and the original is kept as '<file>.bak'. A 'jsonl' log is read
+together with its compaction snapshot and rewritten as a single log; the snapshot is kept as
+'<collection>.snapshot.bak'.
+
+--revive-dates turns strings that look like ISO timestamps (e.g. the "2024-05-01 12:00:00+00:00"
+that the 'json' codec wrote for datetimes) back into datetimes, which the new codec then stores typed.
+"""
+import argparse
+import re
+from datetime import datetime
+from pathlib import Path
+
+from json_db import CODECS, _atomic_write, _make_codec, _new_id
+
+_ISO_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d{1,6})?([+-]\d{2}:\d{2})?')
+
+
+def revive_dates(value):
+    """Recursively convert ISO timestamp strings into datetimes"""
+    if isinstance(value, dict):
+        return {key: revive_dates(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [revive_dates(item) for item in value]
+    if isinstance(value, str) and _ISO_DATETIME.fullmatch(value):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+
+def snapshot_path(path):
+    """The compaction snapshot of a 'jsonl' log (see JSONCollection.compact)"""
+    return path.with_suffix('.snapshot')
+
+
+def read_documents(path, codec):
+    """Documents of a 'json' collection file, or the live documents of a 'jsonl' snapshot + log"""
+    data = path.read_bytes()
+    if path.suffix != '.jsonl':
+        return codec.load(data) if data.strip() else []
+    docs = {}
+    if snapshot_path(path).exists():
+        # The log only holds the changes made after the snapshot: replay them over it
+        docs.update((doc_id, doc) for doc_id, doc in codec.load(snapshot_path(path).read_bytes())["docs"])
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = codec.load(line)
+        except ValueError:
+            print(f"⚠️  Skipping unreadable record in {path}")
+            continue
+        if not isinstance(record, dict) or "op" not in record:
+            raise ValueError(f"{path} is not a collection log")
+        if record["op"] == "insert":
+            docs[record["id"]] = record["doc"]
+        elif record["op"] == "update" and record["id"] in docs:
+            docs[record["id"]] = dict(docs[record["id"]], **record.get("set", {}))
+            for field in record.get("unset", []):
+                docs[record["id"]].pop(field, None)
+        elif record["op"] == "delete":
+            docs.pop(record["id"], None)
+    return list(docs.values())
+
+
+def migrate_file(path, source_codec, target_codec, revive=False, dry_run=False):
+    """Rewrite one collection file with target_codec; returns the new path"""
+    codec = _make_codec('msgpack') if path.suffix == '.msgpack' else source_codec
+    docs = read_documents(path, codec)
+    if revive:
+        docs = revive_dates(docs)
+
+    if path.suffix == '.jsonl':
+        target = path
+        data = b"".join(target_codec.dump_line({"op": "insert", "id": _new_id(), "doc": doc}) + b"\n"
+                        for doc in docs)
+    else:
+        target = path.with_suffix(f".{target_codec.suffix}")
+        data = target_codec.dump(docs)
+    print(f"{path} -> {target}: {len(docs)} documents, {path.stat().st_size} -> {len(data)} bytes")
+    if dry_run:
+        return target
+
+    if path.suffix == '.jsonl' and snapshot_path(path).exists():
+        # Its documents are in the new log now; left in place it would be read with the wrong codec
+        snapshot = snapshot_path(path)
+        snapshot.rename(snapshot.with_name(snapshot.name + ".bak"))
+    path.rename(path.with_name(path.name + ".bak"))
+    _atomic_write(target, data)
+    return target
+
+
+def collection_files(db_dir, names):
+    """Collection files in db_dir, including the partitions of partitioned collections"""
+    for path in sorted(Path(db_dir).iterdir()):
+        name = path.name.split('.')[0]
+        if names and name not in names:
+            continue
+        if path.is_dir() and (path / "manifest.json").exists():
+            yield from (p for p in sorted(path.iterdir())
+                        if p.suffix in ('.json', '.jsonl', '.msgpack') and p.name != "manifest.json")
+        elif path.is_file() and path.suffix in ('.json', '.jsonl', '.msgpack'):
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert json_db collection files to another codec")
+    parser.add_argument("collections", nargs="*", help="collection names (default: all)")
+    parser.add_argument("--db-dir", default="data")
+    parser.add_argument("--codec", required=True, choices=CODECS, help="codec to write")
+    parser.add_argument("--from-codec", default="json", choices=[c for c in CODECS if c != 'msgpack'],
+                        help="codec the .json/.jsonl files were written with")
+    parser.add_argument("--revive-dates", action="store_true", help="turn ISO timestamp strings into datetimes")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be converted")
+    args = parser.parse_args()
+
+    source_codec, target_codec = _make_codec(args.from_codec), _make_codec(args.codec)
+    for path in collection_files(args.db_dir, set(args.collections)):
+        if path.suffix == '.jsonl' and target_codec.binary:
+            print(f"⚠️  Skipping {path}: the '{args.codec}' codec cannot be used with 'jsonl' storage")
+            continue
+        try:
+            migrate_file(path, source_codec, target_codec, revive=args.revive_dates, dry_run=args.dry_run)
+        except ValueError as e:
+            # Checked before anything is renamed, so the file is left as it was
+            print(f"⚠️  Skipping {path}: {e}")
+    print("Done. Set JSON_DB_CODEC=" + args.codec + " in project.env before starting the app.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Materialized quota counters for treatment assignment
+One counter document per (treatment_group, emotion_regulation_type) cell holds the number of
+assigned, non-screened-out participants. Reserving a slot is a single conditional increment
+(find_one_and_update with {"count": {"$lt": quota}}), so assignment is O(1) per cell and a cell
+can never be overfilled by concurrent submits.
+"""
+import random
+
+
+class QuotaCounters:
+    """Quota bookkeeping for the treatments x emotion_regulation_types design"""
+
+    def __init__(self, counters, participants, treatments, regulation_types, quota_per_cell):
+        self.counters = counters
+        self.participants = participants
+        self.treatments = list(treatments)
+        self.regulation_types = list(regulation_types)
+        self.quota_per_cell = quota_per_cell
+        self.counters.create_index([("treatment_group", 1), ("emotion_regulation_type", 1)])
+
+    @staticmethod
+    def _cell(treatment, regulation_type):
+        return {"treatment_group": treatment, "emotion_regulation_type": regulation_type}
+
+    def seed(self):
+        """
+        Create missing counters from the participants collection (one scan, at startup).
+        Existing counters are left alone, so restarting the app never resets them.
+        """
+        counts = {(t, r): 0 for t in self.treatments for r in self.regulation_types}
+        for group in self.participants.aggregate([
+            {"$match": {"screened_out": {"$ne": True}}},
+            {"$group": {"_id": {"treatment_group": "$treatment_group",
+                                "emotion_regulation_type": "$emotion_regulation_type"},
+                        "count": {"$sum": 1}}},
+        ]):
+            cell = (group["_id"]["treatment_group"], group["_id"]["emotion_regulation_type"])
+            if cell in counts:
+                counts[cell] = group["count"]
+        for (treatment, regulation_type), count in counts.items():
+            self.counters.update_one(self._cell(treatment, regulation_type),
+                                     {"$setOnInsert": {"count": count}}, upsert=True)
+
+    def counts(self, regulation_type):
+        """Current participant count per treatment for one emotion regulation type"""
+        counts = {treatment: 0 for treatment in self.treatments}
+        for counter in self.counters.find({"emotion_regulation_type": regulation_type}):
+            if counter.get("treatment_group") in counts:
+                counts[counter["treatment_group"]] = counter.get("count", 0)
+        return counts
+
+    def reserve(self, regulation_type):
+        """
+        Atomically take a slot in a random cell that still has room.
+        Cells are tried in random order, which picks uniformly among the available ones.
+        Returns the treatment, or None if every cell for this type is full.
+        """
+        for treatment in random.sample(self.treatments, len(self.treatments)):
+            query = dict(self._cell(treatment, regulation_type), count={"$lt": self.quota_per_cell})
+            if self.counters.find_one_and_update(query, {"$inc": {"count": 1}}) is not None:
+                return treatment
+        return None
+
+    def release(self, treatment, regulation_type):
+        """Give a reserved slot back (the participant was reassigned or the assignment failed)"""
+        query = dict(self._cell(treatment, regulation_type), count={"$gt": 0})
+        self.counters.update_one(query, {"$inc": {"count": -1}})
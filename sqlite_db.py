@@ -0,0 +1,411 @@
+"""
+SQLite-backed drop-in replacement for json_db's JSONClient
+Same attribute-style access (client.flask_db.chat_history) and the same subset of the
+pymongo API, but documents live in one SQLite file per database:
+
+- every collection is a table of (id, doc) rows, with the document stored as JSON text
+- create_index() adds a generated column per field (json_extract of the document) and a
+  real SQLite index over them, so equality/$in/range terms on hot keys are answered by SQLite
+- the database runs in WAL mode: readers never block the writer, and each write call is
+  a single transaction (BEGIN IMMEDIATE), so concurrent processes cannot lose updates
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from json_db import (JSONCursor, InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany, ReturnDocument,
+                     compile_query, _aggregate, _explain_result, _index_fields, _normalize_projection, _project, _pushdown_terms,
+                     _result, _update_changes, _upsert_document)
+
+# Seconds a writer waits for another process's transaction before giving up
+BUSY_TIMEOUT = float(os.getenv("SQLITE_DB_BUSY_TIMEOUT", "30"))
+
+# Column name prefix for generated index columns (keeps them apart from 'id' and 'doc')
+_COLUMN_PREFIX = "k:"
+
+
+def _quote(identifier):
+    """Quote an SQL identifier"""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _json_path(field):
+    """json_extract path for a (possibly dotted) field; numeric parts index into arrays, as in json_db"""
+    return "$" + "".join(f"[{part}]" if part.isdigit() else '."' + part.replace('"', '""') + '"'
+                         for part in field.split('.'))
+
+
+def _sql_value(value):
+    """The SQL parameter for a query value, or None if SQLite cannot compare it like Mongo does"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    return None
+
+
+def _encode(document):
+    return json.dumps(document, default=str)
+
+
+class SQLiteCollection:
+    """
+    Mimics MongoDB collection interface on top of an SQLite table.
+    Filters are evaluated with json_db's query compiler; terms on indexed fields are
+    pushed down to SQLite first so only candidate rows are decoded.
+    """
+
+    def __init__(self, database, collection_name):
+        self.database = database
+        self.collection_name = collection_name
+        self.table = _quote(collection_name)
+        with self.database.transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                         f"(id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT NOT NULL)")
+        self._columns = self._load_columns()
+
+    def _load_columns(self):
+        """Map indexed fields to the generated columns SQLite can filter on"""
+        conn = self.database.connection()
+        columns = {}
+        for row in conn.execute(f"PRAGMA table_xinfo({self.table})"):
+            name = row[1]
+            if name.startswith(_COLUMN_PREFIX):
+                columns[name[len(_COLUMN_PREFIX):]] = _quote(name)
+        return columns
+
+    def _index_fields_by_name(self):
+        """Read the declared indexes back from the schema"""
+        conn = self.database.connection()
+        indexes = {}
+        for row in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+                                (self.collection_name,)):
+            if row[1] is None:  # automatic index
+                continue
+            indexes[row[0]] = [info[2][len(_COLUMN_PREFIX):]
+                               for info in conn.execute(f"PRAGMA index_info({_quote(row[0])})")
+                               if info[2] and info[2].startswith(_COLUMN_PREFIX)]
+        return indexes
+
+    # ------------------------------------------------------------------
+    # Query helpers
+    # ------------------------------------------------------------------
+    def _where(self, query):
+        """SQL WHERE clause and parameters for the query terms that indexed fields can serve"""
+        equality, ranges = _pushdown_terms(query)
+        clauses, params = [], []
+        for field, values in equality.items():
+            column = self._columns.get(field)
+            values = [_sql_value(value) for value in values]
+            if column is None or not values or any(value is None for value in values):
+                continue
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        operators = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+        for field, bounds in ranges.items():
+            column = self._columns.get(field)
+            if column is None:
+                continue
+            for op, operand in bounds.items():
+                # Booleans sort with numbers in SQLite but not in Mongo
+                if _sql_value(operand) is None or isinstance(operand, bool):
+                    continue
+                clauses.append(f"{column} {operators[op]} ?")
+                params.append(operand)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def _rows(self, conn, query):
+        """Yield (id, document) pairs matching the query, in insertion order"""
+        where, params = self._where(query)
+        matches = compile_query(query)
+        for doc_id, text in conn.execute(f"SELECT id, doc FROM {self.table}{where} ORDER BY id", params):
+            doc = json.loads(text)
+            if matches(doc):
+                yield doc_id, doc
+
+    def _matching(self, query):
+        """Lazily yield (id, document) pairs matching the query (used by JSONCursor)"""
+        yield from self._rows(self.database.connection(), query)
+
+    def _explain(self, query):
+        """SQLite's query plan for the pushed-down terms plus execution statistics (used by JSONCursor.explain)"""
+        conn = self.database.connection()
+        where, params = self._where(query)
+        sql = f"SELECT id, doc FROM {self.table}{where} ORDER BY id"
+        details = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        index = next((detail.split(" INDEX ", 1)[1].split(" ", 1)[0].strip('"') for detail in details
+                      if " INDEX " in detail), None)
+        if index:
+            plan = {"stage": "IXSCAN", "indexName": index.removeprefix(f"{self.collection_name}.")}
+        else:
+            plan = {"stage": "COLLSCAN"}
+        plan["sql"] = sql
+        plan["sqlitePlan"] = details
+
+        started = time.perf_counter()
+        matches = compile_query(query)
+        examined = returned = 0
+        for _, text in conn.execute(sql, params):
+            examined += 1
+            if matches(json.loads(text)):
+                returned += 1
+        return _explain_result(self.collection_name, query, plan, examined, returned, time.perf_counter() - started)
+
+    def explain_count(self, query=None):
+        """Plan and execution statistics of count_documents(query)"""
+        explanation = self._explain(query)
+        explanation["queryPlanner"]["winningPlan"] = {"stage": "COUNT",
+                                                      "inputStage": explanation["queryPlanner"]["winningPlan"]}
+        return explanation
+
+    # ------------------------------------------------------------------
+    # Collection API
+    # ------------------------------------------------------------------
+    def create_index(self, keys, name=None):
+        """Declare a single or compound index; equality and range queries on its fields use it automatically"""
+        fields = _index_fields(keys)
+        name = name or "_".join(f"{field}_1" for field in fields)
+        with self.database.transaction() as conn:
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({self.table})")}
+            columns = []
+            for field in fields:
+                column = _quote(_COLUMN_PREFIX + field)
+                if _COLUMN_PREFIX + field not in existing:
+                    # Virtual generated columns need SQLite 3.31+ and cost nothing until indexed
+                    conn.execute(f"ALTER TABLE {self.table} ADD COLUMN {column} "
+                                 f"GENERATED ALWAYS AS (json_extract(doc, '{_json_path(field)}')) VIRTUAL")
+                columns.append(column)
+            index_name = _quote(f"{self.collection_name}.{name}")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.table} ({', '.join(columns)})")
+        self._columns.update(zip(fields, columns))
+        return name
+
+    def drop_index(self, name):
+        """Remove an index (its generated columns stay, they take no space)"""
+        with self.database.transaction() as conn:
+            conn.execute(f"DROP INDEX IF EXISTS {_quote(f'{self.collection_name}.{name}')}")
+
+    def index_information(self):
+        """Return the declared indexes and their fields"""
+        prefix = f"{self.collection_name}."
+        return {name[len(prefix):] if name.startswith(prefix) else name: {"key": [(field, 1) for field in fields]}
+                for name, fields in self._index_fields_by_name().items()}
+
+    def _insert(self, conn, documents):
+        doc_ids = []
+        for document in documents:
+            # Add timestamp if not present
+            if 'created_at' not in document:
+                document['created_at'] = datetime.now().isoformat()
+            cursor = conn.execute(f"INSERT INTO {self.table} (doc) VALUES (?)", (_encode(document),))
+            doc_ids.append(cursor.lastrowid)
+        return doc_ids
+
+    def _update(self, conn, query, update, multi, upsert):
+        """Update the first (or every) matching row; returns ([(id, updated document)], upserted_id)"""
+        updated = []
+        for doc_id, doc in list(self._rows(conn, query)):
+            changes, removed = _update_changes(doc, update)
+            changes['updated_at'] = datetime.now().isoformat()
+            doc.update(changes)
+            for field in removed:
+                doc.pop(field, None)
+            conn.execute(f"UPDATE {self.table} SET doc = ? WHERE id = ?", (_encode(doc), doc_id))
+            updated.append((doc_id, doc))
+            if not multi:
+                break
+        if not updated and upsert:
+            return [], self._insert(conn, [_upsert_document(query, update)])[0]
+        return updated, None
+
+    def _delete(self, conn, query, multi):
+        doc_ids = []
+        for doc_id, _ in self._rows(conn, query):
+            doc_ids.append((doc_id,))
+            if not multi:
+                break
+        conn.executemany(f"DELETE FROM {self.table} WHERE id = ?", doc_ids)
+        return len(doc_ids)
+
+    def insert_one(self, document):
+        """Insert a single document"""
+        with self.database.transaction() as conn:
+            doc_id = self._insert(conn, [document])[0]
+        return _result('InsertOneResult', inserted_id=doc_id)
+
+    def insert_many(self, documents):
+        """Insert several documents in one transaction"""
+        with self.database.transaction() as conn:
+            doc_ids = self._insert(conn, list(documents))
+        return _result('InsertManyResult', inserted_ids=doc_ids)
+
+    def find_one(self, query=None, projection=None):
+        """Find a single document"""
+        for doc in self.find(query, projection).limit(1):
+            return doc
+        return None
+
+    def find(self, query=None, projection=None):
+        """Find all documents matching the query; returns a lazy cursor supporting sort/skip/limit"""
+        return JSONCursor(self, query, projection)
+
+    def update_one(self, query, update, upsert=False):
+        """Update a single document; with upsert=True a document is inserted if none matches"""
+        with self.database.transaction() as conn:
+            updated, upserted_id = self._update(conn, query, update, multi=False, upsert=upsert)
+        return _result('UpdateResult', matched_count=len(updated), modified_count=len(updated),
+                       upserted_id=upserted_id)
+
+    def update_many(self, query, update, upsert=False):
+        """Update every matching document in one transaction"""
+        with self.database.transaction() as conn:
+            updated, upserted_id = self._update(conn, query, update, multi=True, upsert=upsert)
+        return _result('UpdateResult', matched_count=len(updated), modified_count=len(updated),
+                       upserted_id=upserted_id)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE):
+        """Atomically update the first matching document and return it (before or after the update)"""
+        with self.database.transaction() as conn:
+            before = next((doc for _, doc in self._rows(conn, query)), None)
+            updated, upserted_id = self._update(conn, query, update, multi=False, upsert=upsert)
+            if return_document == ReturnDocument.AFTER:
+                if upserted_id is not None:
+                    row = conn.execute(f"SELECT doc FROM {self.table} WHERE id = ?", (upserted_id,)).fetchone()
+                    doc = json.loads(row[0])
+                else:
+                    doc = updated[0][1] if updated else None
+            else:
+                doc = before
+        return None if doc is None else _project(doc, _normalize_projection(projection))
+
+    def delete_one(self, query):
+        """Delete the first document matching the query"""
+        with self.database.transaction() as conn:
+            deleted = self._delete(conn, query, multi=False)
+        return _result('DeleteResult', deleted_count=deleted)
+
+    def delete_many(self, query):
+        """Delete all documents matching the query"""
+        with self.database.transaction() as conn:
+            deleted = self._delete(conn, query, multi=True)
+        return _result('DeleteResult', deleted_count=deleted)
+
+    def bulk_write(self, requests):
+        """Run InsertOne/UpdateOne/UpdateMany/DeleteOne/DeleteMany operations in order, in one transaction"""
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0,
+                  "upserted_count": 0}
+        upserted_ids = {}
+        with self.database.transaction() as conn:
+            for position, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    self._insert(conn, [request.document])
+                    counts["inserted_count"] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    updated, upserted_id = self._update(conn, request.filter, request.update,
+                                                        multi=isinstance(request, UpdateMany), upsert=request.upsert)
+                    counts["matched_count"] += len(updated)
+                    counts["modified_count"] += len(updated)
+                    if upserted_id is not None:
+                        counts["upserted_count"] += 1
+                        upserted_ids[position] = upserted_id
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    counts["deleted_count"] += self._delete(conn, request.filter, multi=isinstance(request, DeleteMany))
+                else:
+                    raise TypeError(f"Unsupported bulk operation {request!r}")
+        return _result('BulkWriteResult', upserted_ids=upserted_ids, **counts)
+
+    def count_documents(self, query=None):
+        """Count documents matching the query"""
+        conn = self.database.connection()
+        if query is None or query == {}:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return sum(1 for _ in self._rows(conn, query))
+
+    def aggregate(self, pipeline):
+        """Aggregation pipeline as in JSONCollection.aggregate; a leading $match is pushed down to SQL"""
+        return _aggregate(self, pipeline)
+
+    def flush(self):
+        """Writes are durable when each call returns; kept for interface compatibility with JSONCollection"""
+
+
+class SQLiteDatabase:
+    """Mimics MongoDB database interface; one SQLite file, one connection per thread"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._collections = {}
+        self._collections_lock = threading.Lock()
+        # Persistent for the file: readers no longer block the writer (and vice versa)
+        self.connection().execute("PRAGMA journal_mode=WAL")
+
+    def connection(self):
+        """This thread's connection (reopened after a fork, SQLite connections must not cross processes)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            # WAL is crash-safe with NORMAL; only the last transactions before a power loss may roll back
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run a block as one write transaction, taking the write lock up front to avoid upgrade deadlocks"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def __getattr__(self, name):
+        """Get or create a collection"""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        with self._collections_lock:
+            if name not in self._collections:
+                self._collections[name] = SQLiteCollection(self, name)
+            return self._collections[name]
+
+    def list_collection_names(self):
+        """Names of the collections stored in the file"""
+        rows = self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                         "AND name NOT LIKE 'sqlite_%' ORDER BY name")
+        return [row[0] for row in rows]
+
+    def flush(self):
+        """Kept for interface compatibility with JSONDatabase"""
+
+
+class SQLiteClient:
+    """Mimics MongoDB client interface; each database is stored in <db_dir>/<name>.sqlite3"""
+
+    def __init__(self, host='localhost', port=27017, db_dir='data'):
+        self.host = host
+        self.port = port
+        self.db_dir = db_dir
+        self._databases = {}
+        self._databases_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        """Get or create a database"""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        with self._databases_lock:
+            if name not in self._databases:
+                self._databases[name] = SQLiteDatabase(Path(self.db_dir) / f"{name}.sqlite3")
+            return self._databases[name]
+
+    def flush(self):
+        """Kept for interface compatibility with JSONClient"""
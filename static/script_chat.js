@@ -343,7 +343,75 @@ function createLoader(loaderId = 'info-loader') {
   return loader;
 }
 
-function retrieveInfoSupport(message,support_type) {
+// One /copilot/ request for all of a turn's support: returns a promise per agent that resolves
+// with {message} (like the per-agent endpoints) as soon as that agent's NDJSON line arrives
+function requestCopilot(message, agents) {
+  const sessionId = window.location.pathname.split('/')[2];
+  const clientId = sessionStorage.getItem('client_id');
+
+  const resolvers = {};
+  const results = {};
+  agents.forEach((agent) => {
+    results[agent] = new Promise((resolve, reject) => {
+      resolvers[agent] = { resolve, reject };
+    });
+  });
+  const settle = (line) => {
+    const data = JSON.parse(line);
+    const resolver = resolvers[data.agent];
+    if (!resolver) return;
+    delete resolvers[data.agent];
+    if (data.error) {
+      resolver.reject(new Error(data.error));
+    } else {
+      resolver.resolve(data);
+    }
+  };
+
+  fetch(`/copilot/${sessionId}/`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ client_reply: message, client_id: clientId, agents: agents }),
+  })
+    .then(async (response) => {
+      if (!response.ok) {
+        throw new Error((await response.json()).message);
+      }
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffered = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffered += decoder.decode(value, { stream: true });
+        const lines = buffered.split('\n');
+        buffered = lines.pop();
+        lines.filter((line) => line.trim()).forEach(settle);
+      }
+      if (buffered.trim()) settle(buffered);
+      throw new Error('Copilot response ended early');
+    })
+    .catch((error) => {
+      Object.values(resolvers).forEach((resolver) => resolver.reject(error));
+    });
+
+  return results;
+}
+
+function postSupport(endpoint, body) {
+  const sessionId = window.location.pathname.split('/')[2];
+  return fetch(`/${endpoint}/${sessionId}/`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(body),
+  }).then((response) => response.json());
+}
+
+function retrieveInfoSupport(message, support_type, supportRequest) {
   const infoDiv = document.getElementById('co-pilot');
 
     const header = document.createElement('div');
@@ -363,17 +431,9 @@ function retrieveInfoSupport(message,support_type) {
 
     infoDiv.appendChild(header);
 
-  const sessionId = window.location.pathname.split('/')[2];
   const clientId = sessionStorage.getItem('client_id');
 
-  fetch(`/get-info-support/${sessionId}/`, {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({ client_reply: message, client_id: clientId }),
-  })
-    .then((response) => response.json())
+  (supportRequest || postSupport('get-info-support', { client_reply: message, client_id: clientId }))
     .then((data) => {
       const responseContainer = document.createElement('div');
       responseContainer.style.display = 'flex';
@@ -400,7 +460,7 @@ function retrieveInfoSupport(message,support_type) {
 
 
 
-function retrieveEmoSupport(message, support_type) {
+function retrieveEmoSupport(message, support_type, supportRequest) {
   const supportDiv = document.getElementById('supportWindow');
 
   const cardId = `${support_type}-card`;
@@ -435,18 +495,10 @@ function retrieveEmoSupport(message, support_type) {
     card.appendChild(header);
     supportDiv.appendChild(card);
 
-  const sessionId = window.location.pathname.split('/')[2];
   const clientId = sessionStorage.getItem('client_id');
 
   if (support_type == 'TYPE_SENTIMENT') {
-    fetch(`/sentiment/${sessionId}/`, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({ client_reply: message, client_id: clientId }),
-    })
-      .then((response) => response.json())
+    (supportRequest || postSupport('sentiment', { client_reply: message, client_id: clientId }))
       .then((data) => {
         // Add this into html
         document.getElementById(loaderId).remove();
@@ -461,18 +513,11 @@ function retrieveEmoSupport(message, support_type) {
       })
       .catch((error) => console.error('Error:', error));
   } else {
-    fetch(`/get-emo-support/${sessionId}/`, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
+    (supportRequest || postSupport('get-emo-support', {
         client_reply: message,
         type: support_type,
         client_id: clientId,
-      }),
-    })
-      .then((response) => response.json())
+      }))
       .then((data) => {
         //            var emoMessage = createSupportPane(data.message, "emo")
         //            card.appendChild(emoMessage);
@@ -577,7 +622,7 @@ function sendEmoFeedback(support_type) {
     });
 }
 
-function retrieveTroubleSupport(message, support_type) {
+function retrieveTroubleSupport(message, support_type, supportRequest) {
   const troubleDiv = document.getElementById('troubleWindow');
 
     const header = document.createElement('div');
@@ -599,17 +644,9 @@ function retrieveTroubleSupport(message, support_type) {
     header.appendChild(loader);
     troubleDiv.appendChild(header);
 
-    const sessionId = window.location.pathname.split('/')[2];
     const clientId = sessionStorage.getItem('client_id');
 
-    fetch(`/get-trouble-support/${sessionId}/`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({client_reply: message, client_id: clientId}),
-        })
-        .then(response => response.json())
+    (supportRequest || postSupport('get-trouble-support', {client_reply: message, client_id: clientId}))
         .then(data => {
 
             const orderList = document.createElement('ol');
@@ -652,14 +689,24 @@ function processClientResponse(data) {
 
   updateFlag('client_response');
 
+  // All of this turn's support comes from one /copilot/ request, each pane filled as its agent finishes
+  const agents = [];
+  if (data.show_info == '1') agents.push('info', 'trouble');
+  if (data.show_emo == '1') {
+    agents.push('sentiment');
+    if (turn_number > 1) agents.push('reframe');
+  }
+  if (agents.length == 0) return;
+  const support = requestCopilot(data.message, agents);
+
   if (data.show_info == '1') {
     const infoDiv = document.getElementById('co-pilot');
     infoDiv.innerHTML = '';
-    retrieveInfoSupport(data.message, "TYPE_INFO_CUE");
+    retrieveInfoSupport(data.message, "TYPE_INFO_CUE", support.info);
 
     const troubleDiv = document.getElementById('troubleWindow');
     troubleDiv.innerHTML = '';
-    retrieveTroubleSupport(data.message, 'TYPE_INFO_GUIDE');
+    retrieveTroubleSupport(data.message, 'TYPE_INFO_GUIDE', support.trouble);
   }
 
   if (data.show_emo == '1') {
@@ -667,10 +714,10 @@ function processClientResponse(data) {
     supportDiv.innerHTML = '';
     //        retrieveEmoSupport(data.message,TYPE_EMO_THOUGHT);
     //        retrieveEmoSupport(data.message,TYPE_EMO_SHOES);
-    retrieveEmoSupport(data.message, 'TYPE_SENTIMENT');
+    retrieveEmoSupport(data.message, 'TYPE_SENTIMENT', support.sentiment);
 
     if (turn_number > 1){
-        retrieveEmoSupport(data.message, 'TYPE_EMO_REFRAME');
+        retrieveEmoSupport(data.message, 'TYPE_EMO_REFRAME', support.reframe);
     }
 
   }
@@ -0,0 +1,48 @@
+"""
+Speculative coworker support
+getReply starts the support agents for a client reply as soon as it has generated it, so they run
+while the reply travels to the representative's browser. Each result waits in a slot keyed by
+(client_id, turn, agent, reply); the support request that follows takes its slot and gets the
+result at once, or waits only for the time the agent still needs. Slots nobody takes expire.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SupportSlots:
+    """Background support computations, parked per key until run() takes them"""
+
+    def __init__(self, max_workers=8, ttl=600, max_slots=4096):
+        self.ttl = ttl
+        self.max_slots = max_slots
+        # Own pool: /copilot/ workers wait on these futures, so they must not share theirs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative-support")
+        self._slots = OrderedDict()  # key -> (started, future)
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._slots:
+            key, (started, future) = next(iter(self._slots.items()))
+            if len(self._slots) < self.max_slots and now - started < self.ttl:
+                break
+            del self._slots[key]
+            future.cancel()
+
+    def start(self, key, fn, *args):
+        """Start fn(*args) in the background unless a slot for key already exists"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key not in self._slots:
+                self._slots[key] = (now, self._executor.submit(fn, *args))
+
+    def run(self, key, fn, *args):
+        """The result of the slot for key if there is one, else fn(*args) computed now"""
+        with self._lock:
+            _, future = self._slots.pop(key, (None, None))
+        if future is None or future.cancel():
+            # Not speculated, or still queued: cheaper to run it here than to wait for a worker
+            return fn(*args)
+        return future.result()